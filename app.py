@@ -1,5 +1,6 @@
 import os
 import json
+import time
 import logging
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
@@ -16,7 +17,32 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
+def ensure_schema(app):
+    """
+    Bring the database schema up to date (see migrations.py): missing tables are
+    created and columns added since the database was created are added. The
+    database records its schema version, so normal restarts cost one query.
+    SCHEMA_CHECK=always checks every table and step on each boot, SCHEMA_CHECK=off skips it.
+    Returns True if the schema was checked (the database was behind, or mode is 'always').
+    """
+    mode = app.config['SCHEMA_CHECK']
+    if mode == 'off':
+        return False
+    
+    from migrations import migrate, current_version, SCHEMA_VERSION
+    try:
+        steps = migrate(force=(mode == 'always'))
+    except Exception:
+        # Another worker booting at the same time may have migrated first
+        with db.engine.connect() as connection:
+            if (current_version(connection) or 0) < SCHEMA_VERSION:
+                raise
+        return False
+    return steps is not None
+
 def create_app():
+    timings = {}
+    started = time.perf_counter()
     app = Flask(__name__)
     
     # Configuration
@@ -32,13 +58,62 @@ def create_app():
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
     # File upload configuration
-    app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+    # Limits per uploaded file and on the files of one upload (0 = unlimited);
+    # a request may carry that many files plus a patient file
+    app.config['MAX_FILE_SIZE'] = int(os.environ.get('MAX_FILE_SIZE', 16 * 1024 * 1024))
+    app.config['MAX_UPLOAD_FILES'] = int(os.environ.get('MAX_UPLOAD_FILES', 10))
+    if app.config['MAX_FILE_SIZE'] and app.config['MAX_UPLOAD_FILES']:
+        app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_FILE_SIZE'] * (app.config['MAX_UPLOAD_FILES'] + 1) + 1024 * 1024
     app.config['UPLOAD_FOLDER'] = 'uploads'
     app.config['DOWNLOAD_FOLDER'] = 'downloads'
+    app.config['STATE_FOLDER'] = os.environ.get('STATE_FOLDER', 'state')
+    app.config['PREVIEW_FOLDER'] = os.environ.get('PREVIEW_FOLDER', 'previews')
+    # Uploads are stored by content hash; ones no queued or running job reads
+    # are deleted after this many idle hours (0 = keep them)
+    app.config['UPLOAD_RETENTION_HOURS'] = float(os.environ.get('UPLOAD_RETENTION_HOURS', 24))
+    # Result previews (copies of the patient rows) are deleted after this many hours (0 = keep them)
+    app.config['PREVIEW_RETENTION_HOURS'] = float(os.environ.get('PREVIEW_RETENTION_HOURS',
+                                                                app.config['UPLOAD_RETENTION_HOURS']))
+    # Upload/download folders are created on first use, not at boot
+    
+    # Date (YYYY-MM-DD) patient ages are computed against; unset means today
+    app.config['REPORTING_DATE'] = os.environ.get('REPORTING_DATE')
+    
+    # Schema creation: 'cached' (default), 'always' or 'off'
+    app.config['SCHEMA_CHECK'] = os.environ.get('SCHEMA_CHECK', 'cached')
+    
+    # Prewarmed processing worker pool (0 = process jobs in the web worker)
+    app.config['PROCESSING_WORKERS'] = int(os.environ.get('PROCESSING_WORKERS', 0))
+    app.config['WORKER_MAX_JOBS'] = int(os.environ.get('WORKER_MAX_JOBS', 50))
+    app.config['WORKER_MAX_RSS_MB'] = int(os.environ.get('WORKER_MAX_RSS_MB', 1024))
+    
+    # Admission control (0 = unlimited): concurrent jobs per user, estimated
+    # memory of all running jobs, and jobs a user may have waiting
+    app.config['MAX_JOBS_PER_USER'] = int(os.environ.get('MAX_JOBS_PER_USER', 2))
+    app.config['JOB_MEMORY_BUDGET_MB'] = int(os.environ.get('JOB_MEMORY_BUDGET_MB', 2048))
+    app.config['MAX_QUEUED_JOBS_PER_USER'] = int(os.environ.get('MAX_QUEUED_JOBS_PER_USER', 20))
+    # Processes on the host sharing this lock file share the memory budget; a
+    # running job whose process shows no sign of life for the timeout is failed
+    app.config['JOB_LOCK_FILE'] = os.environ.get('JOB_LOCK_FILE', os.path.join(app.instance_path, 'scheduler.lock'))
+    app.config['JOB_HEARTBEAT_TIMEOUT'] = int(os.environ.get('JOB_HEARTBEAT_TIMEOUT', 120))
+    # Run jobs in background threads ('auto': unless the server runs the app
+    # without threads, e.g. uWSGI without enable-threads); otherwise each job
+    # runs in the request that submitted it
+    app.config['JOB_THREADS'] = os.environ.get('JOB_THREADS', 'auto').lower()
+    
+    # Failed logins allowed per client address, and per username from one
+    # address, within the window before further attempts are refused (0 = unlimited)
+    app.config['LOGIN_MAX_FAILURES_PER_IP'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_IP', 20))
+    app.config['LOGIN_MAX_FAILURES_PER_USERNAME'] = int(os.environ.get('LOGIN_MAX_FAILURES_PER_USERNAME', 5))
+    app.config['LOGIN_FAILURE_WINDOW_SECONDS'] = int(os.environ.get('LOGIN_FAILURE_WINDOW_SECONDS', 900))
+    # Failed logins for one username from any address before a warning is logged (0 = never)
+    app.config['LOGIN_USERNAME_ALARM_FAILURES'] = int(os.environ.get('LOGIN_USERNAME_ALARM_FAILURES', 100))
+    # Reverse proxies in front of the app that append to X-Forwarded-For (0 = use the connection's address)
+    app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0))
     
-    # Create directories if they don't exist
-    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-    os.makedirs(app.config['DOWNLOAD_FOLDER'], exist_ok=True)
+    # Hours an API token stays valid after it is issued (0 = until replaced or revoked)
+    app.config['API_TOKEN_LIFETIME_HOURS'] = float(os.environ.get('API_TOKEN_LIFETIME_HOURS', 720))
+    timings['config'] = time.perf_counter() - started
     
     # Initialize extensions
     db.init_app(app)
@@ -48,7 +123,10 @@ def create_app():
     login_manager.login_message_category = 'info'
     
     # Proxy fix for deployment
-    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+    # x_for: login throttling counts failures per client address; X-Forwarded-For
+    # is only trusted from the TRUSTED_PROXIES proxies in front of the app, since
+    # a client could otherwise send any address
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=1, x_host=1)
     
     # Add custom Jinja2 filters
     @app.template_filter('fromjson')
@@ -58,17 +136,59 @@ def create_app():
         except (ValueError, TypeError):
             return []
     
+    timings['extensions'] = time.perf_counter() - started - sum(timings.values())
+    
     with app.app_context():
         # Import models to ensure tables are created
         from models import User
         
-        # Create all tables
-        db.create_all()
+        # Create missing tables and columns when the database is behind the models
+        schema_created = ensure_schema(app)
+        timings['schema'] = time.perf_counter() - started - sum(timings.values())
         
         # Register blueprints
-        from routes import main_bp, auth_bp
+        from routes import main_bp, auth_bp, api_bp
         app.register_blueprint(main_bp)
         app.register_blueprint(auth_bp, url_prefix='/auth')
+        app.register_blueprint(api_bp, url_prefix='/api')
+        timings['blueprints'] = time.perf_counter() - started - sum(timings.values())
+        
+        # Hashed, precompressed copies of static/ for long-lived browser caching
+        from assets import init_assets
+        init_assets(app)
+        timings['assets'] = time.perf_counter() - started - sum(timings.values())
+        
+        if app.config['PROCESSING_WORKERS'] > 0:
+            # Fork the prewarmed workers now so the first job doesn't pay for imports
+            from workers import start_pool
+            start_pool(app.config['PROCESSING_WORKERS'], app.config['WORKER_MAX_JOBS'],
+                       app.config['WORKER_MAX_RSS_MB'])
+            timings['workers'] = time.perf_counter() - started - sum(timings.values())
+    
+    from scheduler import scheduler, threads_supported
+    from routes import _job_thread, job_interrupted
+    # Fails jobs left running by a previous run; queued ones start once there is room
+    scheduler.configure(app.config['MAX_JOBS_PER_USER'], app.config['JOB_MEMORY_BUDGET_MB'],
+                        app.config['MAX_QUEUED_JOBS_PER_USER'], app=app,
+                        runner=lambda job_id: _job_thread(app, job_id), interrupted=job_interrupted,
+                        lock_path=app.config['JOB_LOCK_FILE'],
+                        heartbeat_timeout=app.config['JOB_HEARTBEAT_TIMEOUT'],
+                        threads=threads_supported() if app.config['JOB_THREADS'] == 'auto'
+                                else app.config['JOB_THREADS'] in ('1', 'true', 'yes', 'on'))
+    # Each serving process checks the queue (started on its first request, so
+    # scripts that create the app never pick up jobs)
+    app.before_request(scheduler.start_polling)
+    
+    from security import login_throttle
+    login_throttle.configure(app.config['LOGIN_MAX_FAILURES_PER_IP'], app.config['LOGIN_MAX_FAILURES_PER_USERNAME'],
+                             app.config['LOGIN_FAILURE_WINDOW_SECONDS'], app.config['LOGIN_USERNAME_ALARM_FAILURES'])
+    
+    app.config['STARTUP_TIMINGS'] = {name: round(seconds * 1000, 1) for name, seconds in timings.items()}
+    logging.info(
+        f"App created in {(time.perf_counter() - started) * 1000:.1f} ms "
+        f"(schema {'migrated' if schema_created else 'current'}): "
+        + ', '.join(f"{name} {ms} ms" for name, ms in app.config['STARTUP_TIMINGS'].items())
+    )
     
     return app
 
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Fingerprinted, precompressed static assets.
+
+Each file in static/ is copied to static/dist/ under a name carrying a hash of
+its content (style.css -> style.3f2a9c1b7e04.css), with gzip and, when the
+optional brotli package is installed, brotli versions next to it. A manifest
+maps source names to hashed names; templates call asset_url('style.css') to
+get the hashed URL, falling back to the plain file when it has no build.
+
+Hashed files never change, so they are served with a one-year immutable
+Cache-Control, and the precompressed version the browser accepts is sent
+as is. The build runs at startup (only changed files are written) and can
+be run by hand:
+
+    python assets.py
+"""
+
+import os
+import sys
+import gzip
+import json
+import hashlib
+import logging
+import mimetypes
+
+from flask import request, send_from_directory, url_for
+
+DIST_DIR = 'dist'
+MANIFEST_FILE = 'manifest.json'
+# Text assets worth compressing; images and fonts are already compressed
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.map'}
+IMMUTABLE_MAX_AGE = 31536000
+
+def _write_atomic(path, data):
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    os.replace(temp_path, path)
+
+def _brotli():
+    try:
+        import brotli
+        return brotli
+    except ImportError:
+        return None
+
+def build_assets(static_folder):
+    """
+    Write hashed and precompressed copies of the files in static_folder.
+    Returns the manifest {source name: hashed name relative to static_folder}.
+    """
+    dist = os.path.join(static_folder, DIST_DIR)
+    os.makedirs(dist, exist_ok=True)
+    brotli = _brotli()
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        # Never fingerprint the build output itself
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != dist]
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_folder).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                content = f.read()
+            stem, ext = os.path.splitext(relative)
+            hashed = f"{stem}.{hashlib.sha256(content).hexdigest()[:12]}{ext}"
+            target = os.path.join(dist, hashed)
+            manifest[relative] = f"{DIST_DIR}/{hashed}"
+            if os.path.exists(target):
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _write_atomic(target, content)
+            if ext.lower() in COMPRESSIBLE:
+                # mtime=0 keeps the compressed bytes identical between builds
+                _write_atomic(f"{target}.gz", gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    _write_atomic(f"{target}.br", brotli.compress(content, quality=11))
+            logging.info(f"Built asset {relative} -> {hashed}")
+
+    manifest_path = os.path.join(dist, MANIFEST_FILE)
+    payload = json.dumps(manifest, indent=2, sort_keys=True).encode()
+    if load_manifest(static_folder) != manifest:
+        _write_atomic(manifest_path, payload)
+    return manifest
+
+def load_manifest(static_folder):
+    try:
+        with open(os.path.join(static_folder, DIST_DIR, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def init_assets(app):
+    """Build the assets, add asset_url() to templates and serve hashed files with long-lived caching"""
+    try:
+        manifest = build_assets(app.static_folder)
+    except OSError as e:
+        # Read-only deployments can ship a prebuilt static/dist
+        logging.warning(f"Could not build static assets, using the existing build: {str(e)}")
+        manifest = load_manifest(app.static_folder)
+    app.config['ASSET_MANIFEST'] = manifest
+
+    @app.template_global()
+    def asset_url(filename):
+        return url_for('static', filename=app.config['ASSET_MANIFEST'].get(filename, filename))
+
+    send_static_file = app.view_functions['static']
+
+    def static(filename):
+        if not filename.startswith(f"{DIST_DIR}/"):
+            return send_static_file(filename=filename)
+
+        dist = os.path.join(app.static_folder, DIST_DIR)
+        name = filename[len(DIST_DIR) + 1:]
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        accepted = request.accept_encodings
+        encoding, served = None, name
+        for candidate, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if accepted[candidate] and os.path.isfile(os.path.join(dist, name + suffix)):
+                encoding, served = candidate, name + suffix
+                break
+
+        response = send_from_directory(dist, served, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE)
+        response.cache_control.immutable = True
+        response.cache_control.public = True
+        if os.path.splitext(name)[1].lower() in COMPRESSIBLE:
+            response.vary.add('Accept-Encoding')
+        if encoding:
+            response.content_encoding = encoding
+        return response
+
+    app.view_functions['static'] = static
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    folder = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    built = build_assets(folder)
+    for source, hashed in sorted(built.items()):
+        print(f"{source} -> {hashed}")
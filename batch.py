@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Command-line batch runner for the MIPS Measure Filter.
+Processes a directory or glob of Excel exports in parallel worker processes
+without starting the web application or touching the job database.
+
+Usage:
+    python batch.py exports/ --measures 47,317 --output results/
+    python batch.py "exports/2025_*.xlsx" --measures 226 --workers 8
+    python batch.py exports/practice_a/ --measures 47 --combine --sheets Jan,Feb,Mar
+"""
+
+import os
+import sys
+import csv
+import json
+import glob
+import time
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from utils import process_excel_file, allowed_file
+from dates import parse_reporting_date
+from measures import AVAILABLE_MEASURES
+
+def find_workbooks(sources):
+    """Expand directories and glob patterns into a sorted list of Excel files"""
+    paths = set()
+    for source in sources:
+        if os.path.isdir(source):
+            candidates = [os.path.join(source, name) for name in os.listdir(source)]
+        else:
+            candidates = glob.glob(source)
+        for path in candidates:
+            # Skip Excel lock files such as '~$report.xlsx'
+            if os.path.isfile(path) and allowed_file(path) and not os.path.basename(path).startswith('~$'):
+                paths.add(os.path.abspath(path))
+    return sorted(paths)
+
+def output_names(files):
+    """Map each input file to a unique report name, numbering repeated basenames"""
+    names, seen = {}, {}
+    for path in files:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        seen[stem] = seen.get(stem, 0) + 1
+        suffix = f"_{seen[stem]}" if seen[stem] > 1 else ''
+        names[path] = f"processed_{stem}{suffix}.xlsx"
+    return names
+
+def limit_nested_workers(cpus_per_worker):
+    """
+    Worker initializer: parse sheets and evaluate measures with no more
+    processes than this worker's share of the CPUs, so files processed in
+    parallel do not each start a process per CPU
+    """
+    import reader
+    import utils
+    reader.PARSE_WORKERS = max(1, min(reader.PARSE_WORKERS, cpus_per_worker))
+    utils.MEASURE_WORKERS = max(1, min(utils.MEASURE_WORKERS, cpus_per_worker))
+
+def process_one(filepath, measures, output_folder, output_name, state_folder=None, reporting_date=None,
+                sheets=None, patient_file=None, join_key=None):
+    """Worker entry point: process one workbook (or a list combined into one report) and return a result record"""
+    start = time.perf_counter()
+    incremental_state = None
+    if state_folder:
+        # One state file per input name, so next run's export of the same practice reuses it
+        incremental_state = os.path.join(state_folder, f"{os.path.splitext(output_name)[0]}.pkl")
+    result = process_excel_file(filepath, measures, output_folder, output_name=output_name,
+                                incremental_state=incremental_state, reporting_date=reporting_date,
+                                sheets=sheets, patient_file=patient_file, join_key=join_key)
+    result['file'] = filepath if isinstance(filepath, str) else ', '.join(filepath)
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return result
+
+def write_summary(results, output_folder):
+    """Write a combined CSV and JSON summary of all processed files"""
+    rows = []
+    for result in results:
+        if result['success']:
+            for entry in result['summary']:
+                rows.append({'File': os.path.basename(result['file']), **entry, 'Error': ''})
+        else:
+            rows.append({'File': os.path.basename(result['file']), 'Measure': '', 'Eligible Patients': '',
+                         'Total Patients': '', 'Error': result['error']})
+    
+    fieldnames = ['File']
+    for row in rows:
+        fieldnames.extend(key for key in row if key not in fieldnames)
+    
+    csv_path = os.path.join(output_folder, 'batch_summary.csv')
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    
+    json_path = os.path.join(output_folder, 'batch_summary.json')
+    with open(json_path, 'w') as f:
+        # Packed bitsets are binary and only meaningful to the web app's database
+        json.dump([{k: v for k, v in r.items() if k != 'bitsets'} for r in results], f, indent=2, default=str)
+    
+    return csv_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Apply MIPS measures to a batch of Excel exports.')
+    parser.add_argument('sources', nargs='+', help='Directories, files or glob patterns of .xlsx/.xls exports')
+    parser.add_argument('-m', '--measures', required=True, help='Comma-separated measure numbers, e.g. 47,317')
+    parser.add_argument('-o', '--output', default='batch_output', help='Output folder (default: batch_output)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1,
+                        help='Number of worker processes (default: CPU count)')
+    parser.add_argument('--state-dir', help='Enable incremental processing, keeping per-file results in this folder')
+    parser.add_argument('--sheets', help='Comma-separated sheet names to read (default: every sheet)')
+    parser.add_argument('--combine', action='store_true',
+                        help='Combine all files into one data set and one report (processed_combined.xlsx)')
+    parser.add_argument('--patients', help='Workbook of patient demographics joined onto every export, '
+                        'whose rows are then encounters')
+    parser.add_argument('--join-key', help='Column identifying the patient in both files (default: patient_id)')
+    parser.add_argument('--reporting-date', help='Compute ages as of this date (YYYY-MM-DD; default: REPORTING_DATE or today)')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show per-measure log output')
+    args = parser.parse_args(argv)
+    
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format='%(asctime)s - %(processName)s - %(levelname)s - %(message)s'
+    )
+    
+    measures = [m.strip() for m in args.measures.split(',') if m.strip()]
+    unknown = [m for m in measures if m not in AVAILABLE_MEASURES]
+    if unknown or not measures:
+        parser.error(f"Unknown measures: {', '.join(unknown)}" if unknown else 'No measures given')
+    
+    if args.reporting_date:
+        try:
+            parse_reporting_date(args.reporting_date)
+        except ValueError as e:
+            parser.error(str(e))
+    
+    files = find_workbooks(args.sources)
+    if args.patients:
+        if not os.path.isfile(args.patients):
+            parser.error(f"Patient file not found: {args.patients}")
+        # The patient file may sit in a source directory
+        files = [path for path in files if os.path.abspath(path) != os.path.abspath(args.patients)]
+    if not files:
+        print('No Excel files found.', file=sys.stderr)
+        return 1
+    
+    sheets = [s.strip() for s in args.sheets.split(',') if s.strip()] if args.sheets else None
+    
+    # Each job is (input, report name); a combined job reads every file as one data set
+    if args.combine:
+        jobs = [(files, 'processed_combined.xlsx')]
+    else:
+        names = output_names(files)
+        jobs = [(path, names[path]) for path in files]
+    
+    os.makedirs(args.output, exist_ok=True)
+    workers = max(1, min(args.workers, len(jobs)))
+    print(f"Processing {len(files)} file(s) with measures {', '.join(measures)} on {workers} worker(s)")
+    
+    start = time.perf_counter()
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=limit_nested_workers,
+                             initargs=((os.cpu_count() or 1) // workers,)) as executor:
+        futures = {executor.submit(process_one, source, measures, args.output, name, args.state_dir,
+                                   args.reporting_date, sheets, args.patients, args.join_key): source
+                   for source, name in jobs}
+        for future in as_completed(futures):
+            source = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'success': False, 'file': source if isinstance(source, str) else ', '.join(source),
+                          'error': str(e)}
+            results.append(result)
+            status = f"ok ({result['seconds']}s)" if result['success'] else f"FAILED: {result['error']}"
+            label = 'combined' if args.combine else os.path.basename(result['file'])
+            print(f"[{len(results)}/{len(jobs)}] {label}: {status}")
+    
+    results.sort(key=lambda r: r['file'])
+    summary_path = write_summary(results, args.output)
+    failed = sum(1 for r in results if not r['success'])
+    print(f"Done in {time.perf_counter() - start:.1f}s: {len(results) - failed} succeeded, {failed} failed")
+    print(f"Summary written to {summary_path}")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
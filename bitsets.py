@@ -0,0 +1,70 @@
+"""
+Packed eligibility bitsets for cross-measure analytics.
+
+Each measure's result is stored with its job as one bit per input row
+(numpy.packbits), so overlap questions such as "rows eligible for both 226 and
+317" are answered with vectorized bitwise operations instead of re-filtering.
+Bitsets from different jobs combine only when they cover the same rows, e.g.
+repeated runs over the same upload.
+"""
+
+import numpy as np
+
+OPERATIONS = ('and', 'or', 'difference')
+
+# Bits set in each byte value, for numpy builds without bitwise_count
+_POPCOUNT_TABLE = np.array([bin(value).count('1') for value in range(256)], dtype=np.uint8)
+
+def pack_mask(mask):
+    """Pack a boolean row mask into bytes"""
+    return np.packbits(np.asarray(mask, dtype=bool), bitorder='little').tobytes()
+
+def unpack_mask(bits, row_count):
+    """Unpack bytes from pack_mask into a boolean array of row_count rows"""
+    return np.unpackbits(np.frombuffer(bits, dtype=np.uint8), count=row_count, bitorder='little').astype(bool)
+
+def count_bits(packed):
+    """Number of set bits in a packed uint8 array or pack_mask bytes"""
+    if isinstance(packed, bytes):
+        packed = np.frombuffer(packed, dtype=np.uint8)
+    if hasattr(np, 'bitwise_count'):
+        return int(np.bitwise_count(packed).sum(dtype=np.int64))
+    return int(_POPCOUNT_TABLE[packed].sum(dtype=np.int64))
+
+def combine(bitsets, operation):
+    """
+    Combine packed bitsets with 'and' (intersection), 'or' (union) or
+    'difference' (rows in the first bitset but in none of the others).
+
+    Args:
+        bitsets (list): (row_count, bytes) tuples
+        operation (str): one of OPERATIONS
+
+    Returns:
+        numpy.ndarray: packed uint8 result
+    """
+    if operation not in OPERATIONS:
+        raise ValueError(f"Unknown operation '{operation}'; use one of {', '.join(OPERATIONS)}")
+    if not bitsets:
+        raise ValueError('At least one bitset is required')
+    row_counts = {row_count for row_count, _ in bitsets}
+    if len(row_counts) > 1:
+        raise ValueError('Bitsets cover different rows and cannot be combined')
+
+    arrays = [np.frombuffer(bits, dtype=np.uint8) for _, bits in bitsets]
+    if operation == 'and':
+        return np.bitwise_and.reduce(arrays)
+    if operation == 'or':
+        return np.bitwise_or.reduce(arrays)
+    if len(arrays) == 1:
+        return arrays[0].copy()
+    return arrays[0] & ~np.bitwise_or.reduce(arrays[1:])
+
+def overlap_matrix(bitsets):
+    """Pairwise intersection counts for a dict of measure -> (row_count, bytes)"""
+    measures = list(bitsets)
+    arrays = {m: np.frombuffer(bitsets[m][1], dtype=np.uint8) for m in measures}
+    return {
+        a: {b: count_bits(arrays[a] & arrays[b]) for b in measures}
+        for a in measures
+    }
@@ -0,0 +1,141 @@
+"""
+Numerator and exclusion criteria for performance rates.
+
+Each measure script computes its denominator with filter_patients() and may
+name the value sets (see valuesets.py) of the quality-data codes (CPT II /
+HCPCS G-codes) that put a denominator row into its numerator or exclude it:
+
+    NUMERATOR_VALUE_SET = 'measure47_numerator_qdc'
+    EXCLUSION_VALUE_SET = 'measure130_exclusion_qdc'
+
+so the codes follow the performance year of the reporting date. Scripts may
+also list codes directly as NUMERATOR_CODES / EXCLUSION_CODES.
+
+Codes are looked up in the 'quality_code' and 'cpt' columns; a cell may hold
+several codes ('99213, G8427'), and a code reported with the 8P modifier
+(performance not met, e.g. '1123F-8P') does not count. When the export has
+encounter ids, a code reported on any row of an encounter applies to every row
+of it, since quality codes are usually exported as rows of their own.
+
+The criteria of all selected measures are evaluated together in one pass:
+each code column is factorized once, every distinct cell value is matched
+against all measures' codes, and the matches are broadcast back to rows by
+code. Performance rate = 100 * numerator / (denominator - exclusions), in
+percent; it is not reported when the export has no codes to look up.
+"""
+
+import re
+
+import numpy as np
+import pandas as pd
+
+from rollup import group_codes
+from valuesets import value_set
+
+CODE_FIELDS = ['quality_code', 'cpt']
+NOT_MET_MODIFIER = '8P'
+KINDS = ('numerator', 'exclusions')
+
+_SEPARATORS = re.compile(r'[\s,;|/]+')
+
+def _declared_codes(module, kind):
+    """Codes of a module's <kind>_VALUE_SET for the reporting year plus any listed in <kind>_CODES"""
+    codes = list(getattr(module, f'{kind}_CODES', []))
+    name = getattr(module, f'{kind}_VALUE_SET', None)
+    if name:
+        codes += value_set(name)
+    return {str(code).strip().upper() for code in codes}
+
+def measure_criteria(module):
+    """{'numerator': set, 'exclusions': set} declared by a measure module, or None when it declares none"""
+    numerator = _declared_codes(module, 'NUMERATOR')
+    exclusions = _declared_codes(module, 'EXCLUSION')
+    if not numerator and not exclusions:
+        return None
+    return {'numerator': numerator, 'exclusions': exclusions}
+
+def cell_codes(value):
+    """Codes reported in one cell, without those carrying the 'performance not met' modifier"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return set()
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    codes = []
+    for token in _SEPARATORS.split(str(value).strip().upper()):
+        code, _, modifier = token.partition('-')
+        if code == NOT_MET_MODIFIER and codes:
+            # '1123F 8P': the modifier written as its own token
+            codes.pop()
+        elif code and modifier != NOT_MET_MODIFIER:
+            codes.append(code)
+    return set(codes)
+
+def reports_codes(df):
+    """Whether df has a code column holding any code; without one no measure's rate can be computed"""
+    for field in CODE_FIELDS:
+        if field not in df.columns:
+            continue
+        column = df[field]
+        values = column.cat.categories if isinstance(column.dtype, pd.CategoricalDtype) else column.dropna().unique()
+        if any(cell_codes(value) for value in values):
+            return True
+    return False
+
+def evaluate_criteria(df, criteria):
+    """
+    Row masks of every measure's criteria in one pass.
+
+    Args:
+        df (pandas.DataFrame): input rows
+        criteria (dict): measure -> measure_criteria() result
+
+    Returns:
+        dict: measure -> {'numerator': mask, 'exclusions': mask} (boolean arrays aligned with df)
+    """
+    masks = {measure: {kind: np.zeros(len(df), dtype=bool) for kind in KINDS} for measure in criteria}
+    # code -> [(measure, kind)] across all measures
+    lookup = {}
+    for measure, declared in criteria.items():
+        for kind in KINDS:
+            for code in declared[kind]:
+                lookup.setdefault(code, []).append((measure, kind))
+    if not lookup:
+        return masks
+
+    for field in CODE_FIELDS:
+        if field not in df.columns:
+            continue
+        column = df[field]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            codes, uniques = column.cat.codes.to_numpy(), column.cat.categories
+        else:
+            codes, uniques = pd.factorize(column)
+        if len(uniques) == 0:
+            continue
+        present = codes >= 0
+        # Match each distinct cell value once, then broadcast to its rows
+        hits = {}
+        for position, value in enumerate(uniques):
+            for code in cell_codes(value):
+                for target in lookup.get(code, ()):
+                    hits.setdefault(target, np.zeros(len(uniques), dtype=bool))[position] = True
+        for (measure, kind), matched in hits.items():
+            masks[measure][kind] |= present & matched[np.where(present, codes, 0)]
+
+    if 'encounter_id' in df.columns:
+        encounters = group_codes(df['encounter_id'].to_numpy())
+        for measure_masks in masks.values():
+            for kind, mask in measure_masks.items():
+                if mask.any():
+                    flagged = np.zeros(encounters.max() + 1, dtype=bool)
+                    flagged[encounters[mask]] = True
+                    measure_masks[kind] = flagged[encounters]
+    return masks
+
+def performance_counts(denominator, masks):
+    """(exclusions, numerator, performance rate %) for a denominator mask; rate is None without eligible rows"""
+    excluded = denominator & masks['exclusions']
+    met = denominator & ~excluded & masks['numerator']
+    eligible = int(denominator.sum()) - int(excluded.sum())
+    rate = round(100 * int(met.sum()) / eligible, 1) if eligible else None
+    return int(excluded.sum()), int(met.sum()), rate
@@ -0,0 +1,175 @@
+"""
+Date column parsing and the reporting-period anchor used for ages.
+
+pd.to_datetime without a format guesses per column or, for mixed data, per
+value, which is slow on large exports. parse_date_column samples the column,
+detects a single format (including Excel serial day numbers and YYYYMMDD
+integers) and parses the column's distinct values in one vectorized pass with
+it. Detected formats are cached by header fingerprint and column, so repeat
+uploads from the same EHR template skip sniffing.
+
+Ages are computed against the reporting anchor rather than the current time,
+so the same upload gives the same result whenever it is processed. The anchor
+is set per job with use_reporting_date() and defaults to REPORTING_DATE
+(YYYY-MM-DD) from the environment, else today's date.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+# Text formats tried in order; month-first wins over day-first when both fit
+CANDIDATE_FORMATS = [
+    '%Y-%m-%d',
+    '%m/%d/%Y',
+    '%m/%d/%y',
+    '%d/%m/%Y',
+    '%m-%d-%Y',
+    '%d-%m-%Y',
+    '%Y/%m/%d',
+    '%Y%m%d',
+    '%d-%b-%Y',
+    '%d %b %Y',
+    '%b %d, %Y',
+    '%B %d, %Y',
+    '%Y-%m-%d %H:%M:%S',
+    '%Y-%m-%dT%H:%M:%S',
+    '%m/%d/%Y %H:%M',
+    '%m/%d/%Y %H:%M:%S',
+    '%m/%d/%Y %I:%M %p',
+]
+EXCEL_SERIAL = 'excel_serial'
+DATETIME_OBJECTS = 'datetime_objects'
+
+# Excel serial days for 1900-01-01 .. 2099-12-31
+EXCEL_SERIAL_RANGE = (1, 73415)
+SAMPLE_SIZE = 200
+
+REPORTING_DATE = os.environ.get('REPORTING_DATE')
+
+_formats = {}
+_formats_lock = threading.Lock()
+_reporting_date = contextvars.ContextVar('reporting_date', default=None)
+
+def columns_fingerprint(columns):
+    """Stable hash of a header row, used as the format cache key"""
+    return hashlib.sha1(json.dumps([str(c) for c in columns]).encode()).hexdigest()
+
+def _sample(series):
+    values = series.dropna()
+    if len(values) <= SAMPLE_SIZE:
+        return values
+    # Spread the sample over the column rather than taking the head only
+    return values.iloc[::len(values) // SAMPLE_SIZE][:SAMPLE_SIZE]
+
+def sniff_format(series):
+    """Detect the format of a date column from a sample; None when no single format fits"""
+    sample = _sample(series)
+    if sample.empty:
+        return None
+
+    if pd.api.types.is_numeric_dtype(sample):
+        low, high = sample.min(), sample.max()
+        if EXCEL_SERIAL_RANGE[0] <= low and high <= EXCEL_SERIAL_RANGE[1]:
+            return EXCEL_SERIAL
+        if 19000101 <= low and high <= 21001231 and (sample % 1 == 0).all():
+            return '%Y%m%d'
+        return None
+
+    kind = pd.api.types.infer_dtype(sample, skipna=True)
+    if kind in ('datetime', 'datetime64', 'date'):
+        return DATETIME_OBJECTS
+    if kind != 'string':
+        return None
+
+    for fmt in CANDIDATE_FORMATS:
+        if pd.to_datetime(sample.astype(str), format=fmt, errors='coerce').notna().all():
+            return fmt
+    return None
+
+def parse_with_format(series, fmt):
+    """Parse a whole column with a detected format; unparseable values become NaT"""
+    if fmt == EXCEL_SERIAL:
+        numeric = pd.to_numeric(series, errors='coerce')
+        return pd.to_datetime(numeric, unit='D', origin='1899-12-30')
+    if fmt == DATETIME_OBJECTS:
+        return pd.to_datetime(series, errors='coerce')
+
+    # Exports repeat dates heavily (one row per visit, a bounded range of
+    # birth dates), so each distinct value is parsed once
+    codes, uniques = pd.factorize(series)
+    if len(uniques) == 0:
+        return pd.Series(pd.NaT, index=series.index, name=series.name, dtype='datetime64[ns]')
+    uniques = pd.Series(uniques)
+    uniques = uniques.astype('int64').astype(str) if pd.api.types.is_numeric_dtype(uniques) else uniques.astype(str)
+    parsed = pd.to_datetime(uniques, format=fmt, errors='coerce', cache=False).to_numpy()
+    return pd.Series(np.where(codes >= 0, parsed[codes], np.datetime64('NaT')), index=series.index, name=series.name)
+
+def parse_date_column(series, cache_key=None):
+    """
+    Parse a date column in one vectorized pass. Values that do not match the
+    detected format become NaT. cache_key (e.g. (columns_fingerprint(...),
+    column)) reuses the format detected for an earlier upload.
+    """
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+
+    fmt = None
+    if cache_key is not None:
+        with _formats_lock:
+            fmt = _formats.get(cache_key)
+    if fmt is not None:
+        parsed = parse_with_format(series, fmt)
+        if parsed.notna().sum() == series.notna().sum():
+            return parsed
+        # The template's format changed; detect it again
+
+    fmt = sniff_format(series)
+    if fmt is None:
+        logging.info("No single date format fits this column; parsing values individually")
+        return pd.to_datetime(series, errors='coerce', format='mixed')
+
+    parsed = parse_with_format(series, fmt)
+    if cache_key is not None:
+        with _formats_lock:
+            _formats[cache_key] = fmt
+    return parsed
+
+def parse_reporting_date(value):
+    """Parse a YYYY-MM-DD string into a date, raising ValueError when malformed"""
+    try:
+        return date.fromisoformat(str(value).strip())
+    except ValueError:
+        raise ValueError(f"Invalid reporting date '{value}'; use YYYY-MM-DD")
+
+def reporting_date():
+    """The date ages are computed against for the current job"""
+    anchor = _reporting_date.get()
+    if anchor is not None:
+        return anchor
+    if REPORTING_DATE:
+        return parse_reporting_date(REPORTING_DATE)
+    return date.today()
+
+@contextmanager
+def use_reporting_date(anchor):
+    """Compute ages against anchor (a date or YYYY-MM-DD string) inside the block"""
+    if anchor is not None and not isinstance(anchor, date):
+        anchor = parse_reporting_date(anchor)
+    token = _reporting_date.set(anchor)
+    try:
+        yield reporting_date()
+    finally:
+        _reporting_date.reset(token)
+
+def age_in_years(dob):
+    """Age in years at the reporting date for a parsed date-of-birth column"""
+    return (pd.Timestamp(reporting_date()) - dob).dt.days / 365.25
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+"""
+Differential check of a candidate measure engine against the legacy measures.
+
+Runs the filter_patients function of each legacy measure (measures/<n>.py)
+and of its candidate rewrite side by side over a corpus of inputs: built-in
+tricky cases, seeded generated exports and, optionally, stored workbooks.
+Every input goes through the same schema mapping and dtype compaction as an
+uploaded file. Selected row sets are compared row for row, and each engine is
+timed over --repeat runs, alternating which engine goes first so neither
+always runs on a warmer cache, after one untimed run of each. The medians are
+compared, and a candidate is only flagged as slower when the difference also
+exceeds the run-to-run noise, and stays slower when timed again. Exits
+non-zero on any mismatch or slowdown.
+
+A candidate engine is a directory of <measure>.py files with the legacy
+contract: filter_patients(df) returns the eligible rows as a DataFrame (keeping
+df's columns) or a boolean mask aligned with df's rows. Measures without a
+candidate file are skipped.
+
+Usage:
+    python differential.py --engine engines/vectorized
+    python differential.py --engine engines/vectorized --measures 331 --rows 50000 --seeds 3
+    python differential.py --engine engines/vectorized --corpus corpus/ --max-slowdown 0.05 --json report.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import statistics
+import logging
+import argparse
+import importlib.util
+
+import numpy as np
+import pandas as pd
+
+from utils import load_measure_script, evaluate_measure, ROW_ID_COLUMN, allowed_file
+from schema import apply_schema
+from ingest import compact_dtypes
+from dates import use_reporting_date
+from measures import AVAILABLE_MEASURES
+
+# Fixed so DOB-derived ages, and therefore results, do not change from day to day
+DEFAULT_REPORTING_DATE = '2025-12-31'
+# Runs faster than this are too noisy to call a slowdown
+MIN_TIMED_MS = 5.0
+# A slowdown must exceed this many median absolute deviations of either engine's runs
+NOISE_DEVIATIONS = 3
+# Row numbers listed per side of a mismatch
+MISMATCH_EXAMPLES = 10
+
+def tricky_cases():
+    """Small hand-built exports covering edge cases the measures must agree on"""
+    return {
+        'age_boundaries': pd.DataFrame({
+            'Patient_ID': [f'P{i}' for i in range(10)],
+            'Age': [17, 17.99, 18, 18.0, 64, 65, 66, 'unknown', None, -1],
+            'Visit_Type': ['Office Visit'] * 10,
+            'CPT': ['99213', '99214', '99396', 'G0439', '99203', '99213', '99214', '99396', 'G0439', '99203'],
+            'Diagnosis': ['J01.9', 'I10', 'acute sinusitis', 'F03', 'E11.9', 'J01.9', 'I10', 'J01.9', 'I10', 'J01.9'],
+        }),
+        'dob_only': pd.DataFrame({
+            'Patient_ID': ['P1', 'P2', 'P3', 'P4', 'P5', 'P6'],
+            'Date of Birth': ['1950-02-28', '2008-01-01', '2007-12-31', None, 'not a date', '1990-06-15'],
+            'Visit_Type': ['Office Visit', 'Preventive', 'Annual Wellness', 'Office Visit', 'Urgent Care', 'Telehealth'],
+            'CPT': ['99213', '99396', 'G0439', '99213', '99214', '99203'],
+            'Diagnosis': ['J01.90', 'Z00.00', 'I10', 'J01.9', 'sinusitis', 'F32.9'],
+        }),
+        'dob_mixed_formats': pd.DataFrame({
+            'DOB': ['03/14/1950', '14/03/1950', '1950-03-14', '19500314', 'March 14, 1950', ''],
+            'Age': [None] * 6,
+            'Diagnosis': ['J01.9'] * 6,
+            'Visit_Type': ['Office Visit'] * 6,
+        }),
+        'blank_and_missing_values': pd.DataFrame({
+            'Age': [30, 45, 70, None, 50, 80],
+            'Visit_Type': ['', None, 'office visit', 'OFFICE VISIT', '  Office Visit  ', 'nan'],
+            'CPT': [None, '', '99213', 'nan', '99214', None],
+            'Diagnosis': [None, '', 'J01.9', 'nan', 'I10', 'Acute Sinusitis'],
+        }),
+        'code_variants': pd.DataFrame({
+            'Age': [40] * 8,
+            'Visit_Type': ['Office Visit'] * 8,
+            'CPT': [99213, '99213', '99213.0', ' 99213', 'G0439', 'g0439', '99213,99396', 99396.0],
+            'Diagnosis': ['J01.90', 'j01.9', 'J011', 'J01', 'Z00.00', 'z00.01', 'F03.90; I10', 'N18.6'],
+        }),
+        'header_aliases': pd.DataFrame({
+            'MRN': ['A1', 'A2', 'A3', 'A4'],
+            'Patient Age (Years)': [19, 70, 12, 66],
+            'Encounter Type': ['Office Visit', 'Annual Wellness', 'Preventive', 'Consultation'],
+            'Procedure Code': ['99213', 'G0439', '99396', '99214'],
+            'DX': ['J01.9', 'I10', 'Z00.129', 'acute rhinosinusitis'],
+        }),
+        'missing_columns': pd.DataFrame({
+            'Patient_ID': ['P1', 'P2', 'P3'],
+            'Age': [20, 70, 10],
+        }),
+        'no_eligible_rows': pd.DataFrame({
+            'Age': [1, 2, 3],
+            'Visit_Type': ['Lab Only', 'Lab Only', 'Lab Only'],
+            'CPT': ['80053', '80053', '85025'],
+            'Diagnosis': ['Z01.89', 'Z01.89', 'Z01.89'],
+        }),
+        'single_row': pd.DataFrame({
+            'Age': [72],
+            'Visit_Type': ['Annual Wellness'],
+            'CPT': ['G0439'],
+            'Diagnosis': ['F03.90'],
+        }),
+    }
+
+def generated_export(rows, seed):
+    """A seeded synthetic export drawing from realistic and awkward values"""
+    rng = random.Random(seed)
+    visits = ['Office Visit', 'Preventive', 'Annual Wellness', 'Urgent Care', 'Consultation', 'Follow-up',
+              'Telehealth', 'office visit', 'Outpatient', '', None]
+    diagnoses = ['J01.9 Acute sinusitis', 'J01.01', 'I10', 'N18.6', 'F03.90', 'E11.9', 'Z00.00', 'F32.9',
+                 'acute sinusitis', 'Z71.6', 'Z72.0', '', None]
+    cpts = ['99213', '99214', '99396', 'G0439', 'G0438', '99203', '90837', '99497', '96127', '', None]
+    patients = max(1, rows // 3)
+    return pd.DataFrame({
+        'Patient_ID': [f'P{rng.randint(1, patients):06d}' for _ in range(rows)],
+        'Encounter_ID': [f'E{i:07d}' for i in range(rows)],
+        'Age': [rng.choice([rng.randint(0, 100), 17, 18, 64, 65, None]) for _ in range(rows)],
+        'Visit_Type': [rng.choice(visits) for _ in range(rows)],
+        'CPT': [rng.choice(cpts) for _ in range(rows)],
+        'Diagnosis': [rng.choice(diagnoses) for _ in range(rows)],
+        'Visit_Date': [f'2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}' for _ in range(rows)],
+        'Provider': [rng.choice(['Dr A', 'Dr B', 'Dr C']) for _ in range(rows)],
+    })
+
+def stored_corpus(folder):
+    """Workbooks (every sheet combined, as for a job) and CSV files in folder"""
+    from reader import read_inputs
+
+    cases = {}
+    for name in sorted(os.listdir(folder)):
+        path = os.path.join(folder, name)
+        if not os.path.isfile(path) or name.startswith('~$'):
+            continue
+        if allowed_file(name):
+            cases[name] = read_inputs(path)[0]
+        elif name.lower().endswith('.csv'):
+            cases[name] = pd.read_csv(path)
+    return cases
+
+def prepare(df):
+    """Map headers and compact dtypes exactly as process_excel_file does"""
+    df = df.copy()
+    apply_schema(df)
+    compact_dtypes(df)
+    return df
+
+def load_candidate(engine_dir, measure):
+    """The candidate's filter function for a measure, or None when it has no rewrite"""
+    script_path = os.path.join(engine_dir, f'{measure}.py')
+    if not os.path.exists(script_path):
+        return None
+    spec = importlib.util.spec_from_file_location(f"candidate_{measure}", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.filter_patients
+
+def candidate_mask(filter_function, df):
+    """Rows a candidate selects, as a boolean array; accepts a mask or a DataFrame result"""
+    tagged = df.copy(deep=False)
+    tagged[ROW_ID_COLUMN] = np.arange(len(df))
+    result = filter_function(tagged)
+    if isinstance(result, pd.DataFrame):
+        if ROW_ID_COLUMN not in result.columns:
+            raise ValueError("Candidate dropped the input columns; rows cannot be matched")
+        mask = np.zeros(len(df), dtype=bool)
+        mask[result[ROW_ID_COLUMN].dropna().astype(np.int64).to_numpy()] = True
+        return mask
+    mask = np.asarray(result, dtype=bool)
+    if mask.shape != (len(df),):
+        raise ValueError(f"Candidate mask has shape {mask.shape}, expected ({len(df)},)")
+    return mask
+
+def run_once(run, df):
+    """(mask, milliseconds) of one run on its own copy of the input"""
+    frame = df.copy()
+    start = time.perf_counter()
+    mask = run(frame)
+    return mask, (time.perf_counter() - start) * 1000
+
+def timed_pair(runs, df, repeat):
+    """
+    Masks and run times of two engines: one untimed warm-up run each, then
+    repeat timed runs each, alternating which engine runs first
+    """
+    masks = [run_once(run, df)[0] for run in runs]
+    times = ([], [])
+    for iteration in range(repeat):
+        order = (0, 1) if iteration % 2 == 0 else (1, 0)
+        for engine in order:
+            times[engine].append(run_once(runs[engine], df)[1])
+    return masks, times
+
+def noise_ms(times):
+    """Run-to-run spread of one engine: NOISE_DEVIATIONS median absolute deviations"""
+    median = statistics.median(times)
+    return NOISE_DEVIATIONS * statistics.median(abs(t - median) for t in times)
+
+def is_slower(legacy_times, candidate_times, max_slowdown):
+    """(slower, noise ms) from the medians of two engines' run times"""
+    legacy_ms, candidate_ms = statistics.median(legacy_times), statistics.median(candidate_times)
+    noise = max(noise_ms(legacy_times), noise_ms(candidate_times))
+    slowdown = candidate_ms - legacy_ms
+    slower = (max(legacy_ms, candidate_ms) >= MIN_TIMED_MS and
+              slowdown > legacy_ms * max_slowdown and slowdown > noise)
+    return slower, noise
+
+def compare(case, measure, df, legacy, candidate, repeat, max_slowdown):
+    """Run both engines on one input and return a result record"""
+    record = {'case': case, 'measure': measure, 'rows': len(df)}
+    runs = (lambda frame: evaluate_measure(legacy, frame)[1], lambda frame: candidate_mask(candidate, frame))
+    try:
+        (legacy_mask, new_mask), (legacy_times, candidate_times) = timed_pair(runs, df, repeat)
+    except Exception as e:
+        legacy_mask, record['legacy_ms'] = run_once(runs[0], df)
+        record.update({'status': 'error', 'error': str(e), 'legacy_selected': int(legacy_mask.sum())})
+        return record
+
+    slower, noise = is_slower(legacy_times, candidate_times, max_slowdown)
+    if slower:
+        # Confirm with as many runs again before flagging: one slow stretch of the machine is not a slowdown
+        _, (more_legacy, more_candidate) = timed_pair(runs, df, repeat)
+        legacy_times += more_legacy
+        candidate_times += more_candidate
+        slower, noise = is_slower(legacy_times, candidate_times, max_slowdown)
+
+    record['legacy_ms'] = statistics.median(legacy_times)
+    record['candidate_ms'] = statistics.median(candidate_times)
+    record['noise_ms'] = round(noise, 2)
+    record['legacy_selected'] = int(legacy_mask.sum())
+    record['candidate_selected'] = int(new_mask.sum())
+    # Row numbers as they appear in the report's "Original Data" sheet
+    record['only_legacy'] = (np.flatnonzero(legacy_mask & ~new_mask)[:MISMATCH_EXAMPLES] + 2).tolist()
+    record['only_candidate'] = (np.flatnonzero(new_mask & ~legacy_mask)[:MISMATCH_EXAMPLES] + 2).tolist()
+    record['speedup'] = round(record['legacy_ms'] / record['candidate_ms'], 2) if record['candidate_ms'] else None
+
+    if not np.array_equal(legacy_mask, new_mask):
+        record['status'] = 'mismatch'
+    elif slower:
+        record['status'] = 'slower'
+    else:
+        record['status'] = 'ok'
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare a candidate measure engine with the legacy measures.')
+    parser.add_argument('--engine', required=True, help='Directory of candidate <measure>.py files')
+    parser.add_argument('--measures', help='Comma-separated measure numbers (default: all with a candidate)')
+    parser.add_argument('--corpus', help='Directory of stored workbooks or CSV files to include')
+    parser.add_argument('--rows', type=int, default=20000, help='Rows per generated export (0 to skip)')
+    parser.add_argument('--seeds', type=int, default=2, help='Number of generated exports')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per engine; the medians are compared')
+    parser.add_argument('--max-slowdown', type=float, default=0.10,
+                        help='Flag candidates more than this fraction slower than legacy')
+    parser.add_argument('--reporting-date', default=DEFAULT_REPORTING_DATE, help='Anchor for ages (YYYY-MM-DD)')
+    parser.add_argument('--json', help='Also write the result records to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    # The measures log every run at INFO; keep the report readable
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if not os.path.isdir(args.engine):
+        print(f"Engine directory not found: {args.engine}", file=sys.stderr)
+        return 2
+    measures = [m.strip() for m in args.measures.split(',')] if args.measures else list(AVAILABLE_MEASURES)
+    unknown = [m for m in measures if m not in AVAILABLE_MEASURES]
+    if unknown:
+        print(f"Unknown measures: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    engines = {}
+    for measure in measures:
+        candidate = load_candidate(args.engine, measure)
+        if candidate is None:
+            print(f"Measure {measure}: no candidate in {args.engine}, skipped")
+            continue
+        engines[measure] = (load_measure_script(measure), candidate)
+    if not engines:
+        print("Nothing to compare", file=sys.stderr)
+        return 2
+
+    corpus = tricky_cases()
+    for seed in range(args.seeds if args.rows > 0 else 0):
+        corpus[f'generated_{args.rows}_seed{seed}'] = generated_export(args.rows, seed)
+    if args.corpus:
+        corpus.update(stored_corpus(args.corpus))
+
+    print(f"{'case':<32} {'msr':>4} {'legacy':>7} {'new':>7} {'legacy ms':>9} {'new ms':>9} {'speedup':>7}")
+    records = []
+    with use_reporting_date(args.reporting_date):
+        for case, raw in corpus.items():
+            df = prepare(raw)
+            for measure, (legacy, candidate) in engines.items():
+                record = compare(case, measure, df, legacy, candidate, args.repeat, args.max_slowdown)
+                records.append(record)
+                timing = (f"{record['legacy_ms']:>9.1f} {record.get('candidate_ms', float('nan')):>9.1f} "
+                          f"{record.get('speedup') or '':>7}")
+                print(f"{case:<32} {measure:>4} {record['legacy_selected']:>7} "
+                      f"{record.get('candidate_selected', '-'):>7} {timing}  {record['status'].upper()}")
+                if record['status'] == 'mismatch':
+                    print(f"    only legacy: {record['only_legacy']}  only candidate: {record['only_candidate']}")
+                elif record['status'] == 'error':
+                    print(f"    {record['error']}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(records, f, indent=2)
+
+    failures = [r for r in records if r['status'] != 'ok']
+    print(f"\n{len(records)} comparisons, {len(failures)} flagged "
+          f"({sum(r['status'] == 'mismatch' for r in records)} mismatches, "
+          f"{sum(r['status'] == 'slower' for r in records)} slowdowns, "
+          f"{sum(r['status'] == 'error' for r in records)} errors)")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+"""
+Step-by-step trace of the measure filters.
+
+Measure scripts mark each filter step:
+
+    age = step('Age >= 18', filtered_df)
+    eligible_patients = filtered_df[filtered_df[age_column] >= 18]
+    age.done(eligible_patients)
+
+and call skip(reason) instead of done() when a step does not apply (its
+column is missing, or it would select no rows and is ignored). Inside
+trace_steps() every finished step is recorded with its rows in, rows out,
+elapsed time and whether it was skipped; outside it the calls cost only a
+timer read. Jobs keep the trace of every measure, so a surprising count can
+be followed to the step that produced it and slow steps stand out.
+"""
+
+import time
+import contextvars
+from contextlib import contextmanager
+
+_steps = contextvars.ContextVar('measure_steps', default=None)
+
+def _count(rows):
+    return rows if isinstance(rows, int) else len(rows)
+
+class Step:
+    """One filter step of a measure; finish it with done() or skip()"""
+
+    def __init__(self, name, rows_in):
+        self.name = name
+        self.rows_in = _count(rows_in)
+        self._started = time.perf_counter()
+
+    def _record(self, rows_out, skipped, reason):
+        steps = _steps.get()
+        if steps is not None:
+            steps.append({
+                'step': self.name,
+                'rows_in': self.rows_in,
+                'rows_out': rows_out,
+                'elapsed_ms': round((time.perf_counter() - self._started) * 1000, 3),
+                'skipped': skipped,
+                'reason': reason
+            })
+
+    def done(self, rows):
+        """The step ran and kept rows (a DataFrame, mask-filtered frame or count)"""
+        self._record(_count(rows), False, None)
+
+    def skip(self, reason):
+        """The step did not filter anything"""
+        self._record(self.rows_in, True, reason)
+
+def step(name, rows_in):
+    """Start timing a filter step applied to rows_in (a DataFrame or row count)"""
+    return Step(name, rows_in)
+
+@contextmanager
+def trace_steps():
+    """Record the steps run inside the block; yields the list they are appended to"""
+    steps = []
+    token = _steps.set(steps)
+    try:
+        yield steps
+    finally:
+        _steps.reset(token)
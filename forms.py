@@ -1,7 +1,7 @@
 from flask_wtf import FlaskForm
-from flask_wtf.file import FileField, FileRequired, FileAllowed
+from flask_wtf.file import FileField, MultipleFileField, FileRequired, FileAllowed
 from wtforms import StringField, PasswordField, SubmitField, SelectMultipleField, widgets
-from wtforms.validators import DataRequired, Email, Length, EqualTo
+from wtforms.validators import DataRequired, Email, Length, EqualTo, Optional, Regexp
 
 class LoginForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired()])
@@ -25,10 +25,13 @@ class RegisterForm(FlaskForm):
     submit = SubmitField('Register')
 
 class UploadForm(FlaskForm):
-    file = FileField('Excel File', validators=[
+    file = MultipleFileField('Excel Files', validators=[
         FileRequired(),
         FileAllowed(['xlsx', 'xls'], 'Only Excel files are allowed!')
     ])
+    patients = FileField('Patient File (optional)', validators=[
+        FileAllowed(['xlsx', 'xls'], 'Only Excel files are allowed!')
+    ])
     submit = SubmitField('Upload File')
 
 class MultiCheckboxField(SelectMultipleField):
@@ -44,4 +47,11 @@ class MeasureSelectionForm(FlaskForm):
         ('331', 'Measure 331 - Adult Sinusitis: Antibiotic Prescribed'),
         ('317', 'Measure 317 - Preventive Care and Screening: Screening for High Blood Pressure')
     ])
+    practice = StringField('Practice (for incremental processing)', validators=[
+        Optional(),
+        Length(max=100),
+        Regexp(r'^[\w .-]+$', message='Use letters, numbers, spaces, dots, dashes or underscores')
+    ])
+    sheets = StringField('Sheets', validators=[Optional(), Length(max=500)])
+    join_key = StringField('Patient Key', validators=[Optional(), Length(max=100)])
     submit = SubmitField('Process File')
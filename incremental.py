@@ -0,0 +1,192 @@
+"""
+Incremental re-evaluation for recurring uploads from the same practice.
+
+Each row is fingerprinted by its patient/encounter key and a hash of its
+content. The per-row results of every measure are stored after a run; on the
+next upload only new or changed rows are evaluated and merged with the stored
+results for unchanged rows.
+
+Measures decide some steps on the data set as a whole (a filter is skipped
+when no row matches it), so changed rows are evaluated together with a sample
+of unchanged, previously eligible "anchor" rows. If any anchor loses its
+eligibility the data set's behaviour has shifted and the measure is
+re-evaluated in full. Removed rows, changed headers, a different reporting
+date, changed value sets and measures without stored results also fall back
+to a full evaluation.
+
+The sheets must match a full run's, including columns a measure derives (such
+as calculated_age), which are not stored. The columns each measure derived are
+remembered, and when there are any the selected rows are run through the
+measure once more to compute them.
+"""
+
+import os
+import pickle
+import logging
+
+import numpy as np
+import pandas as pd
+
+import valuesets
+from utils import evaluate_measure, derived_columns
+from explain import trace_steps
+
+STATE_VERSION = 2
+
+# Unchanged eligible rows evaluated alongside the delta as a consistency check
+ANCHOR_ROWS = 64
+
+def detect_key_columns(columns):
+    """
+    Pick the canonical columns identifying a row (see schema.py): encounter id,
+    else patient id plus visit date when available
+    """
+    columns = list(columns)
+    if 'encounter_id' in columns:
+        return ['encounter_id']
+    if 'patient_id' not in columns:
+        return []
+    return ['patient_id', 'visit_date'] if 'visit_date' in columns else ['patient_id']
+
+def fingerprint_rows(df, key_columns):
+    """
+    Return (keys, hashes) as uint64 arrays. Keys are unique per row: repeated
+    key values are numbered in order of appearance.
+    """
+    hashes = pd.util.hash_pandas_object(df, index=False).to_numpy()
+    base = pd.util.hash_pandas_object(df[key_columns], index=False).to_numpy() if key_columns else hashes
+    occurrence = pd.Series(base).groupby(base).cumcount().to_numpy()
+    keys = pd.util.hash_pandas_object(pd.DataFrame({'key': base, 'occurrence': occurrence}), index=False).to_numpy()
+    return keys, hashes
+
+class IncrementalEvaluator:
+    """Evaluates measures on one upload, reusing results stored for its practice"""
+
+    def __init__(self, state_path, df, key_columns=None, reporting_date=None):
+        self.state_path = state_path
+        self.df = df
+        self.key_columns = key_columns if key_columns is not None else detect_key_columns(df.columns)
+        # Ages depend on the reporting date, so results stored for another date are stale
+        self.reporting_date = str(reporting_date) if reporting_date is not None else None
+        self.value_sets = valuesets.version(reporting_date.year if reporting_date is not None else None)
+        self.keys, self.hashes = fingerprint_rows(df, self.key_columns)
+        self.results = {}
+        # Columns each measure adds to (or converts in) its output rows
+        self.derived = {}
+        self.stats = {'rows': len(df), 'changed_rows': len(df), 'key_columns': self.key_columns, 'measures': {}}
+
+        self.previous = self._load()
+        self.full_reason = None
+        self.unchanged = np.zeros(len(df), dtype=bool)
+        self.previous_index = np.full(len(df), -1)
+
+        if self.previous is None:
+            self.full_reason = 'no previous run'
+        elif self.previous['columns'] != [str(c) for c in df.columns] or \
+                self.previous['key_columns'] != self.key_columns:
+            self.full_reason = 'headers changed'
+        elif self.previous['reporting_date'] != self.reporting_date:
+            self.full_reason = 'reporting date changed'
+        elif self.previous.get('value_sets') != self.value_sets:
+            self.full_reason = 'value sets changed'
+        else:
+            self.previous_index = pd.Index(self.previous['keys']).get_indexer(self.keys)
+            matched = self.previous_index >= 0
+            self.unchanged = matched & (self.previous['hashes'][np.maximum(self.previous_index, 0)] == self.hashes)
+            self.stats['changed_rows'] = int((~self.unchanged).sum())
+            if matched.sum() < len(self.previous['keys']):
+                self.full_reason = 'rows removed since previous run'
+
+        if self.full_reason:
+            logging.info(f"Incremental mode: full evaluation ({self.full_reason})")
+        else:
+            logging.info(f"Incremental mode: {self.stats['changed_rows']} of {len(df)} rows new or changed")
+
+    def evaluate(self, measure, filter_function):
+        """Return (filtered_df, mask) for one measure, evaluating as few rows as possible"""
+        mode, mask = self._evaluate_delta(measure, filter_function)
+        filtered_df = None if mask is None else self._selected_rows(measure, filter_function, mask)
+        if filtered_df is None:
+            if mask is not None:
+                logging.info(f"Incremental mode: measure {measure} selects differently on its eligible rows; "
+                             f"re-evaluating all rows")
+                mode = 'full'
+            filtered_df, mask = evaluate_measure(filter_function, self.df)
+            self.derived[measure] = derived_columns(filtered_df, self.df)
+
+        self.results[measure] = mask
+        self.stats['measures'][measure] = mode
+        return filtered_df, mask
+
+    def _selected_rows(self, measure, filter_function, mask):
+        """
+        The sheet rows for a mask: the selected rows as they are when the measure
+        derived no columns last time, else run through the measure again to add
+        them (outside the job's filter trace). None if that run drops a row.
+        """
+        selected = self.df[mask].reset_index(drop=True)
+        derived = self.previous.get('derived', {}).get(measure)
+        if derived == []:
+            self.derived[measure] = derived
+            return selected
+        with trace_steps():
+            filtered_df, selected_mask = evaluate_measure(filter_function, selected)
+        if not selected_mask.all():
+            return None
+        self.derived[measure] = derived_columns(filtered_df, selected)
+        return filtered_df.reset_index(drop=True)
+
+    def _evaluate_delta(self, measure, filter_function):
+        """Return (mode, mask), with mask None when a full evaluation is needed"""
+        if self.full_reason or measure not in self.previous['results']:
+            return 'full', None
+
+        previous_mask = np.zeros(len(self.df), dtype=bool)
+        previous_mask[self.unchanged] = self.previous['results'][measure][self.previous_index[self.unchanged]]
+        delta = np.flatnonzero(~self.unchanged)
+        if delta.size == 0:
+            return 'reused', previous_mask
+
+        eligible = np.flatnonzero(previous_mask)
+        if eligible.size == 0:
+            return 'full', None
+        anchors = eligible[np.unique(np.linspace(0, eligible.size - 1, min(ANCHOR_ROWS, eligible.size)).astype(int))]
+
+        _, subset_mask = evaluate_measure(filter_function, self.df.iloc[np.concatenate([delta, anchors])])
+        if not subset_mask[delta.size:].all():
+            logging.info(f"Incremental mode: measure {measure} behaves differently on this data; re-evaluating all rows")
+            return 'full', None
+
+        mask = previous_mask
+        mask[delta] = subset_mask[:delta.size]
+        return 'incremental', mask
+
+    def _load(self):
+        try:
+            with open(self.state_path, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Ignoring unreadable incremental state {self.state_path}: {str(e)}")
+            return None
+        return state if state.get('version') == STATE_VERSION else None
+
+    def save(self):
+        """Store fingerprints and per-row results of the measures evaluated in this run"""
+        state = {
+            'version': STATE_VERSION,
+            'columns': [str(c) for c in self.df.columns],
+            'key_columns': self.key_columns,
+            'reporting_date': self.reporting_date,
+            'value_sets': self.value_sets,
+            'keys': self.keys,
+            'hashes': self.hashes,
+            'results': self.results,
+            'derived': self.derived,
+        }
+        os.makedirs(os.path.dirname(self.state_path) or '.', exist_ok=True)
+        temp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(temp_path, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.state_path)
@@ -0,0 +1,90 @@
+"""
+Ingest helpers: shrink an uploaded DataFrame before the measures run.
+
+pd.read_excel yields object columns for text and float64/int64 for numbers.
+Measures copy the frame, so every byte saved here is saved several times per
+job. Conversions are lossless: a column is only converted when every
+non-missing value survives the conversion.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from dates import parse_date_column, columns_fingerprint
+
+# Canonical text fields (see schema.py) stored as categoricals when repetitive
+CATEGORICAL_FIELDS = ['visit_type', 'diagnosis', 'secondary_diagnosis', 'cpt', 'quality_code', 'provider', 'chief_complaint']
+# Canonical date fields parsed once at ingest
+DATE_FIELDS = ['dob', 'visit_date']
+
+# Convert text to categorical when distinct values are at most this share of rows
+MAX_CATEGORY_RATIO = 0.5
+
+def memory_footprint(df):
+    """Total bytes used by a DataFrame, including Python string objects"""
+    return int(df.memory_usage(deep=True, index=True).sum())
+
+def compact_age(series):
+    """Downcast ages to the smallest integer type, or float32 when values are missing or fractional"""
+    numeric = pd.to_numeric(series, errors='coerce')
+    if numeric.notna().sum() != series.notna().sum():
+        # Some entries are not numbers (e.g. '45 yrs'); keep the original text
+        return series
+    if numeric.isna().any() or not np.all(np.mod(numeric, 1) == 0):
+        return numeric.astype(np.float32)
+    if numeric.min() >= np.iinfo(np.int8).min and numeric.max() <= np.iinfo(np.int8).max:
+        return numeric.astype(np.int8)
+    return numeric.astype(np.int16)
+
+def compact_category(series, column):
+    """Convert repetitive values to a categorical"""
+    if isinstance(series.dtype, pd.CategoricalDtype) or len(series) == 0:
+        return series
+    if series.nunique(dropna=True) > MAX_CATEGORY_RATIO * len(series):
+        return series
+    if series.dtype == object and column == 'visit_type' and \
+            pd.api.types.infer_dtype(series, skipna=True) != 'string':
+        # Measures use the .str accessor on visit types, which needs string categories
+        return series
+    return series.astype('category')
+
+def parse_dates(series, cache_key=None):
+    """Parse a date column once, keeping the original if any value fails to parse"""
+    parsed = parse_date_column(series, cache_key)
+    if parsed.notna().sum() != series.notna().sum():
+        return series
+    return parsed
+
+def compact_dtypes(df):
+    """
+    Convert canonical columns of df to compact dtypes in place.
+
+    Returns:
+        dict with 'before_bytes', 'after_bytes' and 'converted' (column -> new dtype)
+    """
+    before = memory_footprint(df)
+    converted = {}
+
+    conversions = [('age', compact_age)]
+    # Date formats are detected once per header layout (see dates.py)
+    fingerprint = columns_fingerprint(df.columns)
+    conversions += [(field, lambda s, f=field: parse_dates(s, (fingerprint, f))) for field in DATE_FIELDS]
+    conversions += [(field, lambda s, f=field: compact_category(s, f)) for field in CATEGORICAL_FIELDS]
+
+    for column, convert in conversions:
+        if column not in df.columns:
+            continue
+        try:
+            new_series = convert(df[column])
+        except (TypeError, ValueError) as e:
+            logging.warning(f"Could not compact column {column}: {str(e)}")
+            continue
+        if new_series.dtype != df[column].dtype:
+            df[column] = new_series
+            converted[column] = str(new_series.dtype)
+
+    after = memory_footprint(df)
+    logging.info(f"Ingest compaction: {before / 1048576:.1f} MB -> {after / 1048576:.1f} MB ({converted})")
+    return {'before_bytes': before, 'after_bytes': after, 'converted': converted}
@@ -0,0 +1,114 @@
+"""
+Joining a patient table onto an encounter table.
+
+EHRs often export demographics (one row per patient) separately from
+encounters (one row per visit). Instead of pre-joining them in a spreadsheet,
+a job can take both: the encounter rows are what the measures evaluate, and
+each gets the columns of its patient through a hash join on the declared key.
+The patients' keys are hashed once, every encounter key is probed against
+them in one vectorized lookup, and the patient columns are gathered by
+position.
+
+Demographic derivations are made on the patient table before the join, so
+they are computed once per patient rather than once per encounter: when
+neither table has an age, it is derived from the date of birth here and the
+measures use it as is.
+"""
+
+import logging
+
+import numpy as np
+import pandas as pd
+
+from dates import parse_date_column, age_in_years
+from schema import normalize_header
+
+DEFAULT_KEY = 'patient_id'
+
+def resolve_key(df, mapping, key, role):
+    """The column of df holding the join key, given as a canonical field or an original header"""
+    if key in df.columns:
+        return key
+    if key in mapping and mapping[key] in df.columns:
+        return mapping[key]
+    wanted = normalize_header(key)
+    for original, field in mapping.items():
+        if normalize_header(original) == wanted and field in df.columns:
+            return field
+    for column in df.columns:
+        if normalize_header(column) == wanted:
+            return column
+    raise ValueError(f"Join key '{key}' not found in the {role} file")
+
+def key_values(series):
+    """Join keys as text, so 1001, 1001.0 and '1001 ' all match; missing keys stay missing"""
+    if pd.api.types.is_float_dtype(series.dtype):
+        whole = series.dropna()
+        if (whole == np.floor(whole)).all():
+            series = series.astype('Int64')
+    text = series.astype(str).str.strip()
+    return text.where(series.notna() & (text != ''))
+
+def derive_patient_fields(patients, encounters):
+    """Compute per-patient derivations on the patient table; returns the derived column names"""
+    derived = []
+    if 'age' not in patients.columns and 'age' not in encounters.columns and 'dob' in patients.columns:
+        try:
+            patients['dob'] = parse_date_column(patients['dob'])
+            patients['age'] = age_in_years(patients['dob'])
+            derived.append('age')
+        except (TypeError, ValueError) as e:
+            # The measures fall back to their own derivation (or report the missing age)
+            logging.warning(f"Could not calculate patient ages from date of birth: {str(e)}")
+    return derived
+
+def join_patients(encounters, patients, encounter_key, patient_key):
+    """
+    Left-join patient columns onto the encounter rows.
+
+    Columns present in both tables keep the encounter's value and take the
+    patient's only where the encounter has none. Encounters whose key has no
+    patient keep empty patient columns. A patient key listed more than once
+    uses its first row.
+
+    Returns:
+        (DataFrame with one row per encounter, stats dict)
+    """
+    derived = derive_patient_fields(patients, encounters)
+
+    patient_keys = key_values(patients[patient_key])
+    duplicated = patient_keys.duplicated() & patient_keys.notna()
+    if duplicated.any():
+        logging.warning(f"{int(duplicated.sum())} patient rows repeat a key; using the first row of each")
+    # Patients without a key can never match
+    usable = (patient_keys.notna() & ~duplicated).to_numpy()
+    patients, patient_keys = patients[usable], patient_keys[usable]
+
+    # Build: hash the patient keys once; probe: look up every encounter key at once
+    table = pd.Index(patient_keys.to_numpy())
+    positions = table.get_indexer(key_values(encounters[encounter_key]).to_numpy())
+    matched = positions >= 0
+
+    columns = [column for column in patients.columns if column != patient_key]
+    # Position -1 (no patient) gathers an empty row
+    gathered = patients[columns].reset_index(drop=True).reindex(positions).reset_index(drop=True)
+
+    joined = encounters.reset_index(drop=True)
+    for column in columns:
+        if column in joined.columns:
+            joined[column] = joined[column].where(joined[column].notna(), gathered[column])
+        else:
+            joined[column] = gathered[column]
+
+    stats = {
+        'key': encounter_key,
+        'patients': len(patients),
+        'encounters': len(encounters),
+        'matched_encounters': int(matched.sum()),
+        'unmatched_encounters': int((~matched).sum()),
+        'duplicate_patient_rows': int(duplicated.sum()),
+        'derived': derived
+    }
+    logging.info(f"Joined {len(patients)} patients onto {len(encounters)} encounters on '{encounter_key}': "
+                 f"{stats['unmatched_encounters']} encounters without a patient")
+    return joined, stats
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+End-to-end load test of the web application.
+
+Starts the app under gunicorn in a scratch directory (its own SQLite database,
+upload and download folders) and drives it with simulated users through the
+same pages a browser uses: register, log in, upload a generated workbook,
+select measures, poll the dashboard until the job finishes and download the
+report. Concurrency ramps through the given stages; each stage reports
+latency percentiles, error rates and throughput per route, plus job
+turnaround (submit to completed). Runs offline; point --database-url at a
+local Postgres to test against one, or --url at a server already running.
+
+Usage:
+    python loadtest.py                                   # stages 1,2,4,8 users, 60 s each
+    python loadtest.py --ramp 2,8,16 --stage-seconds 120 --rows 20000 --measures 47,317
+    python loadtest.py --workers 4 --threads 4 --database-url postgresql://localhost/mips_load
+    python loadtest.py --url http://127.0.0.1:5000 --ramp 4 --json results.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import shutil
+import tempfile
+import argparse
+import threading
+import subprocess
+import http.cookiejar
+import urllib.error
+import urllib.parse
+import urllib.request
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_CSRF_TOKEN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+# Dashboard rows, newest job first
+_JOB_ROW = re.compile(r'data-job-id="(\d+)" data-status="(\w+)"')
+FINISHED = ('completed', 'error', 'rejected')
+
+class Recorder:
+    """Thread-safe collection of request timings for the current stage"""
+
+    def __init__(self):
+        self.samples = []
+        self._lock = threading.Lock()
+
+    def add(self, route, elapsed_ms, ok):
+        with self._lock:
+            self.samples.append((route, elapsed_ms, ok))
+
+    def drain(self):
+        with self._lock:
+            samples, self.samples = self.samples, []
+        return samples
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Redirects are timed as requests of their own, as a browser makes them
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+def encode_multipart(fields, files):
+    """Body and content type for a form post; files is [(field, filename, bytes)]"""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, filename, content in files:
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                     f'Content-Type: application/vnd.openxmlformats-officedocument.spreadsheetml.sheet\r\n\r\n'.encode())
+        parts.append(content + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+class Client:
+    """One simulated browser: its own cookie jar, every request timed under a route label"""
+
+    def __init__(self, base_url, recorder, timeout=60):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+                                                  _NoRedirect())
+
+    def request(self, route, path, fields=None, files=None, expect=(200,)):
+        """Send a GET (or a POST when fields are given); returns (status, body) or None on failure"""
+        data, headers = None, {}
+        if files:
+            data, headers['Content-Type'] = encode_multipart(fields or [], files)
+        elif fields is not None:
+            data = urllib.parse.urlencode(fields).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+
+        start = time.perf_counter()
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=data, headers=headers),
+                                  timeout=self.timeout) as response:
+                status, body = response.status, response.read()
+        except urllib.error.HTTPError as e:
+            status, body = e.code, e.read()
+        except (urllib.error.URLError, OSError):
+            status, body = None, b''
+        ok = status in expect
+        self.recorder.add(route, (time.perf_counter() - start) * 1000, ok)
+        return (status, body.decode('utf-8', errors='ignore')) if ok else None
+
+    def form_token(self, route, path):
+        page = self.request(route, path)
+        match = _CSRF_TOKEN.search(page[1]) if page else None
+        return match.group(1) if match else None
+
+def simulated_user(client, username, workbook, measures, deadline, poll_interval, job_timeout, turnarounds):
+    """Register and log in once, then upload, process, wait and download until the stage ends"""
+    password = 'load-test-password'
+    token = client.form_token('GET /auth/register', '/auth/register')
+    if token is None or not client.request('POST /auth/register', '/auth/register', expect=(302,), fields=[
+            ('csrf_token', token), ('username', username), ('email', f'{username}@example.com'),
+            ('password', password), ('password2', password)]):
+        return
+    token = client.form_token('GET /auth/login', '/auth/login')
+    if token is None or not client.request('POST /auth/login', '/auth/login', expect=(302,), fields=[
+            ('csrf_token', token), ('username', username), ('password', password)]):
+        return
+
+    with open(workbook, 'rb') as f:
+        content = f.read()
+    while time.monotonic() < deadline:
+        token = client.form_token('GET /upload', '/upload')
+        if token is None or not client.request('POST /upload', '/upload', expect=(302,),
+                                               fields=[('csrf_token', token)],
+                                               files=[('file', os.path.basename(workbook), content)]):
+            continue
+        token = client.form_token('GET /process', '/process')
+        submitted = time.monotonic()
+        if token is None or not client.request('POST /process', '/process', expect=(302,),
+                                               fields=[('csrf_token', token)] + [('measures', m) for m in measures]):
+            continue
+
+        job_id, status = None, None
+        while time.monotonic() < submitted + job_timeout:
+            page = client.request('GET /dashboard', '/dashboard')
+            match = _JOB_ROW.search(page[1]) if page else None
+            if match:
+                job_id, status = match.groups()
+                if status in FINISHED:
+                    break
+            time.sleep(poll_interval)
+        if status != 'completed':
+            turnarounds.append((None, False))
+            continue
+        turnarounds.append(((time.monotonic() - submitted) * 1000, True))
+        client.request('GET /download/<id>', f'/download/{job_id}')
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))]
+
+def summarize(samples, seconds):
+    """Per-route count, errors, latency percentiles (ms) and throughput (requests/s)"""
+    routes = {}
+    for route, elapsed_ms, ok in samples:
+        routes.setdefault(route, []).append((elapsed_ms, ok))
+    summary = {}
+    for route, entries in sorted(routes.items()):
+        latencies = sorted(elapsed for elapsed, ok in entries if ok)
+        errors = sum(1 for _, ok in entries if not ok)
+        summary[route] = {
+            'count': len(entries),
+            'errors': errors,
+            'error_rate': round(errors / len(entries), 4),
+            'p50_ms': percentile(latencies, 0.50),
+            'p90_ms': percentile(latencies, 0.90),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': latencies[-1] if latencies else None,
+            'per_second': round(len(entries) / seconds, 2) if seconds else None,
+        }
+    return summary
+
+def print_stage(users, seconds, summary):
+    print(f"\n== {users} users, {seconds:.0f} s ==")
+    print(f"{'route':<28} {'count':>6} {'err%':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8} {'req/s':>7}")
+    for route, row in summary.items():
+        cells = [f"{row[key]:>8.0f}" if row[key] is not None else f"{'-':>8}"
+                 for key in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms')]
+        print(f"{route:<28} {row['count']:>6} {row['error_rate'] * 100:>6.1f} {' '.join(cells)} {row['per_second']:>7}")
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(workdir, port, workers, threads, database_url):
+    """Start gunicorn serving main:app with its data in workdir; returns the process once it answers"""
+    env = dict(os.environ, DATABASE_URL=database_url or f"sqlite:///{os.path.join(workdir, 'load.db')}",
+               SESSION_SECRET=uuid.uuid4().hex)
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}', '--worker-class', 'gthread',
+         '--workers', str(workers), '--threads', str(threads), '--timeout', '300',
+         '--pythonpath', PROJECT_DIR, 'main:app'],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+    log.close()
+    url = f'http://127.0.0.1:{port}/auth/login'
+    for _ in range(120):
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited")
+        try:
+            urllib.request.urlopen(url, timeout=2).close()
+            return server
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"gunicorn did not answer on port {port}")
+
+def make_workbook(path, rows, seed):
+    from differential import generated_export
+    generated_export(rows, seed).to_excel(path, index=False)
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the upload, process and download flow.')
+    parser.add_argument('--ramp', default='1,2,4,8', help='Comma-separated concurrent users per stage')
+    parser.add_argument('--stage-seconds', type=float, default=60, help='Duration of each stage')
+    parser.add_argument('--rows', type=int, default=5000, help='Rows in the generated workbook')
+    parser.add_argument('--measures', default='47,317', help='Comma-separated measures to select')
+    parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds between dashboard polls')
+    parser.add_argument('--job-timeout', type=float, default=300, help='Seconds to wait for a job to finish')
+    parser.add_argument('--url', help='Test a running server instead of starting gunicorn')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='gunicorn threads per worker')
+    parser.add_argument('--database-url', help='Database for the started server (default: SQLite in the scratch directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch directory (database, uploads, logs)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+
+    stages = [int(users) for users in args.ramp.split(',') if users.strip()]
+    measures = [m.strip() for m in args.measures.split(',') if m.strip()]
+    workdir = tempfile.mkdtemp(prefix='mips-load-')
+    server = None
+    try:
+        workbook = os.path.join(workdir, f'load_{args.rows}.xlsx')
+        make_workbook(workbook, args.rows, seed=0)
+        base_url = args.url
+        if not base_url:
+            port = free_port()
+            try:
+                server = start_server(workdir, port, args.workers, args.threads, args.database_url)
+            except RuntimeError as e:
+                print(f"Could not start the server: {str(e)}", file=sys.stderr)
+                with open(os.path.join(workdir, 'gunicorn.log')) as f:
+                    print(f.read()[-2000:], file=sys.stderr)
+                return 2
+            base_url = f'http://127.0.0.1:{port}'
+            print(f"gunicorn: {args.workers} workers x {args.threads} threads on {base_url} (scratch: {workdir})")
+
+        run_id = uuid.uuid4().hex[:6]
+        results = []
+        for stage, users in enumerate(stages, start=1):
+            recorder, turnarounds = Recorder(), []
+            deadline = time.monotonic() + args.stage_seconds
+            started = time.monotonic()
+            threads = []
+            for index in range(users):
+                client = Client(base_url, recorder)
+                # Usernames are limited to 20 characters
+                username = f"lt{run_id}s{stage}u{index}"
+                thread = threading.Thread(target=simulated_user, daemon=True, args=(
+                    client, username, workbook, measures, deadline, args.poll_interval, args.job_timeout, turnarounds))
+                thread.start()
+                threads.append(thread)
+                # Spread arrivals over the first second so users do not move in lockstep
+                time.sleep(random.uniform(0, 1 / users))
+            for thread in threads:
+                thread.join()
+            seconds = time.monotonic() - started
+
+            summary = summarize(recorder.drain(), seconds)
+            completed = sorted(ms for ms, ok in turnarounds if ok)
+            summary['job (submit to completed)'] = {
+                'count': len(turnarounds),
+                'errors': len(turnarounds) - len(completed),
+                'error_rate': round((len(turnarounds) - len(completed)) / len(turnarounds), 4) if turnarounds else 0.0,
+                'p50_ms': percentile(completed, 0.50),
+                'p90_ms': percentile(completed, 0.90),
+                'p99_ms': percentile(completed, 0.99),
+                'max_ms': completed[-1] if completed else None,
+                'per_second': round(len(completed) / seconds, 2),
+            }
+            print_stage(users, seconds, summary)
+            results.append({'users': users, 'seconds': round(seconds, 1), 'routes': summary})
+
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'url': base_url, 'rows': args.rows, 'measures': measures, 'stages': results}, f, indent=2)
+        return 0 if all(row['errors'] == 0 for stage in results for row in stage['routes'].values()) else 1
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if args.keep:
+            print(f"Scratch directory kept: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,6 +6,13 @@ Denominator logic for filtering eligible patients
 import pandas as pd
 import logging
 
+from dates import parse_date_column, age_in_years
+from explain import step
+
+# Value sets of the quality-data codes for the performance rate (see criteria.py)
+NUMERATOR_VALUE_SET = 'measure130_numerator_qdc'  # Current medications documented
+EXCLUSION_VALUE_SET = 'measure130_exclusion_qdc'  # Not documented for a medical reason
+
 def filter_patients(df):
     """
     Filter patients eligible for MIPS Measure 130 - Documentation of Current Medications
@@ -24,55 +31,39 @@ def filter_patients(df):
         # Make a copy to avoid modifying original data
         filtered_df = df.copy()
         
-        # Check if required columns exist
-        age_columns = ['age', 'Age', 'AGE', 'patient_age', 'Patient_Age']
-        age_column = None
+        # Headers were mapped to the canonical field names at upload (see schema.py)
+        age_column = 'age' if 'age' in filtered_df.columns else None
         
-        for col in age_columns:
-            if col in filtered_df.columns:
-                age_column = col
-                break
-        
-        if age_column is None:
-            # If no age column found, try to derive from date of birth
-            dob_columns = ['dob', 'DOB', 'date_of_birth', 'Date_of_Birth', 'birth_date', 'Birth_Date']
-            dob_column = None
-            
-            for col in dob_columns:
-                if col in filtered_df.columns:
-                    dob_column = col
-                    break
-            
-            if dob_column is not None:
-                # Calculate age from date of birth
-                try:
-                    filtered_df[dob_column] = pd.to_datetime(filtered_df[dob_column])
-                    today = pd.Timestamp.now()
-                    filtered_df['calculated_age'] = (today - filtered_df[dob_column]).dt.days / 365.25
-                    age_column = 'calculated_age'
-                except:
-                    logging.warning("Could not calculate age from date of birth")
+        if age_column is None and 'dob' in filtered_df.columns:
+            # If no age column found, derive it from date of birth
+            derive = step('Age from date of birth', filtered_df)
+            try:
+                filtered_df['dob'] = parse_date_column(filtered_df['dob'])
+                filtered_df['calculated_age'] = age_in_years(filtered_df['dob'])
+                age_column = 'calculated_age'
+                derive.done(filtered_df)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Could not calculate age from date of birth: {str(e)}")
+                derive.skip(f"Could not calculate age: {str(e)}")
         
         if age_column is None:
             logging.warning("No age or date of birth column found. Returning all patients.")
+            step('Age >= 18', filtered_df).skip('No age or date of birth column')
             return filtered_df
         
         # Convert age to numeric, handling any non-numeric values
+        age_step = step('Age >= 18', filtered_df)
         filtered_df[age_column] = pd.to_numeric(filtered_df[age_column], errors='coerce')
         
         # Filter patients aged 18 and older
         eligible_patients = filtered_df[filtered_df[age_column] >= 18]
+        age_step.done(eligible_patients)
         
         # Additional filtering for medication documentation visits
         # Look for visit types that would require medication documentation
-        visit_type_columns = ['visit_type', 'Visit_Type', 'encounter_type', 'Encounter_Type']
-        visit_type_column = None
-        
-        for col in visit_type_columns:
-            if col in filtered_df.columns:
-                visit_type_column = col
-                break
+        visit_type_column = 'visit_type' if 'visit_type' in filtered_df.columns else None
         
+        visit_step = step('Visit type', eligible_patients)
         if visit_type_column is not None:
             # Filter for relevant visit types (office visits, consultations, etc.)
             relevant_visits = [
@@ -87,6 +78,11 @@ def filter_patients(df):
             
             if visit_filter.any():
                 eligible_patients = eligible_patients[visit_filter]
+                visit_step.done(eligible_patients)
+            else:
+                visit_step.skip('No visit type matched; filter ignored')
+        else:
+            visit_step.skip('No visit type column')
         
         logging.info(f"Measure 130: Found {len(eligible_patients)} eligible patients out of {len(df)} total patients")
         
@@ -6,6 +6,13 @@ Denominator logic for filtering eligible patients
 import pandas as pd
 import logging
 
+from dates import parse_date_column, age_in_years
+from explain import step
+from valuesets import in_value_set
+
+# Value sets of the quality-data codes for the performance rate (see criteria.py)
+NUMERATOR_VALUE_SET = 'measure226_numerator_qdc'  # Screened and counselled if a user / screened as non-user
+
 def filter_patients(df):
     """
     Filter patients eligible for MIPS Measure 226 - Preventive Care and Screening: Tobacco Use
@@ -24,54 +31,38 @@ def filter_patients(df):
         # Make a copy to avoid modifying original data
         filtered_df = df.copy()
         
-        # Check if required columns exist
-        age_columns = ['age', 'Age', 'AGE', 'patient_age', 'Patient_Age']
-        age_column = None
-        
-        for col in age_columns:
-            if col in filtered_df.columns:
-                age_column = col
-                break
-        
-        if age_column is None:
-            # If no age column found, try to derive from date of birth
-            dob_columns = ['dob', 'DOB', 'date_of_birth', 'Date_of_Birth', 'birth_date', 'Birth_Date']
-            dob_column = None
-            
-            for col in dob_columns:
-                if col in filtered_df.columns:
-                    dob_column = col
-                    break
-            
-            if dob_column is not None:
-                # Calculate age from date of birth
-                try:
-                    filtered_df[dob_column] = pd.to_datetime(filtered_df[dob_column])
-                    today = pd.Timestamp.now()
-                    filtered_df['calculated_age'] = (today - filtered_df[dob_column]).dt.days / 365.25
-                    age_column = 'calculated_age'
-                except:
-                    logging.warning("Could not calculate age from date of birth")
+        # Headers were mapped to the canonical field names at upload (see schema.py)
+        age_column = 'age' if 'age' in filtered_df.columns else None
+        
+        if age_column is None and 'dob' in filtered_df.columns:
+            # If no age column found, derive it from date of birth
+            derive = step('Age from date of birth', filtered_df)
+            try:
+                filtered_df['dob'] = parse_date_column(filtered_df['dob'])
+                filtered_df['calculated_age'] = age_in_years(filtered_df['dob'])
+                age_column = 'calculated_age'
+                derive.done(filtered_df)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Could not calculate age from date of birth: {str(e)}")
+                derive.skip(f"Could not calculate age: {str(e)}")
         
         if age_column is None:
             logging.warning("No age or date of birth column found. Returning all patients.")
+            step('Age >= 18', filtered_df).skip('No age or date of birth column')
             return filtered_df
         
         # Convert age to numeric, handling any non-numeric values
+        age_step = step('Age >= 18', filtered_df)
         filtered_df[age_column] = pd.to_numeric(filtered_df[age_column], errors='coerce')
         
         # Filter patients aged 18 and older
         eligible_patients = filtered_df[filtered_df[age_column] >= 18]
+        age_step.done(eligible_patients)
         
         # Filter for preventive care visits
-        visit_type_columns = ['visit_type', 'Visit_Type', 'encounter_type', 'Encounter_Type']
-        visit_type_column = None
-        
-        for col in visit_type_columns:
-            if col in filtered_df.columns:
-                visit_type_column = col
-                break
+        visit_type_column = 'visit_type' if 'visit_type' in filtered_df.columns else None
         
+        visit_step = step('Preventive visit type', eligible_patients)
         if visit_type_column is not None:
             # Filter for preventive care visit types
             preventive_visits = [
@@ -86,25 +77,19 @@ def filter_patients(df):
             
             if preventive_filter.any():
                 eligible_patients = eligible_patients[preventive_filter]
+                visit_step.done(eligible_patients)
+            else:
+                visit_step.skip('No visit type matched; filter ignored')
+        else:
+            visit_step.skip('No visit type column')
         
         # Also check for CPT codes related to preventive care (if available)
-        cpt_columns = ['cpt', 'CPT', 'cpt_code', 'CPT_Code', 'procedure_code', 'Procedure_Code']
-        cpt_column = None
-        
-        for col in cpt_columns:
-            if col in filtered_df.columns:
-                cpt_column = col
-                break
+        cpt_column = 'cpt' if 'cpt' in filtered_df.columns else None
         
+        cpt_step = step('Preventive CPT', eligible_patients)
         if cpt_column is not None:
-            # Common preventive care CPT codes
-            preventive_cpts = [
-                '99381', '99382', '99383', '99384', '99385', '99386', '99387',  # New patient preventive
-                '99391', '99392', '99393', '99394', '99395', '99396', '99397',  # Established patient preventive
-                'G0438', 'G0439'  # Annual wellness visits
-            ]
-            
-            cpt_filter = eligible_patients[cpt_column].astype(str).isin(preventive_cpts)
+            # Preventive care CPT codes of the performance year (see valuesets.py)
+            cpt_filter = in_value_set(eligible_patients[cpt_column], 'preventive_visit_cpt')
             
             if cpt_filter.any():
                 # Combine with existing filter or use as primary filter
@@ -116,6 +101,11 @@ def filter_patients(df):
                     ]
                 else:
                     eligible_patients = eligible_patients[cpt_filter]
+                cpt_step.done(eligible_patients)
+            else:
+                cpt_step.skip('No preventive CPT code matched; filter ignored')
+        else:
+            cpt_step.skip('No CPT column')
         
         logging.info(f"Measure 226: Found {len(eligible_patients)} eligible patients out of {len(df)} total patients")
         
@@ -6,6 +6,13 @@ Denominator logic for filtering eligible patients
 import pandas as pd
 import logging
 
+from dates import parse_date_column, age_in_years
+from explain import step
+from valuesets import value_set
+
+# Value sets of the quality-data codes for the performance rate (see criteria.py)
+NUMERATOR_VALUE_SET = 'measure279_numerator_qdc'  # Screened positive with a follow-up plan / screened negative
+
 def filter_patients(df):
     """
     Filter patients eligible for MIPS Measure 279 - Depression Screening and Follow-Up Plan
@@ -24,54 +31,38 @@ def filter_patients(df):
         # Make a copy to avoid modifying original data
         filtered_df = df.copy()
         
-        # Check if required columns exist
-        age_columns = ['age', 'Age', 'AGE', 'patient_age', 'Patient_Age']
-        age_column = None
-        
-        for col in age_columns:
-            if col in filtered_df.columns:
-                age_column = col
-                break
-        
-        if age_column is None:
-            # If no age column found, try to derive from date of birth
-            dob_columns = ['dob', 'DOB', 'date_of_birth', 'Date_of_Birth', 'birth_date', 'Birth_Date']
-            dob_column = None
-            
-            for col in dob_columns:
-                if col in filtered_df.columns:
-                    dob_column = col
-                    break
-            
-            if dob_column is not None:
-                # Calculate age from date of birth
-                try:
-                    filtered_df[dob_column] = pd.to_datetime(filtered_df[dob_column])
-                    today = pd.Timestamp.now()
-                    filtered_df['calculated_age'] = (today - filtered_df[dob_column]).dt.days / 365.25
-                    age_column = 'calculated_age'
-                except:
-                    logging.warning("Could not calculate age from date of birth")
+        # Headers were mapped to the canonical field names at upload (see schema.py)
+        age_column = 'age' if 'age' in filtered_df.columns else None
+        
+        if age_column is None and 'dob' in filtered_df.columns:
+            # If no age column found, derive it from date of birth
+            derive = step('Age from date of birth', filtered_df)
+            try:
+                filtered_df['dob'] = parse_date_column(filtered_df['dob'])
+                filtered_df['calculated_age'] = age_in_years(filtered_df['dob'])
+                age_column = 'calculated_age'
+                derive.done(filtered_df)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Could not calculate age from date of birth: {str(e)}")
+                derive.skip(f"Could not calculate age: {str(e)}")
         
         if age_column is None:
             logging.warning("No age or date of birth column found. Returning all patients.")
+            step('Age >= 12', filtered_df).skip('No age or date of birth column')
             return filtered_df
         
         # Convert age to numeric, handling any non-numeric values
+        age_step = step('Age >= 12', filtered_df)
         filtered_df[age_column] = pd.to_numeric(filtered_df[age_column], errors='coerce')
         
         # Filter patients aged 12 and older
         eligible_patients = filtered_df[filtered_df[age_column] >= 12]
+        age_step.done(eligible_patients)
         
         # Filter for appropriate encounter types for depression screening
-        visit_type_columns = ['visit_type', 'Visit_Type', 'encounter_type', 'Encounter_Type']
-        visit_type_column = None
-        
-        for col in visit_type_columns:
-            if col in filtered_df.columns:
-                visit_type_column = col
-                break
+        visit_type_column = 'visit_type' if 'visit_type' in filtered_df.columns else None
         
+        visit_step = step('Visit type', eligible_patients)
         if visit_type_column is not None:
             # Relevant visit types for depression screening
             relevant_visits = [
@@ -87,29 +78,30 @@ def filter_patients(df):
             
             if visit_filter.any():
                 eligible_patients = eligible_patients[visit_filter]
+                visit_step.done(eligible_patients)
+            else:
+                visit_step.skip('No visit type matched; filter ignored')
+        else:
+            visit_step.skip('No visit type column')
         
         # Exclude patients with certain conditions (dementia, bipolar disorder, etc.)
-        # Look for diagnosis or condition columns
-        diagnosis_columns = [
-            'diagnosis', 'Diagnosis', 'icd', 'ICD', 'icd_code', 'ICD_Code',
-            'condition', 'Condition', 'primary_diagnosis', 'Primary_Diagnosis'
-        ]
-        
-        for diag_col in diagnosis_columns:
-            if diag_col in eligible_patients.columns:
-                # Exclude patients with dementia or severe mental illness
-                exclusion_conditions = [
-                    'dementia', 'alzheimer', 'bipolar', 'schizophrenia', 'psychosis',
-                    'F03', 'F20', 'F25', 'F31'  # Common ICD-10 codes for exclusions
-                ]
-                
-                exclusion_filter = eligible_patients[diag_col].astype(str).str.lower().str.contains(
-                    '|'.join(exclusion_conditions), na=False
-                )
-                
-                # Remove patients with exclusion conditions
-                eligible_patients = eligible_patients[~exclusion_filter]
-                break
+        exclusion_step = step('Dementia / severe mental illness exclusion', eligible_patients)
+        if 'diagnosis' in eligible_patients.columns:
+            # Exclude patients with dementia or severe mental illness: text
+            # diagnoses and ICD-10 codes of the performance year (see valuesets.py)
+            exclusion_conditions = [
+                'dementia', 'alzheimer', 'bipolar', 'schizophrenia', 'psychosis'
+            ] + value_set('dementia_mental_illness_icd10')
+            
+            exclusion_filter = eligible_patients['diagnosis'].astype(str).str.contains(
+                '|'.join(exclusion_conditions), na=False, case=False
+            )
+            
+            # Remove patients with exclusion conditions
+            eligible_patients = eligible_patients[~exclusion_filter]
+            exclusion_step.done(eligible_patients)
+        else:
+            exclusion_step.skip('No diagnosis column')
         
         logging.info(f"Measure 279: Found {len(eligible_patients)} eligible patients out of {len(df)} total patients")
         
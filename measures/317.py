@@ -6,6 +6,14 @@ Denominator logic for filtering eligible patients
 import pandas as pd
 import logging
 
+from dates import parse_date_column, age_in_years
+from explain import step
+from valuesets import value_set, in_value_set
+
+# Value sets of the quality-data codes for the performance rate (see criteria.py)
+NUMERATOR_VALUE_SET = 'measure317_numerator_qdc'  # Normal reading, or elevated reading with a follow-up plan
+EXCLUSION_VALUE_SET = 'measure317_exclusion_qdc'  # Active diagnosis of hypertension
+
 def filter_patients(df):
     """
     Filter patients eligible for MIPS Measure 317 - Preventive Care and Screening: Screening for High Blood Pressure
@@ -24,54 +32,38 @@ def filter_patients(df):
         # Make a copy to avoid modifying original data
         filtered_df = df.copy()
         
-        # Check if required columns exist
-        age_columns = ['age', 'Age', 'AGE', 'patient_age', 'Patient_Age']
-        age_column = None
-        
-        for col in age_columns:
-            if col in filtered_df.columns:
-                age_column = col
-                break
-        
-        if age_column is None:
-            # If no age column found, try to derive from date of birth
-            dob_columns = ['dob', 'DOB', 'date_of_birth', 'Date_of_Birth', 'birth_date', 'Birth_Date']
-            dob_column = None
-            
-            for col in dob_columns:
-                if col in filtered_df.columns:
-                    dob_column = col
-                    break
-            
-            if dob_column is not None:
-                # Calculate age from date of birth
-                try:
-                    filtered_df[dob_column] = pd.to_datetime(filtered_df[dob_column])
-                    today = pd.Timestamp.now()
-                    filtered_df['calculated_age'] = (today - filtered_df[dob_column]).dt.days / 365.25
-                    age_column = 'calculated_age'
-                except:
-                    logging.warning("Could not calculate age from date of birth")
+        # Headers were mapped to the canonical field names at upload (see schema.py)
+        age_column = 'age' if 'age' in filtered_df.columns else None
+        
+        if age_column is None and 'dob' in filtered_df.columns:
+            # If no age column found, derive it from date of birth
+            derive = step('Age from date of birth', filtered_df)
+            try:
+                filtered_df['dob'] = parse_date_column(filtered_df['dob'])
+                filtered_df['calculated_age'] = age_in_years(filtered_df['dob'])
+                age_column = 'calculated_age'
+                derive.done(filtered_df)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Could not calculate age from date of birth: {str(e)}")
+                derive.skip(f"Could not calculate age: {str(e)}")
         
         if age_column is None:
             logging.warning("No age or date of birth column found. Returning all patients.")
+            step('Age >= 18', filtered_df).skip('No age or date of birth column')
             return filtered_df
         
         # Convert age to numeric, handling any non-numeric values
+        age_step = step('Age >= 18', filtered_df)
         filtered_df[age_column] = pd.to_numeric(filtered_df[age_column], errors='coerce')
         
         # Filter patients aged 18 and older
         eligible_patients = filtered_df[filtered_df[age_column] >= 18]
+        age_step.done(eligible_patients)
         
         # Filter for appropriate encounter types for blood pressure screening
-        visit_type_columns = ['visit_type', 'Visit_Type', 'encounter_type', 'Encounter_Type']
-        visit_type_column = None
-        
-        for col in visit_type_columns:
-            if col in filtered_df.columns:
-                visit_type_column = col
-                break
+        visit_type_column = 'visit_type' if 'visit_type' in filtered_df.columns else None
         
+        visit_step = step('Visit type', eligible_patients)
         if visit_type_column is not None:
             # Relevant visit types for blood pressure screening
             relevant_visits = [
@@ -87,20 +79,19 @@ def filter_patients(df):
             
             if visit_filter.any():
                 eligible_patients = eligible_patients[visit_filter]
+                visit_step.done(eligible_patients)
+            else:
+                visit_step.skip('No visit type matched; filter ignored')
+        else:
+            visit_step.skip('No visit type column')
         
         # Exclude patients with end-stage renal disease or on dialysis
-        diagnosis_columns = [
-            'diagnosis', 'Diagnosis', 'icd', 'ICD', 'icd_code', 'ICD_Code',
-            'condition', 'Condition', 'primary_diagnosis', 'Primary_Diagnosis',
-            'secondary_diagnosis', 'Secondary_Diagnosis'
-        ]
-        
-        for diag_col in diagnosis_columns:
+        exclusion_step = step('ESRD / dialysis exclusion', eligible_patients)
+        for diag_col in ('diagnosis', 'secondary_diagnosis'):
             if diag_col in eligible_patients.columns:
-                # Exclude ESRD and dialysis patients
-                exclusion_conditions = [
-                    'N18.6',  # End stage renal disease
-                    'Z99.2',  # Dependence on renal dialysis
+                # Exclude ESRD and dialysis patients: ICD-10 codes of the
+                # performance year (see valuesets.py) and text diagnoses
+                exclusion_conditions = value_set('esrd_dialysis_icd10') + [
                     'dialysis', 'ESRD', 'end stage renal'
                 ]
                 
@@ -110,28 +101,18 @@ def filter_patients(df):
                 
                 # Remove patients with exclusion conditions
                 eligible_patients = eligible_patients[~exclusion_filter]
+                exclusion_step.done(eligible_patients)
                 break
+        else:
+            exclusion_step.skip('No diagnosis column')
         
         # Also check for CPT codes related to outpatient visits (if available)
-        cpt_columns = ['cpt', 'CPT', 'cpt_code', 'CPT_Code', 'procedure_code', 'Procedure_Code']
-        cpt_column = None
-        
-        for col in cpt_columns:
-            if col in filtered_df.columns:
-                cpt_column = col
-                break
+        cpt_column = 'cpt' if 'cpt' in filtered_df.columns else None
         
+        cpt_step = step('Outpatient CPT', eligible_patients)
         if cpt_column is not None:
-            # Common outpatient visit CPT codes
-            outpatient_cpts = [
-                '99201', '99202', '99203', '99204', '99205',  # New patient office visits
-                '99211', '99212', '99213', '99214', '99215',  # Established patient office visits
-                '99381', '99382', '99383', '99384', '99385', '99386', '99387',  # New patient preventive
-                '99391', '99392', '99393', '99394', '99395', '99396', '99397',  # Established patient preventive
-                'G0438', 'G0439'  # Annual wellness visits
-            ]
-            
-            cpt_filter = eligible_patients[cpt_column].astype(str).isin(outpatient_cpts)
+            # Outpatient visit CPT codes of the performance year (see valuesets.py)
+            cpt_filter = in_value_set(eligible_patients[cpt_column], 'outpatient_visit_cpt')
             
             if cpt_filter.any():
                 # If we have CPT codes, use them to further refine the selection
@@ -145,6 +126,11 @@ def filter_patients(df):
                     eligible_patients = eligible_patients[combined_filter]
                 else:
                     eligible_patients = eligible_patients[cpt_filter]
+                cpt_step.done(eligible_patients)
+            else:
+                cpt_step.skip('No outpatient CPT code matched; filter ignored')
+        else:
+            cpt_step.skip('No CPT column')
         
         logging.info(f"Measure 317: Found {len(eligible_patients)} eligible patients out of {len(df)} total patients")
         
@@ -6,6 +6,14 @@ Denominator logic for filtering eligible patients
 import pandas as pd
 import logging
 
+from dates import parse_date_column, age_in_years
+from explain import step
+from valuesets import value_set
+
+# Value sets of the quality-data codes for the performance rate (see criteria.py); an inverse
+# measure, so a lower rate is better
+NUMERATOR_VALUE_SET = 'measure331_numerator_qdc'  # Antibiotic prescribed within 10 days of diagnosis
+
 def filter_patients(df):
     """
     Filter patients eligible for MIPS Measure 331 - Adult Sinusitis: Antibiotic Prescribed
@@ -24,63 +32,42 @@ def filter_patients(df):
         # Make a copy to avoid modifying original data
         filtered_df = df.copy()
         
-        # Check if required columns exist
-        age_columns = ['age', 'Age', 'AGE', 'patient_age', 'Patient_Age']
-        age_column = None
-        
-        for col in age_columns:
-            if col in filtered_df.columns:
-                age_column = col
-                break
-        
-        if age_column is None:
-            # If no age column found, try to derive from date of birth
-            dob_columns = ['dob', 'DOB', 'date_of_birth', 'Date_of_Birth', 'birth_date', 'Birth_Date']
-            dob_column = None
-            
-            for col in dob_columns:
-                if col in filtered_df.columns:
-                    dob_column = col
-                    break
-            
-            if dob_column is not None:
-                # Calculate age from date of birth
-                try:
-                    filtered_df[dob_column] = pd.to_datetime(filtered_df[dob_column])
-                    today = pd.Timestamp.now()
-                    filtered_df['calculated_age'] = (today - filtered_df[dob_column]).dt.days / 365.25
-                    age_column = 'calculated_age'
-                except:
-                    logging.warning("Could not calculate age from date of birth")
+        # Headers were mapped to the canonical field names at upload (see schema.py)
+        age_column = 'age' if 'age' in filtered_df.columns else None
+        
+        if age_column is None and 'dob' in filtered_df.columns:
+            # If no age column found, derive it from date of birth
+            derive = step('Age from date of birth', filtered_df)
+            try:
+                filtered_df['dob'] = parse_date_column(filtered_df['dob'])
+                filtered_df['calculated_age'] = age_in_years(filtered_df['dob'])
+                age_column = 'calculated_age'
+                derive.done(filtered_df)
+            except (TypeError, ValueError) as e:
+                logging.warning(f"Could not calculate age from date of birth: {str(e)}")
+                derive.skip(f"Could not calculate age: {str(e)}")
         
         if age_column is None:
             logging.warning("No age or date of birth column found. Returning all patients.")
+            step('Age >= 18', filtered_df).skip('No age or date of birth column')
             return filtered_df
         
         # Convert age to numeric, handling any non-numeric values
+        age_step = step('Age >= 18', filtered_df)
         filtered_df[age_column] = pd.to_numeric(filtered_df[age_column], errors='coerce')
         
         # Filter patients aged 18 and older
         eligible_patients = filtered_df[filtered_df[age_column] >= 18]
+        age_step.done(eligible_patients)
         
         # Filter for acute sinusitis diagnosis
-        diagnosis_columns = [
-            'diagnosis', 'Diagnosis', 'icd', 'ICD', 'icd_code', 'ICD_Code',
-            'condition', 'Condition', 'primary_diagnosis', 'Primary_Diagnosis',
-            'secondary_diagnosis', 'Secondary_Diagnosis'
-        ]
-        
         sinusitis_found = False
+        diagnosis_step = step('Sinusitis diagnosis', eligible_patients)
         
-        for diag_col in diagnosis_columns:
+        for diag_col in ('diagnosis', 'secondary_diagnosis'):
             if diag_col in eligible_patients.columns:
-                # ICD-10 codes for acute sinusitis
-                sinusitis_codes = [
-                    'J01', 'J01.0', 'J01.1', 'J01.2', 'J01.3', 'J01.4', 'J01.8', 'J01.9',
-                    'J01.00', 'J01.01', 'J01.10', 'J01.11', 'J01.20', 'J01.21',
-                    'J01.30', 'J01.31', 'J01.40', 'J01.41', 'J01.80', 'J01.81',
-                    'J01.90', 'J01.91'
-                ]
+                # ICD-10 codes for acute sinusitis of the performance year (see valuesets.py)
+                sinusitis_codes = value_set('acute_sinusitis_icd10')
                 
                 # Also include text-based sinusitis diagnoses
                 sinusitis_terms = [
@@ -103,46 +90,41 @@ def filter_patients(df):
                 if sinusitis_filter.any():
                     eligible_patients = eligible_patients[sinusitis_filter]
                     sinusitis_found = True
+                    diagnosis_step.done(eligible_patients)
                     break
         
         # If no sinusitis diagnosis found, check for related symptoms or visit types
         if not sinusitis_found:
+            diagnosis_step.skip('No sinusitis diagnosis found')
+            symptom_step = step('Sinusitis symptoms', eligible_patients)
             # Check visit reasons or chief complaints
-            reason_columns = [
-                'chief_complaint', 'Chief_Complaint', 'visit_reason', 'Visit_Reason',
-                'reason_for_visit', 'Reason_for_Visit', 'symptoms', 'Symptoms'
-            ]
-            
-            for reason_col in reason_columns:
-                if reason_col in eligible_patients.columns:
-                    sinusitis_symptoms = [
-                        'sinus', 'sinusitis', 'nasal congestion', 'facial pain',
-                        'headache', 'post nasal drip', 'rhinorrhea'
-                    ]
-                    
-                    symptom_filter = eligible_patients[reason_col].astype(str).str.lower().str.contains(
-                        '|'.join(sinusitis_symptoms), na=False
-                    )
-                    
-                    if symptom_filter.any():
-                        eligible_patients = eligible_patients[symptom_filter]
-                        sinusitis_found = True
-                        break
+            if 'chief_complaint' in eligible_patients.columns:
+                sinusitis_symptoms = [
+                    'sinus', 'sinusitis', 'nasal congestion', 'facial pain',
+                    'headache', 'post nasal drip', 'rhinorrhea'
+                ]
+                
+                symptom_filter = eligible_patients['chief_complaint'].astype(str).str.lower().str.contains(
+                    '|'.join(sinusitis_symptoms), na=False
+                )
+                
+                if symptom_filter.any():
+                    eligible_patients = eligible_patients[symptom_filter]
+                    sinusitis_found = True
+                    symptom_step.done(eligible_patients)
+            if not sinusitis_found:
+                symptom_step.skip('No sinusitis symptoms found')
         
         # If still no sinusitis patients found, return empty dataframe
         if not sinusitis_found:
             logging.info("Measure 331: No patients with sinusitis diagnosis found")
+            step('Require sinusitis diagnosis or symptoms', eligible_patients).done(0)
             return pd.DataFrame(columns=df.columns)
         
         # Additional filtering for appropriate encounter types
-        visit_type_columns = ['visit_type', 'Visit_Type', 'encounter_type', 'Encounter_Type']
-        visit_type_column = None
-        
-        for col in visit_type_columns:
-            if col in eligible_patients.columns:
-                visit_type_column = col
-                break
+        visit_type_column = 'visit_type' if 'visit_type' in eligible_patients.columns else None
         
+        visit_step = step('Visit type', eligible_patients)
         if visit_type_column is not None:
             # Relevant visit types for sinusitis treatment
             relevant_visits = [
@@ -156,6 +138,11 @@ def filter_patients(df):
             
             if visit_filter.any():
                 eligible_patients = eligible_patients[visit_filter]
+                visit_step.done(eligible_patients)
+            else:
+                visit_step.skip('No visit type matched; filter ignored')
+        else:
+            visit_step.skip('No visit type column')
         
         logging.info(f"Measure 331: Found {len(eligible_patients)} eligible patients out of {len(df)} total patients")
         
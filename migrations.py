@@ -0,0 +1,99 @@
+"""
+Schema migrations for databases created by earlier versions.
+
+db.create_all() creates missing tables but never changes existing ones, so
+every column added to an existing table is a numbered step below. The
+database records the number of steps applied in its schema_version table.
+At boot (see ensure_schema in app.py), a database behind the current version
+gets its missing tables created and its pending steps applied in order; an
+up-to-date one costs a single query.
+
+Steps only add what is missing, so they are safe on tables create_all just
+made and on databases that predate schema_version.
+
+To change the schema: add the column to the model and append a step naming
+it. A new table needs a step too (with no columns), so that existing
+databases are brought up to the new version.
+
+    python migrations.py    # apply pending steps ahead of a deployment
+"""
+
+import logging
+
+from sqlalchemy import inspect, text
+
+from app import db
+
+# (description, [(table, column), ...]) in the order they were introduced
+MIGRATIONS = [
+    ('API tokens and job summaries', [('user', 'api_token'), ('processing_job', 'summary')]),
+    ('Practice of incremental jobs', [('processing_job', 'practice')]),
+    ('Job statistics', [('processing_job', 'stats')]),
+    ('Measure bitsets table', []),
+    ('Admission control', [('processing_job', 'estimated_memory_mb'), ('processing_job', 'started_at')]),
+    ('Sheets and combined files', [('processing_job', 'files'), ('processing_job', 'sheets')]),
+    ('Measure results table', []),
+    ('Performance rates', [('measure_result', 'exclusions'), ('measure_result', 'numerator')]),
+    ('Patient file joins', [('processing_job', 'patient_file'), ('processing_job', 'join_key')]),
+    ('Content-addressed uploads', [('processing_job', 'upload_names')]),
+    ('API token expiry', [('user', 'api_token_expires_at')]),
+    ('Job ownership', [('processing_job', 'worker'), ('processing_job', 'heartbeat_at')]),
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def current_version(connection):
+    """Steps applied to the database, or None when it has no schema_version table"""
+    if not inspect(connection).has_table('schema_version'):
+        return None
+    row = connection.execute(text('SELECT version FROM schema_version')).first()
+    return row[0] if row else None
+
+def add_column(connection, table_name, column_name):
+    """Add a model column (and its indexes) to an existing table; False if it is already there"""
+    table = db.metadata.tables[table_name]
+    column = table.c[column_name]
+    if column_name in {c['name'] for c in inspect(connection).get_columns(table_name)}:
+        return False
+    quote = connection.dialect.identifier_preparer.quote
+    column_type = column.type.compile(dialect=connection.dialect)
+    connection.execute(text(f"ALTER TABLE {quote(table_name)} ADD COLUMN {quote(column_name)} {column_type}"))
+    # ALTER TABLE cannot add UNIQUE on every backend; the model's index carries it
+    for index in table.indexes:
+        if column_name in index.columns:
+            index.create(connection, checkfirst=True)
+    return True
+
+def _set_version(connection, version):
+    connection.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    connection.execute(text('DELETE FROM schema_version'))
+    connection.execute(text('INSERT INTO schema_version (version) VALUES (:version)'), {'version': version})
+
+def migrate(force=False):
+    """
+    Create missing tables and apply pending steps.
+    force runs create_all and checks every step even when the version is current.
+    Returns the descriptions of the steps that added columns, or None when the
+    database was already current.
+    """
+    with db.engine.begin() as connection:
+        version = current_version(connection)
+        if not force and version is not None and version >= SCHEMA_VERSION:
+            return None
+        db.metadata.create_all(connection)
+        applied = []
+        # Databases without a version predate this module: check every step
+        start = 0 if force or version is None else version
+        for number, (description, columns) in enumerate(MIGRATIONS[start:], start + 1):
+            added = [f"{table}.{column}" for table, column in columns if add_column(connection, table, column)]
+            if added:
+                logging.info(f"Schema step {number} ({description}): added {', '.join(added)}")
+                applied.append(description)
+        _set_version(connection, max(SCHEMA_VERSION, version or 0))
+    return applied
+
+if __name__ == '__main__':
+    from app import app
+    with app.app_context():
+        steps = migrate(force=True)
+        print(f"Schema at version {SCHEMA_VERSION}: " + (', '.join(steps) if steps else 'no columns added'))
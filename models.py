@@ -1,7 +1,9 @@
+import json
+import secrets
 from app import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from security import hash_password, verify_password, hash_token
+from datetime import datetime, timedelta
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -10,14 +12,40 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(256), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
+    api_token = db.Column(db.String(64), unique=True, index=True)  # SHA-256 of the current API token
+    api_token_expires_at = db.Column(db.DateTime)  # None: the token does not expire
     
     def set_password(self, password):
         """Set password hash"""
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        """Check password against hash"""
-        return check_password_hash(self.password_hash, password)
+        """Check password against hash; a hash made with old parameters is replaced (commit to keep it)"""
+        valid, new_hash = verify_password(self.password_hash, password)
+        if new_hash:
+            self.password_hash = new_hash
+        return valid
+    
+    def generate_api_token(self, lifetime_hours=0):
+        """Issue a new API token, replacing any previous one; the raw token is returned only here"""
+        token = secrets.token_hex(32)
+        self.api_token = hash_token(token)
+        self.api_token_expires_at = datetime.utcnow() + timedelta(hours=lifetime_hours) if lifetime_hours else None
+        return token
+    
+    def revoke_api_token(self):
+        self.api_token = None
+        self.api_token_expires_at = None
+    
+    @classmethod
+    def from_api_token(cls, token):
+        """The active user holding an unexpired API token, or None"""
+        user = cls.query.filter_by(api_token=hash_token(token)).first()
+        if not user or not user.is_active:
+            return None
+        if user.api_token_expires_at and user.api_token_expires_at <= datetime.utcnow():
+            return None
+        return user
     
     def __repr__(self):
         return f'<User {self.username}>'
@@ -27,13 +55,143 @@ class ProcessingJob(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     measures = db.Column(db.Text, nullable=False)  # JSON string of selected measures
-    status = db.Column(db.String(20), default='pending')  # pending, processing, completed, error
+    status = db.Column(db.String(20), default='pending')  # pending, queued, processing, completed, error, rejected
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
     download_path = db.Column(db.String(255))
     error_message = db.Column(db.Text)
+    summary = db.Column(db.Text)  # JSON string of per-measure summary rows
+    practice = db.Column(db.String(100))  # Set to reuse results from the practice's previous upload
+    stats = db.Column(db.Text)  # JSON string of processing statistics (e.g. memory footprint)
+    estimated_memory_mb = db.Column(db.Integer)  # Peak memory estimate used for admission control
+    started_at = db.Column(db.DateTime)  # When the job left the queue
+    files = db.Column(db.Text)  # JSON list of uploaded files when a job combines several (filename is the first)
+    sheets = db.Column(db.Text)  # JSON list of sheet names to read; all sheets when empty
+    patient_file = db.Column(db.String(255))  # Uploaded patient demographics joined onto the encounter rows
+    join_key = db.Column(db.String(100))  # Column identifying the patient in both files
+    upload_names = db.Column(db.Text)  # JSON {stored upload name: name the file was uploaded as}
+    worker = db.Column(db.String(100))  # host:pid of the process running the job
+    heartbeat_at = db.Column(db.DateTime)  # Last sign of life from that process
     
     user = db.relationship('User', backref=db.backref('jobs', lazy=True))
     
     def __repr__(self):
         return f'<ProcessingJob {self.id}>'
+    
+    def input_files(self):
+        """Uploaded file names this job reads, in order"""
+        return json.loads(self.files) if self.files else [self.filename]
+    
+    def uploads(self):
+        """Stored names of every upload this job reads, the patient file included"""
+        return self.input_files() + ([self.patient_file] if self.patient_file else [])
+    
+    def original_name(self, stored_name):
+        """Name an upload had when it was sent (stored uploads are named by content hash)"""
+        names = json.loads(self.upload_names) if self.upload_names else {}
+        return names.get(stored_name, stored_name)
+    
+    @property
+    def display_name(self):
+        return self.original_name(self.filename)
+    
+    def to_dict(self):
+        """Serialize job status and results for the JSON API"""
+        return {
+            'id': self.id,
+            'filename': self.display_name,
+            'files': [self.original_name(name) for name in self.input_files()],
+            'stored_files': self.uploads(),
+            'sheets': json.loads(self.sheets) if self.sheets else None,
+            'patient_file': self.original_name(self.patient_file) if self.patient_file else None,
+            'join_key': self.join_key,
+            'measures': json.loads(self.measures),
+            'status': self.status,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None,
+            'error_message': self.error_message,
+            'estimated_memory_mb': self.estimated_memory_mb,
+            'practice': self.practice,
+            'summary': json.loads(self.summary) if self.summary else None,
+            'stats': json.loads(self.stats) if self.stats else None
+        }
+
+class StoredUpload(db.Model):
+    """An uploaded file, stored once per distinct content and shared by the jobs that read it"""
+    id = db.Column(db.Integer, primary_key=True)
+    filename = db.Column(db.String(255), unique=True, nullable=False)  # <sha256><extension>
+    sha256 = db.Column(db.String(64), nullable=False, index=True)
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)  # Queued or running jobs reading it
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # Last upload or job release
+    
+    def __repr__(self):
+        return f'<StoredUpload {self.filename}>'
+
+class MeasureBitset(db.Model):
+    """One bit per input row: whether the row is eligible for a measure in a job"""
+    __table_args__ = (db.UniqueConstraint('job_id', 'measure'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('processing_job.id'), nullable=False, index=True)
+    measure = db.Column(db.String(20), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False)
+    eligible_count = db.Column(db.Integer, nullable=False)
+    bits = db.Column(db.LargeBinary, nullable=False)
+    
+    job = db.relationship('ProcessingJob', backref=db.backref('bitsets', lazy=True, cascade='all, delete-orphan'))
+    
+    def __repr__(self):
+        return f'<MeasureBitset job={self.job_id} measure={self.measure}>'
+
+class MeasureResult(db.Model):
+    """Summary statistics of one measure in one completed job, kept for cross-job reporting"""
+    __table_args__ = (
+        db.UniqueConstraint('job_id', 'measure'),
+        db.Index('ix_measure_result_user_measure_completed', 'user_id', 'measure', 'completed_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    job_id = db.Column(db.Integer, db.ForeignKey('processing_job.id'), nullable=False, index=True)
+    # Copied from the job so reports aggregate without joining it
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    practice = db.Column(db.String(100), index=True)
+    completed_at = db.Column(db.DateTime, nullable=False, index=True)
+    measure = db.Column(db.String(20), nullable=False)
+    eligible = db.Column(db.Integer)  # None when the measure failed
+    total = db.Column(db.Integer, nullable=False)
+    unique_patients = db.Column(db.Integer)
+    total_unique_patients = db.Column(db.Integer)
+    encounters = db.Column(db.Integer)
+    # None when the measure declares no numerator criteria
+    exclusions = db.Column(db.Integer)
+    numerator = db.Column(db.Integer)
+    
+    job = db.relationship('ProcessingJob', backref=db.backref('measure_results', lazy=True, cascade='all, delete-orphan'))
+    
+    @classmethod
+    def from_summary(cls, job, measure, row):
+        """Build a result from a row of the job's Summary sheet"""
+        def count(key):
+            value = row.get(key)
+            return value if isinstance(value, int) else None
+        
+        return cls(
+            job_id=job.id,
+            user_id=job.user_id,
+            practice=job.practice,
+            completed_at=job.completed_at,
+            measure=measure,
+            eligible=count('Eligible Patients'),
+            total=row.get('Total Patients') or 0,
+            unique_patients=count('Unique Patients'),
+            total_unique_patients=count('Total Unique Patients'),
+            encounters=count('Encounters'),
+            exclusions=count('Exclusions'),
+            numerator=count('Numerator')
+        )
+    
+    def __repr__(self):
+        return f'<MeasureResult job={self.job_id} measure={self.measure}>'
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Benchmark of parallel measure evaluation (MEASURE_WORKERS) against sequential.
+
+Evaluates the selected measures over a generated export (see differential.py)
+one after another in this process, and through evaluate_in_parallel plus the
+rebuilding of each sheet's rows from the workers' output. Both must produce
+identical sheets (rows, columns and dtypes); the median time of each is
+reported over --repeat runs, alternating which goes first. Only evaluation is
+timed: reading the upload and writing the workbook cost the same either way,
+so a job's overall gain is smaller. Parallel evaluation never uses more
+workers than there are CPUs, so on a single CPU there is nothing to compare.
+
+Usage:
+    python parallel_benchmark.py --rows 200000 --workers 4
+    python parallel_benchmark.py --rows 100000 --workers 6 --dob --json bench.json
+"""
+
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+
+import pandas as pd
+
+import utils
+from utils import load_measure_script, evaluate_measure, evaluate_in_parallel, assemble_rows, available_cpus
+from dates import use_reporting_date, reporting_date
+from differential import generated_export, prepare, DEFAULT_REPORTING_DATE
+from measures import AVAILABLE_MEASURES
+
+def with_dates_of_birth(df, seed):
+    """The export with ages replaced by dates of birth, so measures derive calculated_age"""
+    rng = pd.Series(range(len(df))).sample(frac=1, random_state=seed).to_numpy()
+    df = df.drop(columns=['Age'])
+    df['Date of Birth'] = (pd.Timestamp('1925-01-01') + pd.to_timedelta(rng % 36500, unit='D')).strftime('%Y-%m-%d')
+    return df
+
+def run_sequential(df, measures):
+    sheets = {}
+    for measure in measures:
+        filtered_df, _ = evaluate_measure(load_measure_script(measure), df)
+        sheets[measure] = filtered_df.reset_index(drop=True)
+    return sheets
+
+def run_parallel(df, measures, anchor):
+    results = evaluate_in_parallel(df, measures, anchor)
+    if results is None:
+        return None
+    sheets = {}
+    for measure, (mask, error, steps, output) in results.items():
+        if error is not None:
+            raise RuntimeError(f"Measure {measure} failed in a worker: {error}")
+        sheets[measure] = assemble_rows(df, *output)
+    return sheets
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare parallel and sequential measure evaluation.')
+    parser.add_argument('--rows', type=int, default=200000, help='Rows in the generated export')
+    parser.add_argument('--seed', type=int, default=1, help='Seed of the generated export')
+    parser.add_argument('--measures', help='Comma-separated measure numbers (default: all)')
+    parser.add_argument('--workers', type=int, default=4, help='MEASURE_WORKERS for the parallel runs')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each; the median is reported')
+    parser.add_argument('--dob', action='store_true', help='Give dates of birth instead of ages')
+    parser.add_argument('--reporting-date', default=DEFAULT_REPORTING_DATE, help='Anchor for ages (YYYY-MM-DD)')
+    parser.add_argument('--json', help='Also write the results to this file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    measures = args.measures.split(',') if args.measures else list(AVAILABLE_MEASURES)
+    utils.MEASURE_WORKERS = args.workers
+    utils.PARALLEL_MIN_ROWS = 0
+
+    export = generated_export(args.rows, args.seed)
+    df = prepare(with_dates_of_birth(export, args.seed) if args.dob else export)
+
+    timings = {'sequential': [], 'parallel': []}
+    sheets = {}
+    with use_reporting_date(args.reporting_date):
+        anchor = reporting_date()
+        for run in range(args.repeat):
+            # Alternate the order so neither mode always runs on a warmer cache
+            order = ['sequential', 'parallel'] if run % 2 == 0 else ['parallel', 'sequential']
+            for mode in order:
+                started = time.perf_counter()
+                result = run_sequential(df, measures) if mode == 'sequential' else run_parallel(df, measures, anchor)
+                timings[mode].append(time.perf_counter() - started)
+                if result is None:
+                    print(f"Parallel evaluation not used: {available_cpus()} CPU(s) available, "
+                          f"{args.workers} workers requested")
+                    return 1
+                sheets[mode] = result
+
+    identical = all(sheets['sequential'][m].equals(sheets['parallel'][m]) for m in measures)
+    sequential_s = statistics.median(timings['sequential'])
+    parallel_s = statistics.median(timings['parallel'])
+    report = {
+        'rows': len(df), 'measures': measures, 'workers': min(args.workers, len(measures), available_cpus()),
+        'cpus': available_cpus(), 'sequential_s': round(sequential_s, 3), 'parallel_s': round(parallel_s, 3),
+        'speedup': round(sequential_s / parallel_s, 2), 'identical_sheets': identical,
+        'sheet_columns': {m: [str(c) for c in sheets['parallel'][m].columns] for m in measures},
+    }
+    print(f"{report['rows']} rows, {len(measures)} measures, {report['workers']} workers on {report['cpus']} CPUs: "
+          f"sequential {report['sequential_s']} s, parallel {report['parallel_s']} s "
+          f"({report['speedup']}x); sheets {'identical' if identical else 'DIFFER'}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if identical else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
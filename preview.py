@@ -0,0 +1,232 @@
+"""
+Columnar copy of a job's results for paginated previews.
+
+When a job completes, every input column is saved as a numpy array in the
+job's preview folder (text as integer codes plus a label list), together with
+the row numbers eligible for each measure. A preview page memory-maps the
+arrays and gathers only the rows it shows, so it never opens the workbook or
+imports pandas/openpyxl. Sort orders are computed on first use and cached
+next to the columns.
+
+Previews hold patient data, so they are deleted PREVIEW_RETENTION_HOURS after
+they were saved (see prune); the job's report stays downloadable.
+
+    previews/job12/meta.json      columns, kinds, row and measure counts
+    previews/job12/c0.npy         numeric or datetime values
+    previews/job12/c1.codes.npy   text codes (-1 = empty) + c1.labels.json
+    previews/job12/m_47.npy       rows eligible for measure 47
+"""
+
+import os
+import json
+import math
+import time
+import shutil
+import logging
+import tempfile
+import threading
+
+import numpy as np
+
+META_FILE = 'meta.json'
+MAX_PER_PAGE = 500
+# Seconds between sweeps for expired previews (per process)
+PRUNE_INTERVAL = 600
+
+_last_prune = 0.0
+_prune_lock = threading.Lock()
+
+def _write_array(path, array):
+    # A unique temporary name: threads of one process may write the same array at once
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp.npy')
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            np.save(f, array)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def prune(root, retention_hours):
+    """Delete the previews under root saved more than retention_hours ago; returns the count"""
+    cutoff = time.time() - retention_hours * 3600
+    removed = 0
+    try:
+        names = os.listdir(root)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        folder = os.path.join(root, name)
+        if not os.path.isdir(folder):
+            continue
+        try:
+            # A folder without meta.json is being written, or its job failed while writing it
+            saved_at = os.path.getmtime(os.path.join(folder, META_FILE) if Preview.exists(folder) else folder)
+        except OSError:
+            continue
+        if saved_at < cutoff:
+            shutil.rmtree(folder, ignore_errors=True)
+            removed += 1
+    if removed:
+        logging.info(f"Removed {removed} previews older than {retention_hours} hours")
+    return removed
+
+def prune_if_due(root, retention_hours):
+    """prune at most once per PRUNE_INTERVAL in this process (0 hours keeps everything)"""
+    global _last_prune
+    if retention_hours <= 0:
+        return 0
+    with _prune_lock:
+        now = time.time()
+        if now - _last_prune < PRUNE_INTERVAL:
+            return 0
+        _last_prune = now
+    try:
+        return prune(root, retention_hours)
+    except OSError as e:
+        logging.warning(f"Could not prune previews: {str(e)}")
+        return 0
+
+def save_preview(folder, df, measure_masks, headers=None):
+    """
+    Save df's columns and the measures' row masks under folder.
+    headers: display names for df's columns (e.g. the upload's original headers)
+    """
+    import pandas as pd
+
+    os.makedirs(folder, exist_ok=True)
+    headers = list(headers) if headers is not None else [str(c) for c in df.columns]
+    columns = []
+    for position, (column, header) in enumerate(zip(df.columns, headers)):
+        series = df[column]
+        name = f"c{position}"
+        if pd.api.types.is_bool_dtype(series) or (pd.api.types.is_numeric_dtype(series) and
+                                                  not isinstance(series.dtype, pd.CategoricalDtype)):
+            kind = 'numeric'
+            _write_array(os.path.join(folder, f"{name}.npy"), series.to_numpy(dtype=np.float64, na_value=np.nan))
+        elif pd.api.types.is_datetime64_any_dtype(series):
+            kind = 'datetime'
+            _write_array(os.path.join(folder, f"{name}.npy"), series.to_numpy(dtype='datetime64[s]'))
+        else:
+            kind = 'text'
+            codes, labels = pd.factorize(series)
+            # Store labels sorted so codes order like the text (values may mix types)
+            labels = np.array([str(label) for label in labels], dtype=object)
+            ranking = np.argsort(labels, kind='stable')
+            rank = np.empty(len(labels), dtype=np.int32)
+            rank[ranking] = np.arange(len(labels), dtype=np.int32)
+            codes = np.where(codes >= 0, rank[np.maximum(codes, 0)] if len(labels) else -1, -1).astype(np.int32)
+            _write_array(os.path.join(folder, f"{name}.codes.npy"), codes)
+            with open(os.path.join(folder, f"{name}.labels.json"), 'w') as f:
+                json.dump(labels[ranking].tolist(), f)
+        columns.append({'name': header, 'file': name, 'kind': kind})
+
+    measures = {}
+    for measure, mask in measure_masks.items():
+        rows = np.flatnonzero(mask).astype(np.int32)
+        _write_array(os.path.join(folder, f"m_{measure}.npy"), rows)
+        measures[measure] = int(rows.size)
+
+    meta = {'rows': len(df), 'columns': columns, 'measures': measures}
+    temp_path = os.path.join(folder, f"{META_FILE}.{os.getpid()}.tmp")
+    with open(temp_path, 'w') as f:
+        json.dump(meta, f)
+    os.replace(temp_path, os.path.join(folder, META_FILE))
+    return meta
+
+class Preview:
+    """Read access to a saved preview"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        with open(os.path.join(folder, META_FILE)) as f:
+            self.meta = json.load(f)
+        self._labels = {}
+
+    @classmethod
+    def exists(cls, folder):
+        return os.path.exists(os.path.join(folder, META_FILE))
+
+    def _load(self, name):
+        return np.load(os.path.join(self.folder, name), mmap_mode='r')
+
+    def _labels_for(self, column):
+        if column['file'] not in self._labels:
+            with open(os.path.join(self.folder, f"{column['file']}.labels.json")) as f:
+                self._labels[column['file']] = json.load(f)
+        return self._labels[column['file']]
+
+    def _sort_order(self, column, descending):
+        """Row numbers in sort order of a column (cached), empty values last"""
+        path = os.path.join(self.folder, f"{column['file']}.{'desc' if descending else 'asc'}.order.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+
+        if column['kind'] == 'text':
+            # Labels are saved sorted, so codes order like the text they stand for
+            keys = np.asarray(self._load(f"{column['file']}.codes.npy")).astype(np.int64)
+            missing = keys < 0
+        else:
+            values = np.asarray(self._load(f"{column['file']}.npy"))
+            missing = np.isnat(values) if column['kind'] == 'datetime' else np.isnan(values)
+            keys = values.astype(np.int64) if column['kind'] == 'datetime' else values
+        keys = -keys if descending else keys
+        present = np.flatnonzero(~missing)
+        order = np.concatenate([present[np.argsort(keys[present], kind='stable')], np.flatnonzero(missing)])
+        _write_array(path, order.astype(np.int32))
+        return order
+
+    def _values(self, column, rows):
+        if column['kind'] == 'text':
+            labels = self._labels_for(column)
+            codes = self._load(f"{column['file']}.codes.npy")[rows]
+            return [labels[code] if code >= 0 else None for code in codes.tolist()]
+        values = self._load(f"{column['file']}.npy")[rows]
+        if column['kind'] == 'datetime':
+            return [None if np.isnat(v) else
+                    (str(v)[:10] if v == v.astype('datetime64[D]') else str(v)) for v in values]
+        return [None if math.isnan(v) else (int(v) if v.is_integer() else v) for v in values.tolist()]
+
+    def page(self, measure=None, page=1, per_page=50, sort=None, descending=False):
+        """
+        One page of rows: all input rows, or those eligible for measure.
+        sort is a column name. Raises KeyError for an unknown measure or column.
+        """
+        per_page = max(1, min(per_page, MAX_PER_PAGE))
+        if measure is None:
+            rows = None
+            total = self.meta['rows']
+        else:
+            if measure not in self.meta['measures']:
+                raise KeyError(f"No results for measure {measure}")
+            rows = self._load(f"m_{measure}.npy")
+            total = int(rows.size)
+
+        if sort:
+            column = next((c for c in self.meta['columns'] if c['name'] == sort), None)
+            if column is None:
+                raise KeyError(f"Unknown column {sort}")
+            order = np.asarray(self._sort_order(column, descending))
+            if rows is not None:
+                selected = np.zeros(self.meta['rows'], dtype=bool)
+                selected[rows] = True
+                order = order[selected[order]]
+            rows = order
+        elif rows is None:
+            rows = np.arange(total)
+
+        pages = max(1, math.ceil(total / per_page))
+        page = max(1, min(page, pages))
+        visible = np.asarray(rows[(page - 1) * per_page:page * per_page])
+        return {
+            'measure': measure,
+            'columns': [c['name'] for c in self.meta['columns']],
+            'rows': [list(values) for values in zip(*(self._values(c, visible) for c in self.meta['columns']))],
+            'row_numbers': (visible + 2).tolist(),  # Rows of the report's "Original Data" sheet
+            'total': total,
+            'page': page,
+            'pages': pages,
+            'per_page': per_page,
+            'sort': sort,
+            'descending': bool(sort and descending),
+        }
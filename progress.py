@@ -0,0 +1,82 @@
+"""
+In-process progress broker for processing jobs.
+process_excel_file reports stage transitions and per-measure results through a
+callback; the broker keeps them per job so Server-Sent Event streams can replay
+and follow them.
+"""
+
+import time
+import threading
+
+# Finished jobs are kept for late subscribers, then dropped
+RETENTION_SECONDS = 600
+
+class JobChannel:
+    """Ordered event log for one job"""
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.finished_at = None
+
+class ProgressBroker:
+    """Thread-safe store of job progress events with blocking subscription"""
+
+    def __init__(self):
+        self._channels = {}
+        self._condition = threading.Condition()
+
+    def publish(self, job_id, event, data=None):
+        """Append an event for a job and wake up any subscribers"""
+        with self._condition:
+            channel = self._channels.setdefault(job_id, JobChannel())
+            channel.events.append((event, data or {}))
+            if event in ('completed', 'error'):
+                channel.finished = True
+                channel.finished_at = time.monotonic()
+            self._prune()
+            self._condition.notify_all()
+
+    def callback(self, job_id):
+        """Return a progress callback bound to a job"""
+        return lambda event, data=None: self.publish(job_id, event, data)
+
+    def has_job(self, job_id):
+        with self._condition:
+            return job_id in self._channels
+
+    def subscribe(self, job_id, timeout=15):
+        """
+        Yield (event, data) tuples for a job, replaying earlier events first.
+        Yields None when no event arrived within timeout so callers can send
+        keep-alives; stops after the job's final event.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                channel = self._channels.get(job_id)
+                if channel is None:
+                    return
+                if index >= len(channel.events) and not channel.finished:
+                    self._condition.wait(timeout)
+                pending = channel.events[index:]
+                index += len(pending)
+                finished = channel.finished
+
+            if not pending:
+                if finished:
+                    return
+                yield None
+            for item in pending:
+                yield item
+            if finished and index >= len(channel.events):
+                return
+
+    def _prune(self):
+        cutoff = time.monotonic() - RETENTION_SECONDS
+        expired = [job_id for job_id, channel in self._channels.items()
+                   if channel.finished and channel.finished_at < cutoff]
+        for job_id in expired:
+            del self._channels[job_id]
+
+broker = ProgressBroker()
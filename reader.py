@@ -0,0 +1,138 @@
+"""
+Reading uploads into one DataFrame.
+
+Every sheet of every input file (or only the selected sheets) is parsed, each
+sheet's headers are mapped to the canonical schema (see schema.py), and the
+sheets are concatenated, so exports split by month across sheets or files are
+processed as one data set. Sheets with no recognisable column are skipped
+(cover pages, notes, pivot summaries).
+
+Large inputs spanning several sheets can be parsed in parallel worker
+processes (PARSE_WORKERS; default 1, sequential). Callers that already run
+several jobs in parallel, like batch.py, divide the CPUs between them rather
+than each using PARSE_WORKERS. Processes that cannot have children, such as
+the prewarmed processing workers, parse sequentially.
+"""
+
+import os
+import re
+import html
+import logging
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pandas as pd
+
+from schema import apply_schema
+
+# Added when a job combines several sheets or files: "<file> / <sheet>"
+SOURCE_COLUMN = 'Source'
+
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', 1))
+# Below this total input size, starting worker processes costs more than it saves
+PARALLEL_MIN_BYTES = 2 * 1024 * 1024
+
+_SHEET_NAME = re.compile(r'<sheet\b[^>]*?\bname="([^"]*)"')
+
+def list_sheets(filepath):
+    """Sheet names of a workbook in workbook order, without loading its cells"""
+    if zipfile.is_zipfile(filepath):
+        with zipfile.ZipFile(filepath) as archive:
+            workbook = archive.read('xl/workbook.xml').decode('utf-8', errors='ignore')
+        return [html.unescape(name) for name in _SHEET_NAME.findall(workbook)]
+    with pd.ExcelFile(filepath) as book:
+        return list(book.sheet_names)
+
+def read_sheets(filepath, sheets):
+    """Parse the given sheets of one file; returns {sheet name: DataFrame}"""
+    return pd.read_excel(filepath, sheet_name=list(sheets))
+
+def _read_one(task):
+    filepath, sheet = task
+    return read_sheets(filepath, [sheet])[sheet]
+
+def _parse(plan):
+    """Parse {filepath: [sheet, ...]}; returns [(filepath, sheet, DataFrame)] in plan order"""
+    tasks = [(filepath, sheet) for filepath, sheets in plan.items() for sheet in sheets]
+    total_bytes = sum(os.path.getsize(filepath) for filepath in plan)
+    workers = min(PARSE_WORKERS, len(tasks))
+
+    if workers > 1 and total_bytes >= PARALLEL_MIN_BYTES and not multiprocessing.current_process().daemon:
+        from utils import process_context
+        try:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as executor:
+                frames = list(executor.map(_read_one, tasks))
+            return [(filepath, sheet, frame) for (filepath, sheet), frame in zip(tasks, frames)]
+        except (OSError, BrokenProcessPool) as e:
+            logging.warning(f"Parallel parsing unavailable, parsing sequentially: {str(e)}")
+
+    # One call per file shares the workbook's string table between its sheets
+    parsed = []
+    for filepath, sheets in plan.items():
+        frames = read_sheets(filepath, sheets)
+        parsed.extend((filepath, sheet, frames[sheet]) for sheet in sheets)
+    return parsed
+
+def read_inputs(filepaths, sheets=None, names=None):
+    """
+    Read and concatenate the sheets of one or more workbooks.
+
+    Args:
+        filepaths (str or list): workbook path(s)
+        sheets (list): sheet names to read; None reads every sheet
+        names (dict): optional {file name: name to report it as}, e.g. the
+            original names of uploads stored by content hash
+
+    Returns:
+        (DataFrame, schema mapping {original header: canonical field}, sources)
+        where sources lists {'file', 'sheet', 'rows'} for each sheet read, with
+        'skipped' giving the reason for sheets left out
+    """
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+
+    plan = {}
+    for filepath in filepaths:
+        available = list_sheets(filepath)
+        plan[filepath] = [name for name in available if name in sheets] if sheets else available
+    if sheets and not any(plan.values()):
+        raise ValueError(f"None of the selected sheets were found: {', '.join(sheets)}")
+
+    frames = []
+    mapping = {}
+    used = []
+    skipped = []
+    fallback = None
+    for filepath, sheet, frame in _parse(plan):
+        if frame.empty:
+            continue
+        filename = os.path.basename(filepath)
+        source = {'file': (names or {}).get(filename, filename), 'sheet': sheet, 'rows': len(frame)}
+        sheet_mapping = apply_schema(frame)
+        if not sheet_mapping:
+            fallback = fallback or (frame, source)
+            skipped.append(source)
+            continue
+        mapping.update(sheet_mapping)
+        frames.append(frame)
+        used.append(source)
+
+    if not frames:
+        if fallback is None:
+            return pd.DataFrame(), mapping, []
+        # Nothing recognisable anywhere: process the first sheet as before
+        frames, used = [fallback[0]], [fallback[1]]
+        skipped = skipped[1:]
+    for source in skipped:
+        logging.warning(f"Skipping sheet '{source['sheet']}' of {source['file']} "
+                        f"({source['rows']} rows): no recognised columns")
+        source['skipped'] = 'no recognised columns'
+
+    if len(frames) > 1:
+        for frame, source in zip(frames, used):
+            frame[SOURCE_COLUMN] = f"{source['file']} / {source['sheet']}"
+        logging.info(f"Combining {len(frames)} sheets: {sum(len(f) for f in frames)} rows")
+    df = pd.concat(frames, ignore_index=True, sort=False) if len(frames) > 1 else frames[0]
+    return df, mapping, used + skipped
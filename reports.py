@@ -0,0 +1,121 @@
+"""
+Trend reports over the measure results stored when jobs complete.
+
+Every completed job leaves one MeasureResult row per measure (the numbers of
+its Summary sheet), so reports aggregate them in SQL without opening any
+output file. SQL sums them per day; days are then bucketed into weeks, months
+or years in Python, so week numbers are ISO 8601 weeks (2024-W01 is the week
+with the year's first Thursday) on every database backend.
+"""
+
+from datetime import date, datetime, timedelta
+
+from sqlalchemy import func, case
+
+from app import db
+from models import MeasureResult
+
+PERIODS = ('day', 'week', 'month', 'year')
+GROUPS = ('measure', 'practice')
+
+# Columns summed per day and then per period
+_SUMS = ('jobs', 'eligible', 'total', 'encounters', 'unique_patients', 'measured', 'numerator', 'exclusions', 'rated')
+
+def period_label(day, period):
+    """Label of the period a date falls in: 2024-03-07, 2024-W10, 2024-03 or 2024"""
+    if period == 'day':
+        return day.isoformat()
+    if period == 'week':
+        year, week, _ = day.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == 'month':
+        return f"{day.year}-{day.month:02d}"
+    return str(day.year)
+
+def _as_date(value):
+    # SQLite's date() returns text, other backends a date
+    return date.fromisoformat(value) if isinstance(value, str) else value
+
+def _add(total, value):
+    """Sum that stays None while every value is None (e.g. no numerator in any result)"""
+    if value is None:
+        return total
+    return value if total is None else total + value
+
+def measure_trends(user_id, period='month', measures=None, practice=None, start=None, end=None,
+                   group_by=('measure',)):
+    """
+    Aggregate a user's measure results per period.
+
+    Args:
+        user_id (int): owner of the jobs
+        period (str): one of PERIODS
+        measures (list): only these measures; None for all
+        practice (str): only jobs of this practice
+        start, end (date): completion dates to include (inclusive)
+        group_by (tuple): any of GROUPS, besides the period
+
+    Returns:
+        list of dicts ordered by period, each with the group values and jobs,
+        eligible, total, encounters, unique_patients, rate (percent of total
+        that is eligible), numerator, exclusions and performance_rate (percent,
+        numerator / (eligible - exclusions), as on the Summary sheet)
+    """
+    day = func.date(MeasureResult.completed_at).label('day')
+    groups = [getattr(MeasureResult, name) for name in group_by]
+    query = db.session.query(
+        day,
+        *groups,
+        # A job's results all fall on the day it completed, so daily counts add up
+        func.count(func.distinct(MeasureResult.job_id)).label('jobs'),
+        func.sum(MeasureResult.eligible).label('eligible'),
+        # Runs where the measure failed count as jobs but add no patients
+        func.sum(case((MeasureResult.eligible.isnot(None), MeasureResult.total), else_=0)).label('total'),
+        func.sum(MeasureResult.encounters).label('encounters'),
+        func.sum(MeasureResult.unique_patients).label('unique_patients'),
+        func.count(MeasureResult.eligible).label('measured'),
+        # Performance rates only over results that have a numerator
+        func.sum(MeasureResult.numerator).label('numerator'),
+        func.sum(case((MeasureResult.numerator.isnot(None), MeasureResult.exclusions), else_=0)).label('exclusions'),
+        func.sum(case((MeasureResult.numerator.isnot(None), MeasureResult.eligible), else_=0)).label('rated'),
+    ).filter(MeasureResult.user_id == user_id)
+
+    if measures:
+        query = query.filter(MeasureResult.measure.in_(measures))
+    if practice:
+        query = query.filter(MeasureResult.practice == practice)
+    if start:
+        query = query.filter(MeasureResult.completed_at >= datetime.combine(start, datetime.min.time()))
+    if end:
+        query = query.filter(MeasureResult.completed_at < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+
+    buckets = {}
+    for row in query.group_by(day, *groups).all():
+        key = (period_label(_as_date(row.day), period),) + tuple(getattr(row, name) for name in group_by)
+        bucket = buckets.setdefault(key, dict.fromkeys(_SUMS))
+        for name in _SUMS:
+            bucket[name] = _add(bucket[name], getattr(row, name))
+
+    report = []
+    # Practices may be None: order them first within a period
+    for key in sorted(buckets, key=lambda key: tuple((value is not None, value) for value in key)):
+        row = buckets[key]
+        entry = {'period': key[0]}
+        for name, value in zip(group_by, key[1:]):
+            entry[name] = value
+        eligible = row['eligible'] if row['measured'] else None
+        total = row['total'] or 0
+        entry.update({
+            'jobs': row['jobs'],
+            'eligible': eligible,
+            'total': total,
+            'encounters': row['encounters'],
+            'unique_patients': row['unique_patients'],
+            'rate': round(100 * eligible / total, 1) if eligible is not None and total else None,
+            'numerator': row['numerator'],
+            'exclusions': row['exclusions'] if row['numerator'] is not None else None,
+        })
+        rated = (row['rated'] or 0) - (row['exclusions'] or 0)
+        entry['performance_rate'] = round(100 * row['numerator'] / rated, 1) if row['numerator'] is not None and rated else None
+        report.append(entry)
+    return report
@@ -0,0 +1,62 @@
+"""
+Unique-patient and encounter rollup across measures.
+Measures return visit rows, so a patient seen several times is counted once per
+visit. The rollup groups every measure's row mask by patient id (and encounter
+id) with a single hash-based groupby, producing de-duplicated counts for all
+measures in one pass.
+"""
+
+import numpy as np
+import pandas as pd
+
+def group_codes(values):
+    """Hash-factorize ids into integer group codes; missing ids each form their own group"""
+    codes, uniques = pd.factorize(values)
+    missing = codes < 0
+    codes[missing] = len(uniques) + np.arange(missing.sum())
+    return codes
+
+def rollup_counts(df, masks, patient_column=None, encounter_column=None):
+    """
+    Count unique patients and encounters selected by each measure.
+    
+    Args:
+        df (pandas.DataFrame): Input rows the masks refer to
+        masks (dict): measure -> boolean array aligned with df rows
+        patient_column / encounter_column: id columns (default to the canonical
+            'patient_id' / 'encounter_id' columns when present)
+    
+    Returns:
+        dict with 'patient_column', 'encounter_column', 'total_patients',
+        'total_encounters' and 'measures' (measure -> {'unique_patients', 'encounters'});
+        counts are None when the corresponding id column is absent
+    """
+    if patient_column is None and 'patient_id' in df.columns:
+        patient_column = 'patient_id'
+    if encounter_column is None and 'encounter_id' in df.columns:
+        encounter_column = 'encounter_id'
+    
+    measures = list(masks)
+    counts = {m: {'unique_patients': None, 'encounters': None} for m in measures}
+    rollup = {
+        'patient_column': patient_column,
+        'encounter_column': encounter_column,
+        'total_patients': None,
+        'total_encounters': None,
+        'measures': counts,
+    }
+    if not measures:
+        return rollup
+    
+    selected = pd.DataFrame({m: np.asarray(masks[m], dtype=bool) for m in measures})
+    for column, key, total_key in ((patient_column, 'unique_patients', 'total_patients'),
+                                   (encounter_column, 'encounters', 'total_encounters')):
+        if column is None:
+            continue
+        codes = group_codes(df[column].to_numpy())
+        # One groupby over all measure columns: a group counts if any of its rows was selected
+        per_group = selected.groupby(codes, sort=False).any()
+        rollup[total_key] = int(len(per_group))
+        for measure, value in per_group.sum().items():
+            counts[measure][key] = int(value)
+    return rollup
@@ -1,25 +1,226 @@
 import os
 import json
+import time
 import logging
-from datetime import datetime
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_file, current_app
+from datetime import datetime, date
+from functools import wraps
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, send_file, current_app, jsonify, g, Response, stream_with_context
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.exceptions import RequestEntityTooLarge
 
 from app import db, login_manager
-from models import User, ProcessingJob
+from models import User, ProcessingJob, MeasureBitset, MeasureResult
 from forms import LoginForm, RegisterForm, UploadForm, MeasureSelectionForm
-from utils import process_excel_file, allowed_file
+from utils import process_excel_file, allowed_file, upload_size
+from measures import AVAILABLE_MEASURES
+from progress import broker
+from workers import start_pool
+from scheduler import scheduler, estimate_job_memory, AdmissionError
+# preview and bitsets load numpy, so they are imported by the views using them (see startup_report.py)
+from reports import measure_trends, PERIODS, GROUPS
+from security import login_throttle
+import uploadstore
+
+# Seconds between status checks when streaming a job owned by another worker process
+EVENT_POLL_INTERVAL = 2
+# Upper bound on a single event stream; EventSource reconnects automatically
+EVENT_STREAM_TIMEOUT = 600
+# Milliseconds the browser waits before reconnecting. Servers without threads
+# (sync gunicorn workers, Passenger, uWSGI without threads) would give a whole
+# worker to each open stream, so there every connection reports the job's
+# progress so far and closes, and the browser polls at this interval
+EVENT_RETRY_MS = 5000
 
 # Create blueprints
 main_bp = Blueprint('main', __name__)
 auth_bp = Blueprint('auth', __name__)
+api_bp = Blueprint('api', __name__)
 
 @login_manager.user_loader
 def load_user(user_id):
     return User.query.get(int(user_id))
 
+def save_upload(file, names):
+    """Store an uploaded file by content (see uploadstore.py), record its original name in names and return the stored name"""
+    folder = current_app.config['UPLOAD_FOLDER']
+    uploadstore.prune_if_due(folder, current_app.config['UPLOAD_RETENTION_HOURS'])
+    from preview import prune_if_due
+    prune_if_due(current_app.config['PREVIEW_FOLDER'], current_app.config['PREVIEW_RETENTION_HOURS'])
+    filename = uploadstore.store(file, folder)
+    names[filename] = secure_filename(file.filename)
+    return filename
+
+def upload_limit_error(files, patients=None):
+    """Why uploaded files exceed MAX_UPLOAD_FILES or MAX_FILE_SIZE, or None if they don't"""
+    max_files = current_app.config['MAX_UPLOAD_FILES']
+    if max_files and len(files) > max_files:
+        return f'Too many files: at most {max_files} can be uploaded at once.'
+    max_size = current_app.config['MAX_FILE_SIZE']
+    for file in files + ([patients] if patients else []):
+        if max_size and upload_size(file) > max_size:
+            return f'{file.filename} is too large. Maximum size is {max_size // (1024 * 1024)} MB per file.'
+    return None
+
+def job_filepaths(job):
+    """Upload paths a job reads: one path, or a list when it combines several files"""
+    paths = [os.path.join(current_app.config['UPLOAD_FOLDER'], name) for name in job.input_files()]
+    return paths if len(paths) > 1 else paths[0]
+
+# Processing results kept on the job as its statistics
+STATS_KEYS = ('memory', 'sources', 'reporting_date', 'incremental', 'trace', 'join')
+
+def run_job(job, progress_callback=None):
+    """Process the uploaded file(s) for a job and record the outcome on it"""
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    args = (job_filepaths(job), json.loads(job.measures), current_app.config['DOWNLOAD_FOLDER'])
+    options = {
+        'output_name': f"processed_mips_report_{timestamp}_job{job.id}.xlsx",
+        'preview_folder': preview_folder(job.id)
+    }
+    if job.sheets:
+        options['sheets'] = json.loads(job.sheets)
+    if job.patient_file:
+        options['patient_file'] = os.path.join(current_app.config['UPLOAD_FOLDER'], job.patient_file)
+        options['join_key'] = job.join_key
+    if job.upload_names:
+        options['source_names'] = {name: job.original_name(name) for name in job.uploads()}
+    if current_app.config.get('REPORTING_DATE'):
+        options['reporting_date'] = current_app.config['REPORTING_DATE']
+    if job.practice:
+        options['incremental_state'] = incremental_state_path(job.user_id, job.practice)
+    
+    if current_app.config['PROCESSING_WORKERS'] > 0:
+        # Hand the job to a prewarmed worker process and wait for it
+        pool = start_pool(
+            current_app.config['PROCESSING_WORKERS'],
+            current_app.config['WORKER_MAX_JOBS'],
+            current_app.config['WORKER_MAX_RSS_MB']
+        )
+        result = pool.submit(*args, progress_callback=progress_callback, **options).result()
+    else:
+        result = process_excel_file(*args, progress_callback=progress_callback, **options)
+    
+    if result['success']:
+        from bitsets import count_bits
+        job.status = 'completed'
+        job.completed_at = datetime.utcnow()
+        job.download_path = result['download_path']
+        job.summary = json.dumps(result['summary'])
+        job.stats = json.dumps({key: result[key] for key in STATS_KEYS if key in result})
+        # Summary rows follow the order of the selected measures
+        for measure, row in zip(json.loads(job.measures), result['summary']):
+            db.session.add(MeasureResult.from_summary(job, measure, row))
+        for measure, (row_count, bits) in result.get('bitsets', {}).items():
+            db.session.add(MeasureBitset(
+                job_id=job.id,
+                measure=measure,
+                row_count=row_count,
+                eligible_count=count_bits(bits),
+                bits=bits
+            ))
+    else:
+        job.status = 'error'
+        job.error_message = result['error']
+    db.session.commit()
+    return result
+
+def preview_folder(job_id):
+    """Folder holding the columnar result copy of a job (see preview.py)"""
+    return os.path.join(current_app.config['PREVIEW_FOLDER'], f"job{job_id}")
+
+def preview_page(job):
+    """Return (JSON body, status) for a page of a job's result preview from the request args"""
+    from preview import Preview
+    if job.status != 'completed' or not Preview.exists(preview_folder(job.id)):
+        return {'error': 'No preview is available for this job'}, 404
+    try:
+        return Preview(preview_folder(job.id)).page(
+            measure=request.args.get('measure') or None,
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', 50, type=int),
+            sort=request.args.get('sort') or None,
+            descending=request.args.get('order') == 'desc'
+        ), 200
+    except KeyError as e:
+        return {'error': e.args[0]}, 400
+
+def incremental_state_path(user_id, practice):
+    """Location of the stored per-row results for a user's practice"""
+    return os.path.join(current_app.config['STATE_FOLDER'], f"user{user_id}", f"{secure_filename(practice)}.pkl")
+
+def _job_thread(app, job_id):
+    """Background worker body: run a job and publish its progress"""
+    def forward(event, data):
+        # Final events are published only after the outcome is committed
+        if event not in ('completed', 'error'):
+            broker.publish(job_id, event, data)
+    
+    with app.app_context():
+        # The scheduler has already claimed the job (status 'processing')
+        job = db.session.get(ProcessingJob, job_id)
+        broker.publish(job_id, 'stage', {'stage': 'started'})
+        try:
+            run_job(job, progress_callback=forward)
+        except Exception as e:
+            logging.error(f"Processing error for job {job_id}: {str(e)}")
+            db.session.rollback()
+            job.status = 'error'
+            job.error_message = str(e)
+            db.session.commit()
+        
+        release_uploads(job)
+        if job.status == 'completed':
+            broker.publish(job_id, 'completed', {'summary': json.loads(job.summary or '[]')})
+        else:
+            broker.publish(job_id, 'error', {'error': job.error_message})
+        db.session.remove()
+
+def release_uploads(job):
+    """Drop a finished job's references to its stored uploads"""
+    try:
+        uploadstore.release(job.uploads())
+    except Exception as e:
+        db.session.rollback()
+        logging.warning(f"Could not release the uploads of job {job.id}: {str(e)}")
+
+def job_interrupted(job):
+    """Finish a job the scheduler found interrupted (its process stopped)"""
+    release_uploads(job)
+    broker.publish(job.id, 'error', {'error': job.error_message})
+
+def start_job(job):
+    """
+    Hand a committed job to the scheduler, which runs it in a background
+    thread of some web worker process once the user's concurrency limit and
+    the memory budget allow. Rejected jobs are marked 'rejected' with the
+    reason. Returns job.status.
+    """
+    inputs = job_filepaths(job)
+    if job.patient_file:
+        inputs = (inputs if isinstance(inputs, list) else [inputs]) + \
+            [os.path.join(current_app.config['UPLOAD_FOLDER'], job.patient_file)]
+    estimated_memory_mb = estimate_job_memory(inputs, len(json.loads(job.measures)))
+    try:
+        scheduler.check(job.user_id, estimated_memory_mb, job.id)
+    except AdmissionError as e:
+        logging.warning(f"Job {job.id} rejected: {str(e)}")
+        job.estimated_memory_mb = estimated_memory_mb
+        job.status = 'rejected'
+        job.error_message = str(e)
+        db.session.commit()
+        broker.publish(job.id, 'error', {'error': job.error_message})
+        return job.status
+    
+    # The estimate makes the job eligible to run, so it is committed with the upload references
+    job.estimated_memory_mb = estimated_memory_mb
+    uploadstore.acquire(job.uploads())
+    db.session.commit()
+    broker.publish(job.id, 'stage', {'stage': 'queued'})
+    scheduler.submit(job.id)
+    db.session.refresh(job)
+    return job.status
+
 # Authentication routes
 @auth_bp.route('/login', methods=['GET', 'POST'])
 def login():
@@ -28,12 +229,22 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
+        # Refuse throttled attempts before spending time on the password hash
+        retry_after = login_throttle.retry_after(request.remote_addr, form.username.data)
+        if retry_after:
+            flash(f'Too many failed login attempts. Try again in {max(1, retry_after // 60)} minute(s).', 'error')
+            return render_template('login.html', form=form), 429, {'Retry-After': str(retry_after)}
+        
         user = User.query.filter_by(username=form.username.data).first()
         if user and user.check_password(form.password.data):
+            login_throttle.succeeded(request.remote_addr, form.username.data)
+            # Saves the password hash if it was upgraded to the current parameters
+            db.session.commit()
             login_user(user)
             flash('Welcome back!', 'success')
             next_page = request.args.get('next')
             return redirect(next_page) if next_page else redirect(url_for('main.dashboard'))
+        login_throttle.failed(request.remote_addr, form.username.data)
         flash('Invalid username or password', 'error')
     
     return render_template('login.html', form=form)
@@ -98,23 +309,27 @@ def upload():
     form = UploadForm()
     
     if form.validate_on_submit():
-        file = form.file.data
-        if file and allowed_file(file.filename):
+        files = [file for file in form.file.data if file and file.filename]
+        patients = form.patients.data if form.patients.data and form.patients.data.filename else None
+        error = upload_limit_error(files, patients)
+        if error:
+            flash(error, 'error')
+        elif files and all(allowed_file(file.filename) for file in files):
             try:
-                filename = secure_filename(file.filename)
-                # Add timestamp to avoid conflicts
-                timestamp = datetime.now().strftime('%Y%m%d_%H%M%S_')
-                filename = timestamp + filename
-                filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
+                names = {}
+                filenames = [save_upload(file, names) for file in files]
                 
-                # Store filename in session for next step
-                session['uploaded_file'] = filename
-                flash('File uploaded successfully!', 'success')
+                # Store filenames in session for next step
+                session['uploaded_file'] = filenames[0]
+                session['uploaded_files'] = filenames
+                session['uploaded_patients'] = save_upload(patients, names) if patients else None
+                session['upload_names'] = names
+                flash('File uploaded successfully!' if len(filenames) == 1 else
+                      f'{len(filenames)} files uploaded successfully!', 'success')
                 return redirect(url_for('main.process'))
                 
             except RequestEntityTooLarge:
-                flash('File is too large. Maximum size is 16MB.', 'error')
+                flash(too_large_message(), 'error')
             except Exception as e:
                 logging.error(f"Upload error: {str(e)}")
                 flash('An error occurred during upload. Please try again.', 'error')
@@ -133,46 +348,48 @@ def process():
     
     if form.validate_on_submit():
         filename = session['uploaded_file']
+        filenames = session.get('uploaded_files') or [filename]
         selected_measures = form.measures.data
         
         logging.info(f"Form submitted with measures: {selected_measures}")
         
         if not selected_measures or len(selected_measures) == 0:
             flash('Please select at least one measure.', 'warning')
-            return render_template('process.html', form=form, filename=filename)
+            return render_template('process.html', form=form, **upload_context())
         
+        sheets = parse_sheets(form.sheets.data)
+        patient_file = session.get('uploaded_patients')
         try:
             # Create processing job record
             job = ProcessingJob(
                 user_id=current_user.id,
                 filename=filename,
                 measures=json.dumps(selected_measures),
-                status='processing'
+                status='queued',
+                practice=form.practice.data or None,
+                files=json.dumps(filenames) if len(filenames) > 1 else None,
+                sheets=json.dumps(sheets) if sheets else None,
+                patient_file=patient_file,
+                join_key=(form.join_key.data or '').strip() or None if patient_file else None,
+                upload_names=json.dumps(session.get('upload_names') or {})
             )
             db.session.add(job)
             db.session.commit()
             
-            # Process the file
-            filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-            result = process_excel_file(filepath, selected_measures, current_app.config['DOWNLOAD_FOLDER'])
+            # Process the file in the background; the dashboard streams its progress
+            status = start_job(job)
             
-            if result['success']:
-                # Update job status
-                job.status = 'completed'
-                job.completed_at = datetime.utcnow()
-                job.download_path = result['download_path']
-                db.session.commit()
-                
-                # Clean up session
-                session.pop('uploaded_file', None)
-                
-                flash('File processed successfully! You can download it now.', 'success')
-                return redirect(url_for('main.dashboard'))
+            # Clean up session
+            session.pop('uploaded_file', None)
+            session.pop('uploaded_files', None)
+            session.pop('uploaded_patients', None)
+            session.pop('upload_names', None)
+            
+            if status == 'rejected':
+                flash(f'The job could not be accepted: {job.error_message}', 'error')
             else:
-                job.status = 'error'
-                job.error_message = result['error']
-                db.session.commit()
-                flash(f'Processing failed: {result["error"]}', 'error')
+                flash('Processing started. Progress is shown below and the download appears when it finishes.', 'success')
+            return redirect(url_for('main.dashboard'))
                 
         except Exception as e:
             logging.error(f"Processing error: {str(e)}")
@@ -191,8 +408,19 @@ def process():
                 for error in errors:
                     flash(f'{field}: {error}', 'error')
     
+    return render_template('process.html', form=form, **upload_context())
+
+def upload_context():
+    """Names of the files uploaded in this session, as they were sent, for the measure selection page"""
+    names = session.get('upload_names') or {}
     filename = session.get('uploaded_file', 'Unknown file')
-    return render_template('process.html', form=form, filename=filename)
+    filenames = session.get('uploaded_files') or [filename]
+    patient_file = session.get('uploaded_patients')
+    return {
+        'filename': names.get(filename, filename),
+        'files': [names.get(name, name) for name in filenames],
+        'patient_file': names.get(patient_file, patient_file) if patient_file else None
+    }
 
 @main_bp.route('/download/<int:job_id>')
 @login_required
@@ -211,12 +439,114 @@ def download(job_id):
         flash('Download file not found.', 'error')
         return redirect(url_for('main.dashboard'))
     
+    # send_file resolves relative paths against the app's directory, not the working directory
     return send_file(
-        job.download_path,
+        os.path.abspath(job.download_path),
         as_attachment=True,
-        download_name=f"processed_{job.filename}"
+        download_name=f"processed_{job.display_name}"
     )
 
+@main_bp.route('/jobs/<int:job_id>/events')
+@login_required
+def job_events(job_id):
+    """Server-Sent Events stream of a job's progress"""
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    download_url = url_for('main.download', job_id=job_id)
+    
+    def format_event(event, data):
+        if event == 'completed':
+            data = dict(data, download_url=download_url)
+        return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    
+    def final_event(status, error_message):
+        if status == 'completed':
+            return format_event('completed', {})
+        return format_event('error', {'error': error_message})
+    
+    hold = EVENT_STREAM_TIMEOUT if request.environ.get('wsgi.multithread') else 0
+    
+    def status_event():
+        """The job's final event once it has finished, else None"""
+        row = db.session.query(ProcessingJob.status, ProcessingJob.error_message)\
+                        .filter_by(id=job_id).first()
+        db.session.rollback()
+        if row is None or row.status not in ('pending', 'queued', 'processing'):
+            return final_event(row.status if row else 'error', row.error_message if row else 'Job not found')
+        return None
+    
+    def stream():
+        # Tell the browser how long to wait before reconnecting
+        yield f"retry: {EVENT_RETRY_MS}\n\n"
+        deadline = time.monotonic() + hold
+        
+        if broker.has_job(job_id):
+            for item in broker.subscribe(job_id, timeout=min(15, hold)):
+                if item is not None:
+                    yield format_event(*item)
+                    continue
+                # A queued job may have been run by another worker process
+                final = status_event()
+                if final:
+                    yield final
+                    return
+                if time.monotonic() >= deadline:
+                    return
+                yield ": keep-alive\n\n"
+            return
+        
+        # The job is running in another worker process (or finished before this
+        # one started): fall back to watching its status row
+        while True:
+            final = status_event()
+            if final:
+                yield final
+                return
+            if time.monotonic() >= deadline:
+                return
+            yield ": keep-alive\n\n"
+            time.sleep(EVENT_POLL_INTERVAL)
+    
+    return Response(
+        stream_with_context(stream()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+@main_bp.route('/jobs/<int:job_id>/preview')
+@login_required
+def preview(job_id):
+    from preview import Preview
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job or job.status != 'completed' or not Preview.exists(preview_folder(job.id)):
+        flash('No preview is available for this job.', 'warning')
+        return redirect(url_for('main.dashboard'))
+    
+    meta = Preview(preview_folder(job.id)).meta
+    return render_template('preview.html', job=job, measures=meta['measures'], rows=meta['rows'])
+
+@main_bp.route('/jobs/<int:job_id>/preview/data')
+@login_required
+def preview_data(job_id):
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    body, status = preview_page(job)
+    return jsonify(body), status
+
+@main_bp.route('/jobs/<int:job_id>/trace')
+@login_required
+def trace(job_id):
+    """Rows in, rows out and time of every filter step of each measure"""
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=current_user.id).first()
+    stats = json.loads(job.stats) if job and job.stats else {}
+    if not stats.get('trace'):
+        flash('No filter trace is available for this job.', 'warning')
+        return redirect(url_for('main.dashboard'))
+    return render_template('trace.html', job=job, trace=stats['trace'], incremental=stats.get('incremental'))
+
 @main_bp.route('/jobs')
 @login_required
 def jobs():
@@ -225,7 +555,315 @@ def jobs():
     return render_template('dashboard.html', recent_jobs=user_jobs)
 
 # Error handlers
+def too_large_message():
+    return (f"Upload is too large. Maximum size is {current_app.config['MAX_FILE_SIZE'] // (1024 * 1024)} MB "
+            f"per file, {current_app.config['MAX_UPLOAD_FILES']} files at once.")
+
 @main_bp.errorhandler(413)
 def too_large(e):
-    flash('File is too large. Maximum size is 16MB.', 'error')
+    flash(too_large_message(), 'error')
     return redirect(url_for('main.upload'))
+
+# JSON API routes
+def token_required(f):
+    """Authenticate API requests with an 'Authorization: Bearer <token>' header"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth_header = request.headers.get('Authorization', '')
+        token = auth_header[7:].strip() if auth_header.startswith('Bearer ') else None
+        user = User.from_api_token(token) if token else None
+        if not user:
+            return jsonify({'error': 'Invalid or missing API token'}), 401
+        g.api_user = user
+        return f(*args, **kwargs)
+    return decorated
+
+def parse_measures(values):
+    """Normalize measures given as a list or comma-separated strings; returns (measures, unknown)"""
+    if isinstance(values, str):
+        values = [values]
+    measures = []
+    for value in values or []:
+        for measure in str(value).split(','):
+            measure = measure.strip()
+            if measure and measure not in measures:
+                measures.append(measure)
+    unknown = [m for m in measures if m not in AVAILABLE_MEASURES]
+    return measures, unknown
+
+def parse_sheets(value):
+    """Sheet names from a comma-separated string; empty means every sheet"""
+    return [name.strip() for name in (value or '').split(',') if name.strip()]
+
+@api_bp.route('/token', methods=['POST'])
+def api_token():
+    data = request.get_json(silent=True) or request.form
+    if not hasattr(data, 'get') or not all(isinstance(data.get(key, ''), str) for key in ('username', 'password')):
+        return jsonify({'error': 'Expected username and password as a JSON object or form fields'}), 400
+    retry_after = login_throttle.retry_after(request.remote_addr, data.get('username'))
+    if retry_after:
+        return jsonify({'error': 'Too many failed login attempts', 'retry_after': retry_after}), 429, \
+               {'Retry-After': str(retry_after)}
+    
+    user = User.query.filter_by(username=data.get('username')).first()
+    if not user or not user.is_active or not user.check_password(data.get('password', '')):
+        login_throttle.failed(request.remote_addr, data.get('username'))
+        return jsonify({'error': 'Invalid username or password'}), 401
+    
+    login_throttle.succeeded(request.remote_addr, data.get('username'))
+    token = user.generate_api_token(current_app.config['API_TOKEN_LIFETIME_HOURS'])
+    db.session.commit()
+    expires_at = user.api_token_expires_at.isoformat() if user.api_token_expires_at else None
+    return jsonify({'token': token, 'expires_at': expires_at})
+
+@api_bp.route('/token', methods=['DELETE'])
+@token_required
+def api_revoke_token():
+    """Revoke the token used for this request"""
+    g.api_user.revoke_api_token()
+    db.session.commit()
+    return '', 204
+
+@api_bp.route('/measures')
+@token_required
+def api_measures():
+    return jsonify({'measures': AVAILABLE_MEASURES})
+
+@api_bp.route('/jobs', methods=['POST'])
+@token_required
+def api_submit_jobs():
+    """
+    Submit one or more files for processing.
+    
+    Multipart fields: 'file' or 'files' (repeatable), 'measures' applied to every
+    file (repeatable or comma-separated), and an optional 'manifest' JSON object
+    mapping an uploaded filename to its own measure list. Each file becomes its
+    own job unless 'combine' is true, which makes one job reading all files as
+    one data set. 'sheets' (comma-separated) limits the sheets read; every sheet
+    is read by default. An optional 'practice' enables incremental processing
+    against that practice's previous upload (single-job submissions only).
+    A 'patients' file of demographics is joined onto the rows of the job's
+    file(s), one per encounter, on 'join_key' (default patient_id; single-job
+    submissions only).
+    """
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No files provided'}), 400
+    
+    default_measures, unknown = parse_measures(request.form.getlist('measures'))
+    try:
+        manifest = json.loads(request.form.get('manifest') or '{}')
+    except ValueError:
+        return jsonify({'error': 'manifest must be a JSON object'}), 400
+    if not isinstance(manifest, dict):
+        return jsonify({'error': 'manifest must be a JSON object'}), 400
+    
+    combine = request.form.get('combine', '').lower() in ('1', 'true', 'yes', 'on')
+    if combine and manifest:
+        return jsonify({'error': 'manifest cannot be used with combine'}), 400
+    sheets = parse_sheets(request.form.get('sheets'))
+    
+    practice = (request.form.get('practice') or '').strip() or None
+    if practice and ((len(files) > 1 and not combine) or not secure_filename(practice)):
+        return jsonify({'error': 'practice requires a single job and a plain name'}), 400
+    
+    patients = request.files.get('patients')
+    join_key = (request.form.get('join_key') or '').strip() or None
+    if patients is not None and patients.filename:
+        if len(files) > 1 and not combine:
+            return jsonify({'error': 'patients requires a single job'}), 400
+        if not allowed_file(patients.filename):
+            return jsonify({'error': f'Unsupported file: {patients.filename}'}), 400
+    else:
+        patients = None
+    error = upload_limit_error(files, patients)
+    if error:
+        return jsonify({'error': error}), 413
+    
+    # Validate the whole batch before saving anything
+    batch = []
+    for file in files:
+        if not file.filename or not allowed_file(file.filename):
+            return jsonify({'error': f'Unsupported file: {file.filename}'}), 400
+        measures, file_unknown = parse_measures(manifest.get(file.filename)) if file.filename in manifest \
+            else (default_measures, unknown)
+        if file_unknown:
+            return jsonify({'error': f'Unknown measures for {file.filename}: {", ".join(file_unknown)}'}), 400
+        if not measures:
+            return jsonify({'error': f'No measures selected for {file.filename}'}), 400
+        batch.append(([file], measures))
+    if combine:
+        batch = [([file for group, _ in batch for file in group], default_measures)]
+    
+    jobs = []
+    patient_names = {}
+    patient_file = save_upload(patients, patient_names) if patients else None
+    for group, measures in batch:
+        names = dict(patient_names)
+        filenames = [save_upload(file, names) for file in group]
+        job = ProcessingJob(
+            user_id=g.api_user.id,
+            filename=filenames[0],
+            files=json.dumps(filenames) if len(filenames) > 1 else None,
+            sheets=json.dumps(sheets) if sheets else None,
+            measures=json.dumps(measures),
+            status='queued',
+            practice=practice,
+            patient_file=patient_file,
+            join_key=join_key if patient_file else None,
+            upload_names=json.dumps(names)
+        )
+        db.session.add(job)
+        db.session.commit()
+        jobs.append(job)
+    
+    for job in jobs:
+        start_job(job)
+    
+    return jsonify({'jobs': [
+        {'id': job.id, 'status': job.status, 'error': job.error_message,
+         'status_url': url_for('api.api_job_status', job_id=job.id, _external=True)}
+        for job in jobs
+    ]}), 202
+
+@api_bp.route('/jobs')
+@token_required
+def api_list_jobs():
+    limit = min(request.args.get('limit', 50, type=int), 500)
+    query = ProcessingJob.query.filter_by(user_id=g.api_user.id)
+    status = request.args.get('status')
+    if status:
+        query = query.filter_by(status=status)
+    user_jobs = query.order_by(ProcessingJob.created_at.desc()).limit(limit).all()
+    return jsonify({'jobs': [job.to_dict() for job in user_jobs]})
+
+@api_bp.route('/jobs/<int:job_id>')
+@token_required
+def api_job_status(job_id):
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=g.api_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    data = job.to_dict()
+    if job.status == 'queued':
+        data['queue_position'] = scheduler.position(job.id)
+    if job.status == 'completed' and job.download_path:
+        data['download_url'] = url_for('api.api_download', job_id=job.id, _external=True)
+    return jsonify(data)
+
+@api_bp.route('/jobs/<int:job_id>/download')
+@token_required
+def api_download(job_id):
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=g.api_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job.status != 'completed' or not job.download_path or not os.path.exists(job.download_path):
+        return jsonify({'error': 'File is not ready for download'}), 409
+    
+    # send_file resolves relative paths against the app's directory, not the working directory
+    return send_file(
+        os.path.abspath(job.download_path),
+        as_attachment=True,
+        download_name=f"processed_{job.display_name}"
+    )
+
+@api_bp.route('/jobs/<int:job_id>/preview')
+@token_required
+def api_job_preview(job_id):
+    """Paginated result rows: measure, page, per_page, sort (column name), order=asc|desc"""
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=g.api_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    body, status = preview_page(job)
+    return jsonify(body), status
+
+@api_bp.route('/jobs/<int:job_id>/overlap')
+@token_required
+def api_job_overlap(job_id):
+    """Per-measure eligible counts and pairwise overlaps for one job"""
+    from bitsets import overlap_matrix
+    job = ProcessingJob.query.filter_by(id=job_id, user_id=g.api_user.id).first()
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    bitsets = {b.measure: (b.row_count, b.bits) for b in job.bitsets}
+    return jsonify({
+        'job_id': job.id,
+        'rows': next(iter(bitsets.values()))[0] if bitsets else 0,
+        'eligible': {b.measure: b.eligible_count for b in job.bitsets},
+        'overlap': overlap_matrix(bitsets)
+    })
+
+@api_bp.route('/overlap')
+@token_required
+def api_overlap():
+    """
+    Combine stored measure bitsets, e.g. ?refs=12:226,12:317&op=and counts rows
+    eligible for both measures in job 12. op is 'and', 'or' or 'difference'
+    (rows in the first reference only); jobs must cover the same rows.
+    """
+    from bitsets import combine, count_bits, OPERATIONS
+    operation = request.args.get('op', 'and')
+    if operation not in OPERATIONS:
+        return jsonify({'error': f"op must be one of {', '.join(OPERATIONS)}"}), 400
+    
+    refs = []
+    for ref in request.args.get('refs', '').split(','):
+        job_id, _, measure = ref.strip().partition(':')
+        if not job_id.isdigit() or not measure:
+            return jsonify({'error': f"Invalid reference '{ref}'; use <job_id>:<measure>"}), 400
+        refs.append((int(job_id), measure))
+    
+    bitsets = []
+    for job_id, measure in refs:
+        bitset = MeasureBitset.query.join(ProcessingJob)\
+                                    .filter(ProcessingJob.user_id == g.api_user.id,
+                                            MeasureBitset.job_id == job_id,
+                                            MeasureBitset.measure == measure).first()
+        if not bitset:
+            return jsonify({'error': f"No results for measure {measure} in job {job_id}"}), 404
+        bitsets.append((bitset.row_count, bitset.bits))
+    
+    try:
+        result = combine(bitsets, operation)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({
+        'refs': [f"{job_id}:{measure}" for job_id, measure in refs],
+        'op': operation,
+        'rows': bitsets[0][0],
+        'count': count_bits(result)
+    })
+
+@api_bp.route('/reports/measures')
+@token_required
+def api_measure_report():
+    """
+    Measure results of completed jobs aggregated per period, e.g.
+    ?period=month&measures=226,317&practice=Main&start=2024-01-01&end=2024-12-31&group_by=measure,practice
+    """
+    period = request.args.get('period', 'month')
+    if period not in PERIODS:
+        return jsonify({'error': f"period must be one of {', '.join(PERIODS)}"}), 400
+    
+    group_by = tuple(name.strip() for name in request.args.get('group_by', 'measure').split(',') if name.strip())
+    if any(name not in GROUPS for name in group_by):
+        return jsonify({'error': f"group_by must be among {', '.join(GROUPS)}"}), 400
+    
+    measures, unknown = parse_measures(request.args.get('measures'))
+    if unknown:
+        return jsonify({'error': f"Unknown measures: {', '.join(unknown)}"}), 400
+    
+    dates = {}
+    for name in ('start', 'end'):
+        value = request.args.get(name)
+        try:
+            dates[name] = date.fromisoformat(value) if value else None
+        except ValueError:
+            return jsonify({'error': f"Invalid {name} date '{value}'; use YYYY-MM-DD"}), 400
+    
+    rows = measure_trends(g.api_user.id, period, measures=measures, practice=request.args.get('practice'),
+                          start=dates['start'], end=dates['end'], group_by=group_by)
+    return jsonify({'period': period, 'group_by': list(group_by), 'rows': rows})
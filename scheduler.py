@@ -0,0 +1,377 @@
+"""
+Admission control for processing jobs.
+
+Each job's peak memory is estimated from its upload before it runs. Jobs start
+only while the user is under their concurrency limit and the estimates of all
+running jobs fit the memory budget; otherwise they wait in a FIFO queue. Jobs
+that could never fit the budget, or that would exceed a user's queue limit,
+are rejected up front.
+
+The queue is the job table itself: queued jobs wait in id order, and the
+memory budget counts every job with status 'processing'. Admission decisions
+are taken under a file lock (JOB_LOCK_FILE), so every web worker process on
+the host shares one budget, and a job is claimed by a conditional update, so
+only one process runs it. Each process also checks the queue every few
+seconds, starting jobs that memory freed in another process now allows.
+
+A process running jobs refreshes their heartbeat_at. A job still
+'processing' whose process has exited, or whose heartbeat is older than
+JOB_HEARTBEAT_TIMEOUT, was interrupted (a restart, or a worker killed for
+memory): it is marked 'error' and its uploads are released. Queued jobs
+outlive a restart and run once a process has room for them.
+
+Where the server runs no threads besides the request's own (uWSGI without
+enable-threads, as on PythonAnywhere), a job runs inside the request that
+submitted it, and that request then runs any queued jobs it has made room
+for. There are no queue checks or heartbeats between requests, so a job's
+process is then judged only by its process id, and queued jobs start when a
+running job finishes or another job is submitted.
+"""
+
+import os
+import re
+import time
+import socket
+import logging
+import zipfile
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from app import db
+from models import ProcessingJob
+from utils import file_lock
+
+# Peak memory per input cell, measured on processed exports: reading the
+# sheet and writing the "Original Data" sheet, plus each measure's sheet
+BYTES_PER_CELL = 400
+BYTES_PER_CELL_PER_MEASURE = 150
+BASELINE_MB = 32
+
+# Uncompressed worksheet XML per cell (.xlsx) and file bytes per cell (.xls)
+XML_BYTES_PER_CELL = 55
+XLS_BYTES_PER_CELL = 16
+
+# Seconds between each process's checks of the queue and heartbeats of its jobs
+POLL_INTERVAL = 5
+
+INTERRUPTED_MESSAGE = 'Processing was interrupted: the server process running this job stopped'
+
+_DIMENSION = re.compile(r'<dimension ref="[A-Z]+\d+:([A-Z]+)(\d+)"')
+
+def _column_number(letters):
+    number = 0
+    for letter in letters:
+        number = number * 26 + ord(letter) - ord('A') + 1
+    return number
+
+def count_cells(filepath):
+    """
+    Estimate the number of cells in a workbook's sheets without parsing them,
+    from each sheet's dimension record and its uncompressed size
+    """
+    if not zipfile.is_zipfile(filepath):
+        return os.path.getsize(filepath) // XLS_BYTES_PER_CELL
+
+    total = 0
+    with zipfile.ZipFile(filepath) as archive:
+        for sheet in archive.infolist():
+            if not sheet.filename.startswith('xl/worksheets/sheet'):
+                continue
+            with archive.open(sheet) as f:
+                head = f.read(4096).decode('utf-8', errors='ignore')
+            cells = sheet.file_size // XML_BYTES_PER_CELL
+            match = _DIMENSION.search(head)
+            if match:
+                # Some writers record only "A1"; never trust the dimension below the size estimate
+                cells = max(cells, _column_number(match.group(1)) * int(match.group(2)))
+            total += cells
+    return total
+
+def estimate_job_memory(filepaths, measure_count):
+    """Estimated peak memory in MB for processing file(s) with measure_count measures"""
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    cells = 0
+    for filepath in filepaths:
+        try:
+            cells += count_cells(filepath)
+        except (OSError, zipfile.BadZipFile) as e:
+            logging.warning(f"Could not size {filepath}: {str(e)}")
+    return int(BASELINE_MB + cells * (BYTES_PER_CELL + BYTES_PER_CELL_PER_MEASURE * measure_count) / 1048576)
+
+class AdmissionError(Exception):
+    """Raised when a job cannot be accepted"""
+
+def threads_supported():
+    """False under uWSGI without threads enabled, where threads the application starts never run"""
+    try:
+        import uwsgi
+    except ImportError:
+        return True
+    return bool(uwsgi.opt.get('enable-threads') or uwsgi.opt.get('threads'))
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+class JobScheduler:
+    """Database-backed FIFO job queue enforcing per-user concurrency and a shared memory budget"""
+
+    def __init__(self, max_jobs_per_user=2, memory_budget_mb=2048, max_queued_per_user=20):
+        self.max_jobs_per_user = max_jobs_per_user
+        self.memory_budget_mb = memory_budget_mb
+        self.max_queued_per_user = max_queued_per_user
+        self.heartbeat_timeout = 120
+        self.lock_path = None
+        self.threads = True
+        self._app = None
+        self._runner = None
+        self._interrupted = None
+        self._local = set()
+        self._poller_pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, max_jobs_per_user, memory_budget_mb, max_queued_per_user,
+                  app=None, runner=None, interrupted=None, lock_path=None, heartbeat_timeout=120,
+                  threads=True):
+        """
+        Set the limits. runner(job_id) runs a claimed job; interrupted(job) is
+        called in an app context for each job found interrupted. Without
+        threads, jobs run in the submitting request. Jobs left over from a
+        previous run are recovered now.
+        """
+        with self._lock:
+            self.max_jobs_per_user = max_jobs_per_user
+            self.memory_budget_mb = memory_budget_mb
+            self.max_queued_per_user = max_queued_per_user
+            self.heartbeat_timeout = heartbeat_timeout
+            self.threads = threads
+            self.lock_path = lock_path
+            self._app = app
+            self._runner = runner
+            self._interrupted = interrupted
+        if lock_path:
+            os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+        if app is not None:
+            with app.app_context():
+                self.recover()
+
+    @property
+    def worker_id(self):
+        """Identifies this process in ProcessingJob.worker"""
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def check(self, user_id, memory_mb, job_id=None):
+        """Raise AdmissionError if a job of this size may not be queued for the user"""
+        if self.memory_budget_mb and memory_mb > self.memory_budget_mb:
+            raise AdmissionError(f"File too large to process: needs about {memory_mb} MB, "
+                                 f"more than the {self.memory_budget_mb} MB processing budget")
+        if self.max_queued_per_user:
+            waiting = ProcessingJob.query.filter(
+                ProcessingJob.user_id == user_id, ProcessingJob.status == 'queued',
+                ProcessingJob.estimated_memory_mb.isnot(None), ProcessingJob.id != job_id).count()
+            if waiting >= self.max_queued_per_user:
+                raise AdmissionError(f"Too many jobs waiting ({waiting}); try again when some have finished")
+
+    def submit(self, job_id):
+        """
+        Start a committed queued job (with its estimated_memory_mb set) if it
+        may run now. Returns True if it started, False if it is waiting.
+        Without threads it has finished by then, along with any queued jobs
+        that could start after it.
+        """
+        self.start_polling()
+        started = self.dispatch()
+        if not self.threads:
+            self._run_inline(started)
+        return job_id in started
+
+    def position(self, job_id):
+        """1-based position of a waiting job, or None when it is not waiting"""
+        job = db.session.get(ProcessingJob, job_id)
+        if job is None or job.status != 'queued':
+            return None
+        return ProcessingJob.query.filter(
+            ProcessingJob.status == 'queued', ProcessingJob.estimated_memory_mb.isnot(None),
+            ProcessingJob.id < job_id).count() + 1
+
+    def status(self):
+        """Snapshot of running and waiting jobs across all processes"""
+        running = db.session.query(ProcessingJob.estimated_memory_mb).filter_by(status='processing').all()
+        return {
+            'running': len(running),
+            'running_here': len(self._local),
+            'queued': ProcessingJob.query.filter_by(status='queued').count(),
+            'memory_in_use_mb': sum(row.estimated_memory_mb or 0 for row in running),
+            'memory_budget_mb': self.memory_budget_mb,
+        }
+
+    @contextmanager
+    def _admission_lock(self):
+        """Serialize admission between threads, and between processes sharing lock_path"""
+        with self._lock:
+            if not self.lock_path:
+                yield
+                return
+            with file_lock(self.lock_path):
+                yield
+
+    def dispatch(self):
+        """Claim and start every queued job that may run now; returns the started job ids"""
+        if self._runner is None:
+            return set()
+        claimed = []
+        with self._admission_lock():
+            try:
+                running = db.session.query(ProcessingJob.user_id, ProcessingJob.estimated_memory_mb)\
+                                    .filter_by(status='processing').all()
+                queued = db.session.query(ProcessingJob.id, ProcessingJob.user_id,
+                                          ProcessingJob.estimated_memory_mb, ProcessingJob.created_at)\
+                                   .filter(ProcessingJob.status == 'queued',
+                                           ProcessingJob.estimated_memory_mb.isnot(None))\
+                                   .order_by(ProcessingJob.id).all()
+                memory_in_use = sum(row.estimated_memory_mb or 0 for row in running)
+                running_per_user = Counter(row.user_id for row in running)
+                now = datetime.utcnow()
+
+                for job in queued:
+                    if self.max_jobs_per_user and running_per_user[job.user_id] >= self.max_jobs_per_user:
+                        # Other users' jobs may go ahead of a user at their limit
+                        continue
+                    if self.memory_budget_mb and memory_in_use + job.estimated_memory_mb > self.memory_budget_mb:
+                        # The oldest job blocked on memory goes first once memory frees up
+                        break
+                    updated = ProcessingJob.query.filter_by(id=job.id, status='queued').update(
+                        {'status': 'processing', 'started_at': now, 'worker': self.worker_id, 'heartbeat_at': now},
+                        synchronize_session=False)
+                    if not updated:
+                        continue
+                    memory_in_use += job.estimated_memory_mb
+                    running_per_user[job.user_id] += 1
+                    claimed.append(job)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logging.warning(f"Could not dispatch queued jobs: {str(e)}")
+                return set()
+            self._local.update(job.id for job in claimed)
+
+        for job in claimed:
+            waited = (job.created_at and (datetime.utcnow() - job.created_at).total_seconds()) or 0
+            if waited >= 1:
+                logging.info(f"Job {job.id} started after waiting {waited:.0f}s for ~{job.estimated_memory_mb} MB")
+            if not self.threads:
+                continue
+            thread = threading.Thread(target=self._run, args=(job.id,), name=f"job-{job.id}", daemon=True)
+            thread.start()
+        return {job.id for job in claimed}
+
+    def _run(self, job_id):
+        try:
+            self._runner(job_id)
+        except Exception as e:
+            logging.error(f"Job {job_id} failed in scheduler thread: {str(e)}")
+        finally:
+            with self._lock:
+                self._local.discard(job_id)
+            with self._app.app_context():
+                self.dispatch()
+
+    def _run_inline(self, job_ids):
+        """Run claimed jobs in this thread, then whichever queued jobs they made room for"""
+        while job_ids:
+            for job_id in sorted(job_ids):
+                try:
+                    self._runner(job_id)
+                except Exception as e:
+                    logging.error(f"Job {job_id} failed: {str(e)}")
+                finally:
+                    with self._lock:
+                        self._local.discard(job_id)
+            job_ids = self.dispatch()
+
+    def heartbeat(self):
+        """Record that this process is still running its jobs"""
+        with self._lock:
+            job_ids = list(self._local)
+        if job_ids:
+            ProcessingJob.query.filter(ProcessingJob.id.in_(job_ids), ProcessingJob.status == 'processing')\
+                               .update({'heartbeat_at': datetime.utcnow()}, synchronize_session=False)
+            db.session.commit()
+
+    def _lost(self, job, cutoff):
+        """Whether a processing job's process has stopped"""
+        host, _, pid = (job.worker or '').rpartition(':')
+        if host == socket.gethostname() and pid.isdigit() and not _process_alive(int(pid)):
+            return True
+        if not self.threads and host == socket.gethostname():
+            # No heartbeats are sent while a request runs its job
+            return False
+        return (job.heartbeat_at or job.started_at or job.created_at) < cutoff
+
+    def recover(self):
+        """
+        Mark jobs interrupted by a stopped process as 'error', and jobs left
+        queued without an estimate (their process stopped while submitting
+        them); returns the ids of the interrupted jobs
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=self.heartbeat_timeout)
+        try:
+            with self._admission_lock():
+                lost = [job for job in ProcessingJob.query.filter_by(status='processing').all()
+                        if job.id not in self._local and self._lost(job, cutoff)]
+                for job in lost:
+                    job.status = 'error'
+                    job.error_message = INTERRUPTED_MESSAGE
+                unsubmitted = ProcessingJob.query.filter(
+                    ProcessingJob.status == 'queued', ProcessingJob.estimated_memory_mb.is_(None),
+                    ProcessingJob.created_at < cutoff).update(
+                    {'status': 'error', 'error_message': INTERRUPTED_MESSAGE}, synchronize_session=False)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.warning(f"Could not recover interrupted jobs: {str(e)}")
+            return []
+
+        if lost or unsubmitted:
+            logging.warning(f"Marked {len(lost)} interrupted and {unsubmitted} unsubmitted jobs as failed")
+        for job in lost:
+            if self._interrupted is not None:
+                self._interrupted(job)
+        return [job.id for job in lost]
+
+    def start_polling(self):
+        """
+        Start this process's queue checks (once per process; a no-op until
+        configured with an app, or without threads)
+        """
+        if self._app is None or not self.threads or self._poller_pid == os.getpid():
+            return
+        with self._lock:
+            if self._poller_pid == os.getpid():
+                return
+            # Set per pid: a forked web worker starts its own
+            self._poller_pid = os.getpid()
+            self._local = set()
+        threading.Thread(target=self._poll, name='job-scheduler', daemon=True).start()
+
+    def _poll(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with self._app.app_context():
+                try:
+                    self.heartbeat()
+                    self.recover()
+                    self.dispatch()
+                except Exception as e:
+                    db.session.rollback()
+                    logging.warning(f"Job scheduler check failed: {str(e)}")
+
+scheduler = JobScheduler()
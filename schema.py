@@ -0,0 +1,166 @@
+"""
+Schema resolution for uploaded exports.
+
+Maps the headers of an upload to the canonical field names the measures look
+for ('age', 'dob', 'visit_type', 'cpt', 'diagnosis', ...) once per upload.
+Headers are normalized (case, spacing and punctuation) before matching against
+alias lists, which can be extended with a JSON file named by the
+SCHEMA_ALIASES_FILE environment variable:
+
+    {"age": ["edad", "patient years"], "cpt": ["billing code"]}
+
+Resolved mappings are cached by header fingerprint, in memory and in the JSON
+file named by SCHEMA_CACHE_FILE, so repeat uploads from the same EHR template
+skip resolution entirely.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+
+# Canonical field -> normalized aliases, in order of preference
+CANONICAL_FIELDS = {
+    'age': ['age', 'patient_age', 'pt_age', 'age_years', 'age_in_years', 'patient_age_years', 'age_at_visit',
+            'age_at_encounter', 'age_yrs'],
+    'dob': ['dob', 'date_of_birth', 'birth_date', 'birthdate', 'patient_dob', 'pt_dob', 'birth_dt'],
+    'visit_type': ['visit_type', 'encounter_type', 'appointment_type', 'appt_type', 'type_of_visit',
+                   'visit_category', 'encounter_class', 'visit_kind'],
+    'cpt': ['cpt', 'cpt_code', 'procedure_code', 'cpt_hcpcs', 'hcpcs', 'hcpcs_code', 'proc_code',
+            'cpt_codes', 'procedure_codes'],
+    'quality_code': ['quality_code', 'quality_codes', 'qdc', 'quality_data_code', 'quality_data_codes', 'cpt_ii',
+                     'cpt_ii_code', 'g_code', 'performance_code'],
+    'diagnosis': ['diagnosis', 'primary_diagnosis', 'icd', 'icd_code', 'icd10', 'icd_10', 'icd10_code',
+                  'icd_10_code', 'diagnosis_code', 'dx', 'dx_code', 'primary_dx', 'condition'],
+    'secondary_diagnosis': ['secondary_diagnosis', 'secondary_dx', 'dx2', 'diagnosis_2'],
+    'chief_complaint': ['chief_complaint', 'visit_reason', 'reason_for_visit', 'reason', 'symptoms', 'cc'],
+    'patient_id': ['patient_id', 'mrn', 'patient_number', 'medical_record_number', 'pt_id', 'patient_mrn',
+                   'person_id'],
+    'encounter_id': ['encounter_id', 'visit_id', 'encounter_number', 'visit_number', 'csn', 'encounter_no'],
+    'visit_date': ['visit_date', 'encounter_date', 'date_of_service', 'service_date', 'dos',
+                   'appointment_date', 'appt_date'],
+    'provider': ['provider', 'rendering_provider', 'provider_name', 'physician', 'clinician',
+                 'rendering_physician'],
+}
+
+CACHE_FILE = os.environ.get('SCHEMA_CACHE_FILE', os.path.join('cache', 'schema_cache.json'))
+ALIASES_FILE = os.environ.get('SCHEMA_ALIASES_FILE')
+
+_cache = {}
+_cache_lock = threading.Lock()
+_disk_cache_loaded = False
+_configured_aliases = None
+
+def normalize_header(header):
+    """'Patient Age (Years)' -> 'patient_age_years'"""
+    text = re.sub(r'[^0-9a-z]+', '_', str(header).strip().lower())
+    return text.strip('_')
+
+def load_aliases(path=ALIASES_FILE):
+    """Built-in aliases extended with the configured aliases file"""
+    aliases = {field: list(names) for field, names in CANONICAL_FIELDS.items()}
+    if not path:
+        return aliases
+    try:
+        with open(path) as f:
+            extra = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read schema aliases from {path}: {str(e)}")
+        return aliases
+    for field, names in extra.items():
+        aliases.setdefault(field, [])
+        aliases[field].extend(normalize_header(name) for name in names)
+    return aliases
+
+def header_fingerprint(columns, aliases):
+    """Stable hash of an upload's headers together with the alias configuration"""
+    payload = json.dumps([[str(c) for c in columns], aliases], sort_keys=True)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+def match_headers(columns, aliases):
+    """Return {original header: canonical field} for the best match of each field"""
+    columns = list(columns)
+    normalized = {col: normalize_header(col) for col in columns}
+    mapping = {}
+    for field, names in aliases.items():
+        # A column already named exactly like the field always wins
+        if field in columns:
+            if field not in mapping:
+                mapping[field] = field
+            continue
+        candidates = [(names.index(normalized[col]), position, col)
+                      for position, col in enumerate(columns)
+                      if col not in mapping and normalized[col] in names]
+        if candidates:
+            mapping[min(candidates)[2]] = field
+    return mapping
+
+def resolve_schema(columns, aliases=None):
+    """
+    Map input headers to canonical field names, using the fingerprint cache.
+    Returns a dict {original header: canonical field} for matched headers only.
+    """
+    global _configured_aliases
+    if aliases is None:
+        if _configured_aliases is None:
+            _configured_aliases = load_aliases()
+        aliases = _configured_aliases
+    fingerprint = header_fingerprint(columns, aliases)
+
+    with _cache_lock:
+        _load_disk_cache()
+        cached = _cache.get(fingerprint)
+    if cached is not None:
+        # JSON keys are strings; map back to the actual header objects
+        by_name = {str(col): col for col in columns}
+        return {by_name[name]: field for name, field in cached.items() if name in by_name}
+
+    mapping = match_headers(columns, aliases)
+    with _cache_lock:
+        _cache[fingerprint] = {str(col): field for col, field in mapping.items()}
+        _save_disk_cache()
+    return mapping
+
+def apply_schema(df, aliases=None):
+    """
+    Rename a DataFrame's columns to canonical names in place (no data is copied).
+    Returns the mapping {original header: canonical field}.
+    """
+    mapping = resolve_schema(df.columns, aliases)
+    if any(col != field for col, field in mapping.items()):
+        df.columns = [mapping.get(col, col) for col in df.columns]
+    if 'age' not in mapping.values() and 'dob' not in mapping.values():
+        logging.warning("No age or date of birth column recognised; measures will not be able to apply age criteria")
+    return mapping
+
+def original_headers(columns, mapping):
+    """Translate canonical column names back to the upload's original headers"""
+    inverse = {field: col for col, field in mapping.items()}
+    return [inverse.get(col, col) for col in columns]
+
+def _load_disk_cache():
+    global _disk_cache_loaded
+    if _disk_cache_loaded or not CACHE_FILE:
+        return
+    _disk_cache_loaded = True
+    try:
+        with open(CACHE_FILE) as f:
+            _cache.update(json.load(f))
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable schema cache {CACHE_FILE}: {str(e)}")
+
+def _save_disk_cache():
+    if not CACHE_FILE:
+        return
+    try:
+        os.makedirs(os.path.dirname(CACHE_FILE) or '.', exist_ok=True)
+        temp_path = f"{CACHE_FILE}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(_cache, f)
+        os.replace(temp_path, CACHE_FILE)
+    except OSError as e:
+        logging.warning(f"Could not write schema cache {CACHE_FILE}: {str(e)}")
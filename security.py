@@ -0,0 +1,150 @@
+"""
+Password hashing parameters and login throttling.
+
+Passwords are hashed with PASSWORD_HASH_METHOD, in Werkzeug's method syntax
+(default 'scrypt:32768:8:1'; e.g. 'scrypt:16384:8:1' or
+'pbkdf2:sha256:600000'). A stored hash made with other parameters still
+verifies, and is replaced by one with the current parameters at the user's
+next successful login, so changing the setting needs no migration.
+
+Failed logins are counted over a sliding window per client address and per
+username from that address. Once either is over its limit, further attempts
+are refused before any password hash is computed, so failed-login bursts
+cannot tie up worker CPU. A username alone is never locked out, since anyone
+could then lock a user out by failing their logins from elsewhere; failures
+for one username across all addresses only raise an alarm in the log.
+Counts are kept in memory, so limits apply per web worker process.
+
+The client address is the connection's unless TRUSTED_PROXIES (see app.py)
+says how many proxies in front of the app set X-Forwarded-For.
+"""
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+
+_canonical_method = None
+
+def current_method():
+    """PASSWORD_HASH_METHOD with Werkzeug's defaults filled in (e.g. 'scrypt' -> 'scrypt:32768:8:1')"""
+    global _canonical_method
+    if _canonical_method is None:
+        _canonical_method = generate_password_hash('', method=PASSWORD_HASH_METHOD).split('$', 1)[0]
+    return _canonical_method
+
+def hash_password(password):
+    return generate_password_hash(password, method=PASSWORD_HASH_METHOD)
+
+def verify_password(password_hash, password):
+    """
+    Check a password against a stored hash. Returns (valid, new_hash) where
+    new_hash replaces the stored hash when it was made with other parameters.
+    """
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if password_hash.split('$', 1)[0] != current_method():
+        return True, hash_password(password)
+    return True, None
+
+def hash_token(token):
+    """SHA-256 of an API token: only the hash is stored, so the database never holds a usable token"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+class LoginThrottle:
+    """Sliding-window count of failed logins per client address and per (address, username)"""
+
+    # Stale keys are swept once this many are tracked
+    SWEEP_THRESHOLD = 10000
+
+    def __init__(self, max_per_ip=20, max_per_username=5, window_seconds=900, username_alarm=100):
+        self.max_per_ip = max_per_ip
+        self.max_per_username = max_per_username
+        self.window_seconds = window_seconds
+        self.username_alarm = username_alarm
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_per_ip, max_per_username, window_seconds, username_alarm=100):
+        with self._lock:
+            self.max_per_ip = max_per_ip
+            self.max_per_username = max_per_username
+            self.window_seconds = window_seconds
+            self.username_alarm = username_alarm
+
+    @staticmethod
+    def _username(username):
+        return username.strip().lower() if isinstance(username, str) and username.strip() else None
+
+    def _keys(self, ip, username):
+        """(key, limit) pairs that refuse attempts once over their limit"""
+        keys = []
+        username = self._username(username)
+        if self.max_per_ip and ip:
+            keys.append((('ip', ip), self.max_per_ip))
+        if self.max_per_username and username:
+            keys.append((('ip_user', ip, username), self.max_per_username))
+        return keys
+
+    def _recent(self, key, now):
+        failures = self._failures.get(key)
+        if failures is None:
+            return None
+        while failures and failures[0] <= now - self.window_seconds:
+            failures.popleft()
+        if not failures:
+            del self._failures[key]
+            return None
+        return failures
+
+    def retry_after(self, ip, username):
+        """Seconds until another attempt is allowed, or 0 when it is allowed now"""
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for key, limit in self._keys(ip, username):
+                failures = self._recent(key, now)
+                if failures is not None and len(failures) >= limit:
+                    # Allowed again once enough failures have aged out of the window
+                    wait = max(wait, failures[-limit] + self.window_seconds - now)
+        return int(wait) + 1 if wait else 0
+
+    def failed(self, ip, username):
+        now = time.monotonic()
+        keys = self._keys(ip, username)
+        username = self._username(username)
+        if self.username_alarm and username:
+            keys.append((('user', username), self.username_alarm))
+        with self._lock:
+            if len(self._failures) >= self.SWEEP_THRESHOLD:
+                for key in list(self._failures):
+                    self._recent(key, now)
+            for key, limit in keys:
+                failures = self._failures.setdefault(key, deque())
+                failures.append(now)
+                if len(failures) == limit:
+                    if key[0] == 'user':
+                        logging.warning(f"Possible password guessing against user {username}: {limit} failed "
+                                        f"logins from any address in {self.window_seconds}s")
+                    else:
+                        logging.warning(f"Login throttled for {' '.join(key[1:])}: {limit} failures "
+                                        f"in {self.window_seconds}s")
+
+    def succeeded(self, ip, username):
+        """
+        Forget the failures of this username from this address. The address
+        keeps its own count, so logging in to one account does not reset
+        guessing against others.
+        """
+        username = self._username(username)
+        if username:
+            with self._lock:
+                self._failures.pop(('ip_user', ip, username), None)
+
+login_throttle = LoginThrottle()
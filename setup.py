@@ -39,7 +39,7 @@ SESSION_SECRET=mips-filter-secret-key-change-this-in-production
 DATABASE_URL=sqlite:///mips_filter.db
 UPLOAD_FOLDER=uploads
 DOWNLOAD_FOLDER=downloads
-MAX_CONTENT_LENGTH=16777216
+MAX_FILE_SIZE=16777216
 """
         with open(env_file, 'w') as f:
             f.write(env_content)
@@ -0,0 +1,148 @@
+"""
+Zero-copy DataFrame handoff to other processes through shared memory.
+
+SharedFrame.create(df) lays the frame out once in a single
+multiprocessing.shared_memory segment: a pickled header describing the
+columns, followed by one aligned buffer per column. Numeric, boolean and
+datetime columns are stored as their raw values, categoricals as their codes,
+and text as integer codes into the column's distinct values. Another process
+attaches by segment name only; numeric columns then read straight from the
+shared pages, so no per-task pickling of the frame is needed. Text columns are
+rebuilt from their codes on attach (Python strings cannot live in shared
+memory), which is still much cheaper than unpickling the column.
+
+The creator owns the segment and must call unlink() once every reader is
+done; readers call close(). Use both as context managers.
+"""
+
+import pickle
+import struct
+import logging
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import pandas as pd
+
+ALIGNMENT = 64
+_HEADER_LENGTH = struct.Struct('<Q')
+
+def _aligned(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _column_layout(series):
+    """(kind, metadata, buffer) for one column"""
+    dtype = series.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        return 'category', {'categories': list(dtype.categories), 'ordered': dtype.ordered,
+                            'categories_dtype': dtype.categories.dtype}, series.cat.codes.to_numpy()
+    if isinstance(dtype, np.dtype) and dtype.kind in 'biufcmM':
+        return 'array', {}, np.ascontiguousarray(series.to_numpy())
+    # Text, mixed objects and extension types: codes into the distinct values
+    codes, uniques = pd.factorize(series)
+    return 'factorized', {'uniques': list(uniques), 'values_dtype': dtype}, codes.astype(np.int32)
+
+class SharedFrame:
+    """A DataFrame laid out in one shared memory segment"""
+
+    def __init__(self, shm, header, owner):
+        self.shm = shm
+        self.header = header
+        self.owner = owner
+        self.name = shm.name
+
+    @classmethod
+    def create(cls, df):
+        """Copy df into a new segment; the caller owns it"""
+        columns, buffers = [], []
+        for position, column in enumerate(df.columns):
+            kind, meta, values = _column_layout(df.iloc[:, position])
+            columns.append({'name': column, 'kind': kind, 'buffer_dtype': values.dtype.str, **meta})
+            buffers.append(values)
+
+        # Header size depends on the offsets it records, so lay out buffers
+        # after a generous header estimate and grow it if needed
+        header = {'rows': len(df), 'index': None if isinstance(df.index, pd.RangeIndex) and
+                  df.index.start == 0 and df.index.step == 1 else df.index, 'columns': columns}
+        reserved = len(pickle.dumps(header)) + 1024
+        while True:
+            offset = _aligned(_HEADER_LENGTH.size + reserved)
+            for column, values in zip(columns, buffers):
+                column['offset'] = offset
+                column['nbytes'] = values.nbytes
+                offset = _aligned(offset + values.nbytes)
+            payload = pickle.dumps(header, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(payload) <= reserved:
+                break
+            reserved = len(payload) + 1024
+
+        shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        _HEADER_LENGTH.pack_into(shm.buf, 0, len(payload))
+        shm.buf[_HEADER_LENGTH.size:_HEADER_LENGTH.size + len(payload)] = payload
+        for column, values in zip(columns, buffers):
+            target = np.ndarray(values.shape, dtype=values.dtype, buffer=shm.buf, offset=column['offset'])
+            target[...] = values
+        logging.info(f"Shared {len(df)} rows x {len(columns)} columns in {shm.size / 1048576:.1f} MB ({shm.name})")
+        return cls(shm, header, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        """Open a segment created by another process"""
+        # Python < 3.13 registers attached segments with the resource tracker,
+        # which would unlink them when this process exits; only the creator may
+        register = resource_tracker.register
+        resource_tracker.register = lambda *args, **kwargs: None
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+        (length,) = _HEADER_LENGTH.unpack_from(shm.buf, 0)
+        header = pickle.loads(shm.buf[_HEADER_LENGTH.size:_HEADER_LENGTH.size + length])
+        return cls(shm, header, owner=False)
+
+    def _buffer(self, column):
+        dtype = np.dtype(column['buffer_dtype'])
+        return np.ndarray((column['nbytes'] // dtype.itemsize,), dtype=dtype, buffer=self.shm.buf, offset=column['offset'])
+
+    def to_frame(self):
+        """The DataFrame; numeric columns are views of the shared pages, valid until close()"""
+        data = {}
+        for column in self.header['columns']:
+            values = self._buffer(column)
+            if column['kind'] == 'array':
+                data[column['name']] = values
+            elif column['kind'] == 'category':
+                dtype = pd.CategoricalDtype(pd.Index(column['categories'], dtype=column['categories_dtype']),
+                                            ordered=column['ordered'])
+                data[column['name']] = pd.Categorical.from_codes(values, dtype=dtype)
+            else:
+                uniques = np.empty(len(column['uniques']) + 1, dtype=object)
+                uniques[:-1] = column['uniques']
+                uniques[-1] = np.nan
+                # Code -1 (missing) picks the trailing NaN
+                data[column['name']] = pd.array(uniques[values], dtype=column['values_dtype'])
+        index = self.header['index']
+        if index is None:
+            index = pd.RangeIndex(self.header['rows'])
+        return pd.DataFrame(data, index=index, copy=False)
+
+    def close(self):
+        try:
+            self.shm.close()
+        except BufferError:
+            # A frame built by to_frame() is still alive; the mapping goes with the process
+            logging.warning(f"Shared frame {self.name} still in use; leaving it mapped")
+
+    def unlink(self):
+        """Free the segment (creator only)"""
+        self.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.owner:
+            self.unlink()
+        else:
+            self.close()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Startup-time report for the MIPS Measure Filter application.
+Boots the app in a fresh interpreter (as a gunicorn or Passenger worker would),
+then reports the slowest imports, the create_app() phase timings, and whether
+heavy processing libraries were loaded eagerly.
+
+Usage:
+    python startup_report.py                 # report only
+    python startup_report.py --budget-ms 800 # exit non-zero if boot is slower
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import subprocess
+
+# Libraries that should only be imported when a job runs
+HEAVY_MODULES = ['pandas', 'numpy', 'openpyxl']
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import main
+total = time.perf_counter() - started
+print('STARTUP_REPORT ' + json.dumps({
+    'total_ms': round(total * 1000, 1),
+    'phases': main.app.config.get('STARTUP_TIMINGS', {}),
+    'loaded': sorted(m for m in %r if m in sys.modules),
+}))
+""" % (HEAVY_MODULES,)
+
+def parse_importtime(stderr, top):
+    """Return the third-party/stdlib packages with the largest cumulative import time (ms)"""
+    project_modules = {os.path.splitext(name)[0] for name in os.listdir(os.path.dirname(os.path.abspath(__file__)))}
+    packages = {}
+    for line in stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \| *(\S+)', line)
+        if not match:
+            continue
+        package = match.group(3).split('.')[0]
+        if package in project_modules:
+            continue
+        # Keep the outermost (largest) cumulative time seen for each package
+        packages[package] = max(packages.get(package, 0), int(match.group(2)) / 1000)
+    return sorted(((ms, name) for name, ms in packages.items()), reverse=True)[:top]
+
+def main():
+    parser = argparse.ArgumentParser(description='Report application startup time.')
+    parser.add_argument('--budget-ms', type=float, help='Fail if total startup exceeds this many milliseconds')
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest imports to show')
+    args = parser.parse_args()
+    
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE],
+        cwd=project_dir, capture_output=True, text=True
+    )
+    report_line = next((line for line in completed.stdout.splitlines() if line.startswith('STARTUP_REPORT ')), None)
+    if completed.returncode != 0 or report_line is None:
+        print('Application failed to start:', file=sys.stderr)
+        print(completed.stderr[-2000:], file=sys.stderr)
+        return 2
+    
+    report = json.loads(report_line[len('STARTUP_REPORT '):])
+    print(f"Total startup: {report['total_ms']} ms")
+    print("\ncreate_app() phases:")
+    for phase, ms in report['phases'].items():
+        print(f"  {phase:<12} {ms:>8} ms")
+    
+    print("\nSlowest imported packages:")
+    for ms, module in parse_importtime(completed.stderr, args.top):
+        print(f"  {module:<30} {ms:>8.1f} ms")
+    
+    if report['loaded']:
+        print(f"\nWARNING: heavy modules imported at startup: {', '.join(report['loaded'])}")
+    else:
+        print(f"\nHeavy modules deferred: {', '.join(HEAVY_MODULES)}")
+    
+    if args.budget_ms is not None and report['total_ms'] > args.budget_ms:
+        print(f"\nFAIL: startup {report['total_ms']} ms exceeds budget {args.budget_ms} ms")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
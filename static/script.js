@@ -15,6 +15,9 @@ document.addEventListener('DOMContentLoaded', function() {
     
     // Form submission handling
     initializeFormHandling();
+    
+    // Result preview table
+    initializePreview();
 });
 
 function initializeFileUpload() {
@@ -22,11 +25,14 @@ function initializeFileUpload() {
     const fileInput = document.getElementById('fileInput');
     const uploadPlaceholder = document.getElementById('uploadPlaceholder');
     const uploadInfo = document.getElementById('uploadInfo');
-    const fileName = document.getElementById('fileName');
-    const fileSize = document.getElementById('fileSize');
+    const fileList = document.getElementById('fileList');
 
     if (!uploadArea || !fileInput) return;
 
+    // Per-file size and file count limits (0 = unlimited)
+    const maxSize = parseInt(uploadArea.dataset.maxSize, 10) || 0;
+    const maxFiles = parseInt(uploadArea.dataset.maxFiles, 10) || 0;
+
     // Drag and drop functionality
     uploadArea.addEventListener('dragover', function(e) {
         e.preventDefault();
@@ -44,12 +50,12 @@ function initializeFileUpload() {
         
         const files = e.dataTransfer.files;
         if (files.length > 0) {
-            const file = files[0];
-            if (isValidExcelFile(file)) {
-                fileInput.files = files;
-                displayFileInfo(file);
+            const error = validateFiles(files);
+            if (error) {
+                alert(error);
             } else {
-                alert('Please select a valid Excel file (.xlsx or .xls)');
+                fileInput.files = files;
+                displayFileInfo(files);
             }
         }
     });
@@ -57,12 +63,13 @@ function initializeFileUpload() {
     // File input change
     fileInput.addEventListener('change', function() {
         if (fileInput.files.length > 0) {
-            const file = fileInput.files[0];
-            if (isValidExcelFile(file)) {
-                displayFileInfo(file);
-            } else {
-                alert('Please select a valid Excel file (.xlsx or .xls)');
+            const error = validateFiles(fileInput.files);
+            if (error) {
+                alert(error);
                 fileInput.value = '';
+                hideFileInfo();
+            } else {
+                displayFileInfo(fileInput.files);
             }
         } else {
             hideFileInfo();
@@ -80,10 +87,34 @@ function initializeFileUpload() {
                validExtensions.some(ext => file.name.toLowerCase().endsWith(ext));
     }
 
-    function displayFileInfo(file) {
-        if (fileName && fileSize && uploadPlaceholder && uploadInfo) {
-            fileName.textContent = file.name;
-            fileSize.textContent = formatFileSize(file.size);
+    // Returns why the selected files cannot be uploaded, or null
+    function validateFiles(files) {
+        if (maxFiles && files.length > maxFiles) {
+            return `Please select at most ${maxFiles} files`;
+        }
+        for (const file of files) {
+            if (!isValidExcelFile(file)) {
+                return `${file.name} is not a valid Excel file (.xlsx or .xls)`;
+            }
+            if (maxSize && file.size > maxSize) {
+                return `${file.name} is too large (maximum ${formatFileSize(maxSize)} per file)`;
+            }
+        }
+        return null;
+    }
+
+    function displayFileInfo(files) {
+        if (fileList && uploadPlaceholder && uploadInfo) {
+            fileList.innerHTML = '';
+            for (const file of files) {
+                const item = document.createElement('li');
+                item.textContent = file.name + ' ';
+                const size = document.createElement('small');
+                size.className = 'text-muted';
+                size.textContent = formatFileSize(file.size);
+                item.appendChild(size);
+                fileList.appendChild(item);
+            }
             uploadPlaceholder.style.display = 'none';
             uploadInfo.style.display = 'block';
         }
@@ -245,19 +276,160 @@ function showAlert(message, type = 'info') {
     }
 }
 
-// Auto-refresh functionality for job status (if needed)
-function initializeStatusRefresh() {
-    const statusElements = document.querySelectorAll('[data-status="processing"]');
+// Live job progress via Server-Sent Events
+function initializeJobProgress() {
+    const jobRows = document.querySelectorAll('tr[data-status="queued"][data-events-url], tr[data-status="processing"][data-events-url]');
     
-    if (statusElements.length > 0) {
-        // Refresh page every 30 seconds if there are processing jobs
-        setTimeout(() => {
-            window.location.reload();
-        }, 30000);
+    if (!window.EventSource) return;
+    
+    jobRows.forEach(row => {
+        const source = new EventSource(row.dataset.eventsUrl);
+        const progressBar = row.querySelector('.job-progress .progress-bar');
+        const progressText = row.querySelector('.job-progress-text');
+        const stageLabels = {
+            queued: 'Waiting for a processing slot...',
+            started: 'Starting...',
+            reading: 'Reading file...',
+            joining: 'Joining patients to encounters...',
+            compacted: 'Preparing data...',
+            filtering: 'Applying measures...',
+            writing: 'Writing report...'
+        };
+        
+        function setProgress(percent, text) {
+            if (progressBar && percent !== null) progressBar.style.width = percent + '%';
+            if (progressText) progressText.textContent = text;
+        }
+        
+        source.addEventListener('stage', function(e) {
+            const data = JSON.parse(e.data);
+            let text = stageLabels[data.stage] || data.stage;
+            if (data.stage === 'filtering' && data.rows !== undefined) {
+                text = `Applying ${data.measures} measure(s) to ${data.rows.toLocaleString()} rows...`;
+            } else if (data.stage === 'incremental') {
+                text = `${data.changed_rows.toLocaleString()} of ${data.rows.toLocaleString()} rows new or changed`;
+            }
+            if (data.stage === 'started') {
+                const badge = row.querySelector('.job-state');
+                if (badge) {
+                    badge.classList.replace('bg-info', 'bg-warning');
+                    badge.lastChild.textContent = ' Processing';
+                }
+                row.dataset.status = 'processing';
+            }
+            setProgress(data.stage === 'writing' ? 95 : null, text);
+        });
+        
+        source.addEventListener('measure', function(e) {
+            const data = JSON.parse(e.data);
+            const percent = Math.round(90 * data.position / data.total);
+            setProgress(percent, `Measure ${data.measure}: ${data.eligible} eligible (${data.position}/${data.total})`);
+        });
+        
+        source.addEventListener('completed', function(e) {
+            source.close();
+            row.dataset.status = 'completed';
+            row.querySelector('.job-status').innerHTML =
+                '<span class="badge bg-success"><i data-feather="check" width="12" height="12" class="me-1"></i>Completed</span>';
+            row.querySelector('.job-actions').innerHTML =
+                `<a href="${row.dataset.downloadUrl}" class="btn btn-sm btn-outline-primary">` +
+                '<i data-feather="download" width="14" height="14" class="me-1"></i>Download</a> ' +
+                `<a href="${row.dataset.previewUrl}" class="btn btn-sm btn-outline-secondary">` +
+                '<i data-feather="eye" width="14" height="14" class="me-1"></i>Preview</a> ' +
+                `<a href="${row.dataset.traceUrl}" class="btn btn-sm btn-outline-secondary">` +
+                '<i data-feather="list" width="14" height="14" class="me-1"></i>Trace</a>';
+            feather.replace();
+        });
+        
+        source.addEventListener('error', function(e) {
+            // Connection errors carry no data; EventSource reconnects on its own
+            if (!e.data) return;
+            source.close();
+            const data = JSON.parse(e.data);
+            row.dataset.status = 'error';
+            row.querySelector('.job-status').innerHTML =
+                '<span class="badge bg-danger"><i data-feather="x" width="12" height="12" class="me-1"></i>Error</span>';
+            row.querySelector('.job-actions').innerHTML =
+                '<span class="text-danger small"></span>';
+            row.querySelector('.job-actions span').textContent = data.error || 'Processing failed';
+            feather.replace();
+        });
+    });
+}
+
+// Paginated, sortable result preview
+function initializePreview() {
+    const preview = document.getElementById('preview');
+    if (!preview) return;
+    
+    const measureSelect = document.getElementById('previewMeasure');
+    const head = document.getElementById('previewHead');
+    const body = document.getElementById('previewBody');
+    const info = document.getElementById('previewInfo');
+    const prevButton = document.getElementById('previewPrev');
+    const nextButton = document.getElementById('previewNext');
+    const state = {page: 1, pages: 1, sort: '', order: 'asc'};
+    
+    function load() {
+        const params = new URLSearchParams({page: state.page, measure: measureSelect.value});
+        if (state.sort) {
+            params.set('sort', state.sort);
+            params.set('order', state.order);
+        }
+        fetch(`${preview.dataset.url}?${params}`)
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) {
+                    info.textContent = data.error;
+                    return;
+                }
+                state.page = data.page;
+                state.pages = data.pages;
+                render(data);
+            });
     }
+    
+    function render(data) {
+        head.innerHTML = '<th class="text-muted">Row</th>';
+        data.columns.forEach(column => {
+            const th = document.createElement('th');
+            th.textContent = column + (column === state.sort ? (state.order === 'asc' ? ' \u25B2' : ' \u25BC') : '');
+            th.classList.add('sortable');
+            th.addEventListener('click', () => {
+                state.order = state.sort === column && state.order === 'asc' ? 'desc' : 'asc';
+                state.sort = column;
+                state.page = 1;
+                load();
+            });
+            head.appendChild(th);
+        });
+        
+        body.innerHTML = '';
+        data.rows.forEach((values, index) => {
+            const tr = document.createElement('tr');
+            [data.row_numbers[index]].concat(values).forEach((value, position) => {
+                const td = document.createElement('td');
+                td.textContent = value === null ? '' : value;
+                if (position === 0) td.classList.add('text-muted');
+                tr.appendChild(td);
+            });
+            body.appendChild(tr);
+        });
+        
+        const first = data.total ? (data.page - 1) * data.per_page + 1 : 0;
+        const last = Math.min(data.page * data.per_page, data.total);
+        info.textContent = `${first}-${last} of ${data.total.toLocaleString()} (page ${data.page}/${data.pages})`;
+        prevButton.disabled = data.page <= 1;
+        nextButton.disabled = data.page >= data.pages;
+    }
+    
+    measureSelect.addEventListener('change', () => { state.page = 1; load(); });
+    prevButton.addEventListener('click', () => { state.page -= 1; load(); });
+    nextButton.addEventListener('click', () => { state.page += 1; load(); });
+    load();
 }
 
-// Initialize status refresh on dashboard
-if (window.location.pathname.includes('dashboard')) {
-    initializeStatusRefresh();
+// Initialize progress streams on the job lists
+if (window.location.pathname.includes('dashboard') || window.location.pathname.endsWith('/jobs')) {
+    document.addEventListener('DOMContentLoaded', initializeJobProgress);
 }
@@ -0,0 +1,168 @@
+"""
+Content-addressed upload storage.
+
+Uploads are stored under the SHA-256 of their content (plus the original
+extension, which selects the Excel engine), so a file sent again - the same
+monthly export submitted by the web form and the API, or re-submitted after
+a failed job - is stored once. The upload is hashed straight from the
+request stream; when that content is already stored nothing is written.
+The name the file was sent as is kept on the job (ProcessingJob.upload_names),
+and since the stored name is a function of the content, anything keyed on an
+upload's path is keyed on its content.
+
+Each stored upload counts the queued and running jobs that read it. Uploads
+no job needs any more are deleted once they have been idle for
+UPLOAD_RETENTION_HOURS, which also covers files uploaded through the web form
+but never processed. Storing a file and pruning one hold the same lock (a
+file in the upload folder, shared by every process), so a prune never deletes
+a file that the same content was just stored to again. Counts left above zero
+by jobs that ended without releasing them (a process killed mid-job) are
+reset when no queued or running job reads the upload.
+"""
+
+import os
+import uuid
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import secure_filename
+
+from app import db
+from models import StoredUpload, ProcessingJob
+from utils import file_lock
+
+CHUNK_SIZE = 1024 * 1024
+# In the upload folder; held while a stored file is written or deleted
+LOCK_FILE = '.store.lock'
+# Seconds between sweeps for unreferenced uploads (per process)
+PRUNE_INTERVAL = 600
+
+_last_prune = 0.0
+_prune_lock = threading.Lock()
+
+def content_hash(stream):
+    """(hex SHA-256, size) of a seekable stream, which is left at its start"""
+    digest = hashlib.sha256()
+    size = 0
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+        size += len(chunk)
+    stream.seek(0)
+    return digest.hexdigest(), size
+
+def _touch(filename):
+    """Mark a stored upload as just used; False when it has no record"""
+    updated = StoredUpload.query.filter_by(filename=filename).update({'last_used_at': datetime.utcnow()})
+    db.session.commit()
+    return updated > 0
+
+def store(file, folder):
+    """
+    Store an uploaded file (werkzeug FileStorage) by content and return its
+    stored name. Content that is already stored is not written again.
+    """
+    sha256, size = content_hash(file.stream)
+    extension = os.path.splitext(secure_filename(file.filename))[1].lower()
+    filename = f"{sha256}{extension}"
+    path = os.path.join(folder, filename)
+    os.makedirs(folder, exist_ok=True)
+
+    # Write beside the target first, so a stored name always holds the complete file
+    temp_path = os.path.join(folder, f".{uuid.uuid4().hex}.tmp")
+    try:
+        with file_lock(os.path.join(folder, LOCK_FILE)):
+            # prune deletes the record and then the file under this lock, so
+            # neither can disappear between this check and the commit below
+            if _touch(filename) and os.path.exists(path):
+                logging.info(f"Upload {file.filename} is already stored as {filename}")
+                return filename
+            file.save(temp_path)
+            os.replace(temp_path, path)
+            try:
+                db.session.add(StoredUpload(filename=filename, sha256=sha256, size=size))
+                db.session.commit()
+            except IntegrityError:
+                # The record outlived its file
+                db.session.rollback()
+                _touch(filename)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    logging.info(f"Stored upload {file.filename} as {filename} ({size} bytes)")
+    return filename
+
+def acquire(filenames):
+    """Count a job as reading these stored uploads (names without a record are ignored)"""
+    names = sorted(set(filenames))
+    if names:
+        StoredUpload.query.filter(StoredUpload.filename.in_(names)).update(
+            {'ref_count': StoredUpload.ref_count + 1}, synchronize_session=False)
+        db.session.commit()
+
+def release(filenames):
+    """Undo acquire once the job no longer needs its uploads"""
+    names = sorted(set(filenames))
+    if names:
+        StoredUpload.query.filter(StoredUpload.filename.in_(names), StoredUpload.ref_count > 0).update(
+            {'ref_count': StoredUpload.ref_count - 1, 'last_used_at': datetime.utcnow()},
+            synchronize_session=False)
+        db.session.commit()
+
+def release_stuck(cutoff):
+    """Reset the counts of uploads idle since cutoff that no queued or running job reads; returns the count"""
+    active = ProcessingJob.query.filter(ProcessingJob.status.in_(('pending', 'queued', 'processing'))).all()
+    needed = sorted({name for job in active for name in job.uploads()})
+    stuck = StoredUpload.query.filter(StoredUpload.ref_count > 0, StoredUpload.last_used_at < cutoff,
+                                      StoredUpload.filename.notin_(needed))\
+                              .update({'ref_count': 0}, synchronize_session=False)
+    db.session.commit()
+    if stuck:
+        logging.warning(f"Reset the job counts of {stuck} uploads no queued or running job reads")
+    return stuck
+
+def prune(folder, retention_hours):
+    """Delete uploads no job reads that have been idle for retention_hours; returns the count"""
+    cutoff = datetime.utcnow() - timedelta(hours=retention_hours)
+    release_stuck(cutoff)
+    idle = [row.filename for row in StoredUpload.query.filter(
+        StoredUpload.ref_count == 0, StoredUpload.last_used_at < cutoff).all()]
+    removed = 0
+    if idle:
+        os.makedirs(folder, exist_ok=True)
+    for filename in idle:
+        with file_lock(os.path.join(folder, LOCK_FILE)):
+            # Re-check in the delete itself: a job or upload may have claimed it meanwhile
+            deleted = StoredUpload.query.filter(
+                StoredUpload.filename == filename, StoredUpload.ref_count == 0,
+                StoredUpload.last_used_at < cutoff).delete(synchronize_session=False)
+            db.session.commit()
+            if deleted:
+                try:
+                    os.remove(os.path.join(folder, filename))
+                except FileNotFoundError:
+                    pass
+                removed += 1
+    if removed:
+        logging.info(f"Removed {removed} unreferenced uploads idle for over {retention_hours} hours")
+    return removed
+
+def prune_if_due(folder, retention_hours):
+    """prune at most once per PRUNE_INTERVAL in this process (0 hours keeps everything)"""
+    global _last_prune
+    if retention_hours <= 0:
+        return 0
+    with _prune_lock:
+        now = datetime.utcnow().timestamp()
+        if now - _last_prune < PRUNE_INTERVAL:
+            return 0
+        _last_prune = now
+    try:
+        return prune(folder, retention_hours)
+    except Exception as e:
+        db.session.rollback()
+        logging.warning(f"Could not prune stored uploads: {str(e)}")
+        return 0
@@ -1,29 +1,60 @@
 import os
-import pandas as pd
 import logging
+import threading
 from datetime import datetime
-from openpyxl import Workbook
-from openpyxl.utils.dataframe import dataframe_to_rows
+from contextlib import contextmanager
 import importlib.util
 import sys
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# pandas and openpyxl are imported inside the processing functions so that
+# importing this module (and therefore the web app) stays fast; they are only
+# paid for when a job actually runs.
+
 ALLOWED_EXTENSIONS = {'xlsx', 'xls'}
+_file_lock_fallback = threading.Lock()
+MEASURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'measures')
 
 def allowed_file(filename):
     """Check if file has allowed extension"""
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+def upload_size(file):
+    """Size in bytes of an uploaded file (werkzeug FileStorage), leaving its stream at the start"""
+    file.stream.seek(0, os.SEEK_END)
+    size = file.stream.tell()
+    file.stream.seek(0)
+    return size
+
+# Loaded measure modules keyed by script path: (modification time, module)
+_measure_modules = {}
+
+def load_measure_module(measure_number):
+    """Load (or reuse) the module of a measure script"""
+    script_path = os.path.join(MEASURES_DIR, f'{measure_number}.py')
+    if not os.path.exists(script_path):
+        raise FileNotFoundError(f"Measure script {measure_number}.py not found")
+    
+    # Reuse the loaded module unless the script changed on disk
+    mtime = os.path.getmtime(script_path)
+    cached = _measure_modules.get(script_path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    spec = importlib.util.spec_from_file_location(f"measure_{measure_number}", script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    _measure_modules[script_path] = (mtime, module)
+    return module
+
 def load_measure_script(measure_number):
     """Dynamically load and return the measure processing function"""
     try:
-        script_path = os.path.join('measures', f'{measure_number}.py')
-        if not os.path.exists(script_path):
-            raise FileNotFoundError(f"Measure script {measure_number}.py not found")
-        
-        spec = importlib.util.spec_from_file_location(f"measure_{measure_number}", script_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+        module = load_measure_module(measure_number)
         
         # Look for the main processing function
         if hasattr(module, 'filter_patients'):
@@ -37,19 +68,344 @@ def load_measure_script(measure_number):
         logging.error(f"Error loading measure {measure_number}: {str(e)}")
         raise
 
-def process_excel_file(filepath, selected_measures, download_folder):
+# Hidden column used to map a measure's output rows back to input rows
+ROW_ID_COLUMN = '__row_id'
+
+def evaluate_measure_rows(filter_function, df):
+    """
+    Run a measure's filter function and return (filtered_df, row_ids), where
+    row_ids are the positions in df of the output rows (None if the measure
+    dropped them)
+    """
+    import numpy as np
+    
+    # Shallow copy: the measures make their own copy, the row id column is all we add
+    tagged = df.copy(deep=False)
+    tagged[ROW_ID_COLUMN] = np.arange(len(df))
+    filtered_df = filter_function(tagged)
+    
+    if ROW_ID_COLUMN not in filtered_df.columns:
+        return filtered_df, None
+    row_ids = filtered_df[ROW_ID_COLUMN].dropna().astype(np.int64).to_numpy()
+    return filtered_df.drop(columns=[ROW_ID_COLUMN]), row_ids
+
+def evaluate_measure(filter_function, df):
+    """
+    Run a measure's filter function and return (filtered_df, mask), where mask
+    is a boolean numpy array aligned with the rows of df
+    """
+    import numpy as np
+    
+    filtered_df, row_ids = evaluate_measure_rows(filter_function, df)
+    mask = np.zeros(len(df), dtype=bool)
+    if row_ids is not None:
+        mask[row_ids] = True
+    return filtered_df, mask
+
+def derived_columns(filtered_df, df):
+    """Columns a measure added to its output rows (e.g. calculated_age) or converted to another dtype"""
+    return [column for column in filtered_df.columns
+            if column not in df.columns or filtered_df[column].dtype != df[column].dtype]
+
+def assemble_rows(df, row_ids, derived, columns):
+    """
+    Rebuild a measure's output rows from df: the rows at row_ids, with the
+    columns the measure derived, in the measure's column order
+    """
+    if row_ids is None:
+        # The measure did not keep row ids; derived holds its whole output
+        return derived
+    rows = df.iloc[row_ids].reset_index(drop=True)
+    for column in derived.columns:
+        rows[column] = derived[column].to_numpy()
+    return rows[columns]
+
+# Measures evaluated in parallel processes over a shared-memory copy of the
+# frame; 1 evaluates them one after another in the job's own process
+MEASURE_WORKERS = int(os.environ.get('MEASURE_WORKERS', 1))
+# Below this many rows, sharing the frame and starting workers costs more than
+# the measures take (about 5 s per million rows for all six; parallel_benchmark.py)
+PARALLEL_MIN_ROWS = int(os.environ.get('MEASURE_PARALLEL_MIN_ROWS', 200000))
+
+# Imported once by the fork server worker processes are started from, so they
+# start with pandas and the processing modules loaded instead of importing them
+FORKSERVER_PRELOAD = ['pandas', 'openpyxl', 'openpyxl.utils.dataframe', 'utils', 'reader', 'ingest',
+                      'sharedframe', 'bitsets', 'explain', 'dates', 'measures', 'workers']
+
+def process_context():
+    """
+    multiprocessing context for worker processes: a preloaded fork server, else
+    spawn. A fresh process per worker; forking a threaded web process is unsafe.
+    """
+    import multiprocessing
+    
+    if 'forkserver' not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('spawn')
+    context = multiprocessing.get_context('forkserver')
+    # Only takes effect when the fork server starts, so the first caller's list wins
+    context.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return context
+
+@contextmanager
+def file_lock(path):
+    """
+    Exclusive lock between processes on path (created if missing). Without
+    fcntl (Windows) it only excludes the other threads of this process.
+    """
+    if fcntl is None:
+        with _file_lock_fallback:
+            yield
+        return
+    with open(path, 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def available_cpus():
+    """CPUs this process may run on; more measure workers than that only add overhead"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def _evaluate_shared(task):
+    """
+    Worker entry point: evaluate one measure on a shared frame. Returns
+    (packed mask, error, filter steps, output) where output is (row ids,
+    derived columns of those rows, column order) for assemble_rows, so the
+    parent writes the same sheet as a sequential run without receiving a copy
+    of the rows.
+    """
+    import numpy as np
+    from sharedframe import SharedFrame
+    from dates import use_reporting_date
+    from bitsets import pack_mask
+    from explain import trace_steps
+    
+    name, measure, reporting_date = task
+    shared = SharedFrame.attach(name)
+    try:
+        df = shared.to_frame()
+        try:
+            with trace_steps() as steps, use_reporting_date(reporting_date):
+                filtered_df, row_ids = evaluate_measure_rows(load_measure_script(measure), df)
+            mask = np.zeros(len(df), dtype=bool)
+            if row_ids is None:
+                output = (None, filtered_df, list(filtered_df.columns))
+            else:
+                mask[row_ids] = True
+                derived = filtered_df[derived_columns(filtered_df, df)].reset_index(drop=True)
+                output = (row_ids, derived, list(filtered_df.columns))
+            return pack_mask(mask), None, steps, output
+        except Exception as e:
+            return None, str(e), steps, None
+        finally:
+            del df
+    finally:
+        shared.close()
+
+def evaluate_in_parallel(df, measures, reporting_date):
     """
-    Process the uploaded Excel file with selected measures
+    Evaluate measures in worker processes that attach to one shared copy of df.
+    Returns {measure: (mask, error, steps, output)} (see _evaluate_shared), or None when parallel evaluation does
+    not apply (one worker, measure or CPU, a small frame, or no child processes).
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    from concurrent.futures.process import BrokenProcessPool
+    from sharedframe import SharedFrame
+    from bitsets import unpack_mask
+    
+    workers = min(MEASURE_WORKERS, len(measures), available_cpus())
+    if workers <= 1 or len(df) < PARALLEL_MIN_ROWS or multiprocessing.current_process().daemon:
+        return None
+    
+    try:
+        with SharedFrame.create(df) as shared:
+            tasks = [(shared.name, measure, reporting_date) for measure in measures]
+            with ProcessPoolExecutor(max_workers=workers, mp_context=process_context()) as executor:
+                results = list(executor.map(_evaluate_shared, tasks))
+    except (OSError, BrokenProcessPool) as e:
+        logging.warning(f"Parallel measure evaluation unavailable, evaluating sequentially: {str(e)}")
+        return None
+    return {measure: (unpack_mask(bits, len(df)) if bits is not None else None, error, steps, output)
+            for measure, (bits, error, steps, output) in zip(measures, results)}
+
+def append_frame(sheet, frame, schema_mapping=None):
+    """Append a DataFrame to a worksheet, writing the upload's original headers"""
+    from openpyxl.utils.dataframe import dataframe_to_rows
+    from schema import original_headers
+    
+    rows = dataframe_to_rows(frame, index=False, header=True)
+    header = next(rows)
+    sheet.append(original_headers(header, schema_mapping) if schema_mapping else header)
+    for row in rows:
+        sheet.append(row)
+
+def add_rollup_counts(summary_data, df, measure_masks):
+    """Add unique-patient and encounter counts to the summary rows"""
+    from rollup import rollup_counts
+    
+    rollup = rollup_counts(df, measure_masks)
+    for entry in summary_data:
+        measure = entry['Measure'].replace('Measure ', '', 1)
+        counts = rollup['measures'].get(measure)
+        row = {'Measure': entry['Measure'], 'Eligible Patients': entry['Eligible Patients']}
+        if rollup['patient_column']:
+            row['Unique Patients'] = counts['unique_patients'] if counts else 'Error'
+        if rollup['encounter_column']:
+            row['Encounters'] = counts['encounters'] if counts else 'Error'
+        row['Total Patients'] = entry['Total Patients']
+        if rollup['patient_column']:
+            row['Total Unique Patients'] = rollup['total_patients']
+        # Keep the summary rows' identity (and column order) for callers holding them
+        entry.clear()
+        entry.update(row)
+    return rollup
+
+def add_performance_rates(summary_data, df, measure_masks):
+    """
+    Add exclusion, numerator and performance rate (percent) columns to the
+    summary rows of the measures that declare numerator or exclusion codes,
+    or 'N/A' when df has no codes to look up. The criteria of all measures are
+    evaluated together in one pass over df.
+    """
+    from criteria import measure_criteria, evaluate_criteria, performance_counts, reports_codes
+    
+    criteria = {}
+    for measure in measure_masks:
+        try:
+            declared = measure_criteria(load_measure_module(measure))
+        except Exception as e:
+            logging.warning(f"Could not read the criteria of measure {measure}: {str(e)}")
+            continue
+        if declared is not None:
+            criteria[measure] = declared
+    if not criteria:
+        return {}
+    if not reports_codes(df):
+        # Without codes every numerator would be 0: the rate is unknown, not 0%
+        logging.warning("No quality or CPT codes in the upload; performance rates are not available")
+        for entry in summary_data:
+            if entry['Eligible Patients'] == 'Error':
+                entry['Exclusions'] = entry['Numerator'] = entry['Performance Rate'] = 'Error'
+            elif entry['Measure'].replace('Measure ', '', 1) in criteria:
+                entry['Exclusions'] = entry['Numerator'] = entry['Performance Rate'] = 'N/A'
+            else:
+                entry['Exclusions'] = entry['Numerator'] = entry['Performance Rate'] = None
+        return {}
+    
+    masks = evaluate_criteria(df, criteria)
+    counts = {measure: performance_counts(measure_masks[measure], masks[measure]) for measure in criteria}
+    for entry in summary_data:
+        measure = entry['Measure'].replace('Measure ', '', 1)
+        if measure in counts:
+            entry['Exclusions'], entry['Numerator'], entry['Performance Rate'] = counts[measure]
+        elif entry['Eligible Patients'] == 'Error':
+            entry['Exclusions'] = entry['Numerator'] = entry['Performance Rate'] = 'Error'
+        else:
+            # No criteria declared: no rate to report
+            entry['Exclusions'] = entry['Numerator'] = entry['Performance Rate'] = None
+    return counts
+
+def process_excel_file(filepath, selected_measures, download_folder, output_name=None, progress_callback=None,
+                       incremental_state=None, reporting_date=None, sheets=None, preview_folder=None,
+                       patient_file=None, join_key=None, source_names=None):
+    """
+    Process the uploaded Excel file(s) with selected measures
+    filepath: path of the workbook, or a list of paths combined into one data set
+    output_name: optional file name for the report (defaults to a timestamped name)
+    progress_callback: optional callable(event, data) told about stage transitions
+        ('stage'), each finished measure ('measure') and the final outcome
+        ('completed' or 'error')
+    incremental_state: optional path of the practice's incremental state file;
+        only rows that are new or changed since the stored run are evaluated
+    reporting_date: date (or YYYY-MM-DD) ages are computed against; defaults
+        to REPORTING_DATE, else today (see dates.py)
+    sheets: optional list of sheet names to read; every sheet is read by default
+    preview_folder: optional folder for a columnar copy of the results that
+        the preview pages read (see preview.py)
+    patient_file: optional workbook of patient demographics joined onto the
+        rows of filepath, which then hold one encounter each (see join.py)
+    join_key: column identifying the patient in both files (default patient_id)
+    source_names: optional {upload file name: original name} used to label
+        the sources (uploads are stored under their content hash)
     Returns: dict with success status and either download_path or error message
     """
+    def report(event, **data):
+        if progress_callback is not None:
+            try:
+                progress_callback(event, data)
+            except Exception as e:
+                logging.warning(f"Progress callback failed: {str(e)}")
+    
+    from dates import use_reporting_date
+    
+    try:
+        with use_reporting_date(reporting_date) as anchor:
+            return _process_excel_file(filepath, selected_measures, download_folder, output_name, report,
+                                       incremental_state, anchor, sheets, preview_folder, patient_file, join_key,
+                                       source_names)
+    except ValueError as e:
+        # Malformed reporting date
+        report('error', error=f"Processing failed: {str(e)}")
+        return {'success': False, 'error': f"Processing failed: {str(e)}"}
+
+def _process_excel_file(filepath, selected_measures, download_folder, output_name, report, incremental_state,
+                        reporting_date, sheets, preview_folder, patient_file=None, join_key=None,
+                        source_names=None):
+    """process_excel_file body, run with the job's reporting date in effect"""
+    import pandas as pd
+    from openpyxl import Workbook
+    from openpyxl.utils.dataframe import dataframe_to_rows
+    from explain import trace_steps
+    
     try:
-        # Read the original Excel file
+        # Read every sheet (or the selected ones) of every input file, with the
+        # headers mapped to the canonical names the measures use
+        from reader import read_inputs
         logging.info(f"Reading Excel file: {filepath}")
-        df = pd.read_excel(filepath)
+        report('stage', stage='reading')
+        df, schema_mapping, sources = read_inputs(filepath, sheets, source_names)
         
         if df.empty:
+            report('error', error='The uploaded file is empty')
             return {'success': False, 'error': 'The uploaded file is empty'}
         
+        join_stats = None
+        if patient_file:
+            # Separate demographics: join them onto the encounter rows by patient
+            from join import join_patients, resolve_key, DEFAULT_KEY
+            report('stage', stage='joining')
+            patients, patient_mapping, patient_sources = read_inputs(patient_file, names=source_names)
+            if patients.empty:
+                report('error', error='The patient file is empty')
+                return {'success': False, 'error': 'The patient file is empty'}
+            key = join_key or DEFAULT_KEY
+            df, join_stats = join_patients(df, patients, resolve_key(df, schema_mapping, key, 'encounter'),
+                                           resolve_key(patients, patient_mapping, key, 'patient'))
+            schema_mapping = {**patient_mapping, **schema_mapping}
+            sources = sources + [{**source, 'role': 'patients'} for source in patient_sources]
+        
+        # Shrink the frame before the measures copy it
+        from ingest import compact_dtypes
+        memory_stats = compact_dtypes(df)
+        report('stage', stage='compacted', before_bytes=memory_stats['before_bytes'],
+               after_bytes=memory_stats['after_bytes'])
+        
+        report('stage', stage='filtering', rows=len(df), measures=len(selected_measures))
+        
+        evaluator = None
+        parallel = None
+        if incremental_state:
+            from incremental import IncrementalEvaluator
+            evaluator = IncrementalEvaluator(incremental_state, df, reporting_date=reporting_date)
+            report('stage', stage='incremental', changed_rows=evaluator.stats['changed_rows'], rows=len(df))
+        else:
+            parallel = evaluate_in_parallel(df, selected_measures, reporting_date)
+        
         # Create a new workbook for results
         wb = Workbook()
         
@@ -58,27 +414,42 @@ def process_excel_file(filepath, selected_measures, download_folder):
         
         # Add original data sheet
         original_sheet = wb.create_sheet("Original Data")
-        for row in dataframe_to_rows(df, index=False, header=True):
-            original_sheet.append(row)
+        append_frame(original_sheet, df, schema_mapping)
         
         # Process each selected measure
         summary_data = []
+        measure_masks = {}
+        # Filter steps of each measure (see explain.py)
+        trace = {}
         
-        for measure in selected_measures:
+        for position, measure in enumerate(selected_measures, start=1):
             try:
                 logging.info(f"Processing measure {measure}")
                 
-                # Load the measure processing function
-                filter_function = load_measure_script(measure)
-                
-                # Apply the filter function to the data
-                filtered_df = filter_function(df.copy())
+                with trace_steps() as steps:
+                    trace[measure] = steps
+                    if parallel is not None:
+                        # Evaluated by a worker, which sent back the rows it selected and the columns it derived
+                        mask, error, worker_steps, output = parallel[measure]
+                        steps.extend(worker_steps)
+                        if error is not None:
+                            raise RuntimeError(error)
+                        filtered_df = assemble_rows(df, *output)
+                    else:
+                        # Load the measure processing function
+                        filter_function = load_measure_script(measure)
+                        
+                        # Apply the filter function to the data
+                        if evaluator is not None:
+                            filtered_df, mask = evaluator.evaluate(measure, filter_function)
+                        else:
+                            filtered_df, mask = evaluate_measure(filter_function, df)
+                measure_masks[measure] = mask
                 
                 if not filtered_df.empty:
                     # Create sheet for this measure
                     measure_sheet = wb.create_sheet(f"Measure {measure}")
-                    for row in dataframe_to_rows(filtered_df, index=False, header=True):
-                        measure_sheet.append(row)
+                    append_frame(measure_sheet, filtered_df, schema_mapping)
                     
                     # Add to summary
                     summary_data.append({
@@ -108,8 +479,31 @@ def process_excel_file(filepath, selected_measures, download_folder):
                     'Eligible Patients': 'Error',
                     'Total Patients': len(df)
                 })
+            
+            report('measure', measure=measure, position=position, total=len(selected_measures),
+                   eligible=summary_data[-1]['Eligible Patients'], rows=len(df))
+        
+        if evaluator is not None:
+            evaluator.save()
+        
+        from bitsets import pack_mask
+        
+        # Roll visit rows up to unique patients and encounters for every measure at once
+        add_rollup_counts(summary_data, df, measure_masks)
+        # Numerators and exclusions of every measure in one more pass over the frame
+        add_performance_rates(summary_data, df, measure_masks)
+        
+        if preview_folder:
+            from preview import save_preview
+            from schema import original_headers
+            try:
+                save_preview(preview_folder, df, measure_masks, original_headers(df.columns, schema_mapping))
+            except (OSError, ValueError, TypeError) as e:
+                # The report is still usable without a preview
+                logging.warning(f"Could not save result preview: {str(e)}")
         
         # Add summary sheet
+        report('stage', stage='writing')
         if summary_data:
             summary_sheet = wb.create_sheet("Summary")
             summary_df = pd.DataFrame(summary_data)
@@ -117,21 +511,39 @@ def process_excel_file(filepath, selected_measures, download_folder):
                 summary_sheet.append(row)
         
         # Save the workbook
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        filename = f"processed_mips_report_{timestamp}.xlsx"
+        if output_name:
+            filename = output_name
+        else:
+            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+            filename = f"processed_mips_report_{timestamp}.xlsx"
         download_path = os.path.join(download_folder, filename)
         
+        os.makedirs(download_folder, exist_ok=True)
         wb.save(download_path)
         logging.info(f"Saved processed file to: {download_path}")
+        report('completed', download_path=download_path)
         
-        return {
+        result = {
             'success': True,
             'download_path': download_path,
-            'summary': summary_data
+            'summary': summary_data,
+            'schema': {str(col): field for col, field in schema_mapping.items()},
+            'memory': memory_stats,
+            'sources': sources,
+            'reporting_date': reporting_date.isoformat(),
+            # Packed eligibility per measure: (row count, one bit per row)
+            'bitsets': {measure: (len(df), pack_mask(mask)) for measure, mask in measure_masks.items()},
+            'trace': trace
         }
+        if evaluator is not None:
+            result['incremental'] = evaluator.stats
+        if join_stats is not None:
+            result['join'] = join_stats
+        return result
         
     except Exception as e:
         logging.error(f"Error processing Excel file: {str(e)}")
+        report('error', error=f"Processing failed: {str(e)}")
         return {
             'success': False,
             'error': f"Processing failed: {str(e)}"
@@ -0,0 +1,194 @@
+"""
+Versioned value sets: the code lists (CPT, ICD-10) the measures select on.
+
+Value sets are plain files, one per set and performance year:
+
+    valuesets/2025/outpatient_visit_cpt.txt
+
+with one code per line ('#' starts a comment). Updating the lists for a new
+performance year means adding a folder, not editing the measures. The year
+used is the reporting date's year (see dates.py), or the latest earlier
+year that has value sets.
+
+A year's files are compiled into one sorted array of fixed-width codes, each
+set a contiguous sorted slice of it, saved as .npy next to a JSON index of
+the slices. The array is memory-mapped, so every process evaluating measures
+shares the same pages, and membership tests are vectorized binary searches
+over the distinct values of a column. The compiled files are named after a
+hash of the sources and rebuilt whenever a source file changes.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+VALUESETS_DIR = os.environ.get('VALUESETS_DIR',
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'valuesets'))
+CACHE_DIR = os.environ.get('VALUESET_CACHE_DIR', os.path.join('cache', 'valuesets'))
+# Longest code stored; longer values can never be in a set
+CODE_WIDTH = 16
+
+_indexes = {}
+_lock = threading.Lock()
+
+def available_years():
+    try:
+        return sorted(int(name) for name in os.listdir(VALUESETS_DIR)
+                      if name.isdigit() and os.path.isdir(os.path.join(VALUESETS_DIR, name)))
+    except FileNotFoundError:
+        return []
+
+def performance_year(year=None):
+    """The value-set year for a reporting year (default: the reporting date's year)"""
+    if year is None:
+        from dates import reporting_date
+        year = reporting_date().year
+    years = available_years()
+    if not years:
+        raise FileNotFoundError(f"No value sets found in {VALUESETS_DIR}")
+    earlier = [y for y in years if y <= int(year)]
+    return earlier[-1] if earlier else years[0]
+
+def read_codes(path):
+    """Distinct codes listed in a value-set file"""
+    codes = set()
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            code = line.split('#', 1)[0].strip()
+            if code:
+                if len(code.encode()) > CODE_WIDTH:
+                    raise ValueError(f"Code {code!r} in {path} is longer than {CODE_WIDTH} bytes")
+                codes.add(code)
+    return codes
+
+def _sources(year):
+    folder = os.path.join(VALUESETS_DIR, str(year))
+    return sorted((name[:-4], os.path.join(folder, name)) for name in os.listdir(folder) if name.endswith('.txt'))
+
+def _signature(year, sources):
+    digest = hashlib.sha1(str(year).encode())
+    for name, path in sources:
+        stat = os.stat(path)
+        digest.update(f"{name}:{stat.st_mtime_ns}:{stat.st_size};".encode())
+    return digest.hexdigest()[:16]
+
+def compile_year(year, sources=None):
+    """Build a year's value sets: (codes array, {name: (start, stop)})"""
+    sources = _sources(year) if sources is None else sources
+    chunks, ranges, start = [], {}, 0
+    for name, path in sources:
+        codes = np.array(sorted(code.encode() for code in read_codes(path)), dtype=f'S{CODE_WIDTH}')
+        chunks.append(codes)
+        ranges[name] = (start, start + len(codes))
+        start += len(codes)
+    codes = np.concatenate(chunks) if chunks else np.array([], dtype=f'S{CODE_WIDTH}')
+    return codes, ranges
+
+class ValueSets:
+    """One performance year's compiled value sets"""
+
+    def __init__(self, year, codes, ranges):
+        self.year = year
+        self._codes = codes
+        self._ranges = ranges
+
+    def names(self):
+        return list(self._ranges)
+
+    def _slice(self, name):
+        try:
+            start, stop = self._ranges[name]
+        except KeyError:
+            raise KeyError(f"Unknown value set {name!r} for {self.year}") from None
+        return self._codes[start:stop]
+
+    def codes(self, name):
+        """The codes of a set, as strings"""
+        return [code.decode() for code in self._slice(name)]
+
+    def contains(self, values, name):
+        """Boolean array: which values are in the set (values compare as str(value))"""
+        members = self._slice(name)
+        values = pd.Series(values, copy=False)
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            labels, uniques = values.cat.codes.to_numpy(), values.cat.categories
+        else:
+            labels, uniques = pd.factorize(values)
+        if not len(members) or not len(uniques):
+            return np.zeros(len(labels), dtype=bool)
+        # Binary search of the distinct values only, then broadcast to the rows
+        keys = np.array([str(value).encode() for value in uniques], dtype=object)
+        fits = np.array([len(key) <= CODE_WIDTH for key in keys], dtype=bool)
+        keys = np.where(fits, keys, b'').astype(f'S{CODE_WIDTH}')
+        positions = np.minimum(np.searchsorted(members, keys), len(members) - 1)
+        found = fits & (members[positions] == keys)
+        return (labels >= 0) & found[np.maximum(labels, 0)]
+
+def _compiled(year, sources):
+    """Compile a year to the cache folder (once per source change) and map it"""
+    signature = _signature(year, sources)
+    base = os.path.join(CACHE_DIR, f"{year}-{signature}")
+    try:
+        with open(f"{base}.json") as f:
+            ranges = {name: tuple(bounds) for name, bounds in json.load(f).items()}
+        return np.load(f"{base}.npy", mmap_mode='r'), ranges
+    except (OSError, ValueError):
+        pass
+
+    codes, ranges = compile_year(year, sources)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # Array first, index last: a present index means a complete build
+        temp_path = f"{base}.{os.getpid()}.tmp.npy"
+        np.save(temp_path, codes)
+        os.replace(temp_path, f"{base}.npy")
+        temp_path = f"{base}.{os.getpid()}.tmp.json"
+        with open(temp_path, 'w') as f:
+            json.dump(ranges, f)
+        os.replace(temp_path, f"{base}.json")
+        logging.info(f"Compiled {len(ranges)} value sets for {year} ({len(codes)} codes) to {base}.npy")
+        return np.load(f"{base}.npy", mmap_mode='r'), ranges
+    except OSError as e:
+        logging.warning(f"Could not save compiled value sets to {CACHE_DIR}, keeping them in memory: {str(e)}")
+        return codes, ranges
+
+def load(year=None):
+    """The value sets for a reporting year (see performance_year)"""
+    year = performance_year(year)
+    sources = _sources(year)
+    signature = _signature(year, sources)
+    with _lock:
+        cached = _indexes.get(year)
+        if cached is None or cached[0] != signature:
+            cached = (signature, ValueSets(year, *_compiled(year, sources)))
+            _indexes[year] = cached
+    return cached[1]
+
+def version(year=None):
+    """'<year>-<hash of its sources>', or None without value sets; changes whenever a list does"""
+    try:
+        year = performance_year(year)
+    except FileNotFoundError:
+        return None
+    return f"{year}-{_signature(year, _sources(year))}"
+
+def value_set(name, year=None):
+    """Codes of a value set for the reporting year"""
+    return load(year).codes(name)
+
+def in_value_set(values, name, year=None):
+    """Boolean array: which values (a column) are in a value set for the reporting year"""
+    return load(year).contains(values, name)
+
+if __name__ == '__main__':
+    import sys
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    for year in ([int(arg) for arg in sys.argv[1:]] or available_years()):
+        sets = load(year)
+        for name in sets.names():
+            print(f"{sets.year} {name}: {len(sets.codes(name))} codes")
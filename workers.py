@@ -0,0 +1,247 @@
+"""
+Prewarmed processing worker pool.
+Workers are forked from a fork server: a separate single-threaded process
+started at boot that imports pandas, openpyxl and the processing modules once,
+so every worker starts warm and shares those pages copy-on-write. The web
+process itself is never forked, which would copy its threads' locks and
+database connections mid-use, so workers can be replaced safely at any time.
+Workers run process_excel_file and retire after a number of jobs or when their
+resident memory passes a threshold, so fragmentation from large DataFrames is
+released back to the OS; the pool replaces retired and dead workers.
+
+Each task is handed to one idle worker, so the pool always knows which task a
+worker holds and fails it if the worker dies.
+
+Enabled with PROCESSING_WORKERS=<n> (see create_app()).
+"""
+
+import os
+import queue
+import collections
+import logging
+import threading
+import itertools
+from concurrent.futures import Future
+
+from utils import process_excel_file, load_measure_script, process_context
+from measures import AVAILABLE_MEASURES
+
+def prewarm():
+    """Import heavy libraries and the measure registry in the current process"""
+    import pandas  # noqa: F401
+    import openpyxl  # noqa: F401
+    from openpyxl.utils.dataframe import dataframe_to_rows  # noqa: F401
+
+    for measure in AVAILABLE_MEASURES:
+        try:
+            load_measure_script(measure)
+        except Exception as e:
+            logging.warning(f"Could not preload measure {measure}: {str(e)}")
+
+def current_rss_mb():
+    """Resident set size of the current process in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+        return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+def _worker_main(task_queue, result_queue, max_jobs, max_rss_mb):
+    """Worker process loop: run tasks until told to stop or due for recycling"""
+    pid = os.getpid()
+    jobs_done = 0
+    reason = 'shutdown'
+    # Measure scripts are loaded by path rather than imported, so the fork server cannot preload them
+    prewarm()
+
+    while True:
+        item = task_queue.get()
+        if item is None:
+            break
+
+        task_id, args, kwargs = item
+
+        def progress(event, data=None, task_id=task_id):
+            result_queue.put(('progress', task_id, event, data))
+
+        try:
+            result = process_excel_file(*args, progress_callback=progress, **kwargs)
+            result_queue.put(('done', task_id, result))
+        except Exception as e:
+            result_queue.put(('failed', task_id, f"Processing failed: {str(e)}"))
+
+        jobs_done += 1
+        if max_jobs and jobs_done >= max_jobs:
+            reason = f"completed {jobs_done} jobs"
+            break
+        rss = current_rss_mb()
+        if max_rss_mb and rss > max_rss_mb:
+            reason = f"RSS {rss:.0f} MB over {max_rss_mb} MB"
+            break
+
+    result_queue.put(('retired', None, pid, reason))
+
+class ProcessingPool:
+    """Fixed-size pool of warm workers running process_excel_file"""
+
+    def __init__(self, size, max_jobs_per_worker=50, max_rss_mb=1024):
+        self.size = size
+        self.max_jobs_per_worker = max_jobs_per_worker
+        self.max_rss_mb = max_rss_mb
+        self.owner_pid = os.getpid()
+        self._context = process_context()
+        self._result_queue = self._context.Queue()
+        # Dispatcher state: pid -> (process, task queue), idle pids, pid -> task id it holds
+        self._workers = {}
+        self._idle = []
+        self._assigned = {}
+        # task id -> (future, progress callback, payload); submitted tasks wait in _pending
+        self._tasks = {}
+        self._pending = collections.deque()
+        self._task_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._dispatcher = None
+
+    def start(self):
+        """Start the workers (and the fork server) and begin dispatching tasks"""
+        for _ in range(self.size):
+            self._spawn()
+
+        self._dispatcher = threading.Thread(target=self._dispatch, name='processing-pool', daemon=True)
+        self._dispatcher.start()
+        logging.info(f"Processing pool started with {self.size} workers ({self._context.get_start_method()})")
+        return self
+
+    def submit(self, *args, progress_callback=None, **kwargs):
+        """Queue a process_excel_file call; returns a Future with its result dict"""
+        if self._closed:
+            raise RuntimeError('Processing pool is shut down')
+        future = Future()
+        task_id = next(self._task_ids)
+        with self._lock:
+            self._tasks[task_id] = (future, progress_callback, (task_id, args, kwargs))
+            self._pending.append(task_id)
+        # Wake the dispatcher to hand the task to an idle worker
+        self._result_queue.put(('submitted', task_id))
+        return future
+
+    def shutdown(self, timeout=10):
+        """Stop all workers after their current task"""
+        self._closed = True
+        for process, task_queue in list(self._workers.values()):
+            task_queue.put(None)
+        for process, task_queue in list(self._workers.values()):
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        if self._dispatcher is not None:
+            self._dispatcher.join(timeout)
+
+    def _spawn(self):
+        task_queue = self._context.SimpleQueue()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(task_queue, self._result_queue, self.max_jobs_per_worker, self.max_rss_mb),
+            daemon=True
+        )
+        process.start()
+        self._workers[process.pid] = (process, task_queue)
+        self._idle.append(process.pid)
+
+    def _assign(self):
+        """Hand pending tasks to idle workers"""
+        with self._lock:
+            while self._idle and self._pending:
+                pid = self._idle.pop()
+                task_id = self._pending.popleft()
+                self._assigned[pid] = task_id
+                self._workers[pid][1].put(self._tasks[task_id][2])
+
+    def _resolve(self, task_id, result):
+        with self._lock:
+            future = self._tasks.pop(task_id, (None, None, None))[0]
+        if future is not None:
+            future.set_result(result)
+
+    def _dispatch(self):
+        while not (self._closed and not self._workers):
+            try:
+                message = self._result_queue.get(timeout=1)
+            except queue.Empty:
+                self._reap_dead_workers()
+                self._assign()
+                continue
+
+            kind, task_id = message[0], message[1]
+            if kind == 'progress':
+                with self._lock:
+                    callback = self._tasks.get(task_id, (None, None, None))[1]
+                if callback is not None:
+                    try:
+                        callback(message[2], message[3])
+                    except Exception as e:
+                        logging.warning(f"Progress callback failed: {str(e)}")
+            elif kind in ('done', 'failed'):
+                for pid, assigned in list(self._assigned.items()):
+                    if assigned == task_id:
+                        del self._assigned[pid]
+                        self._idle.append(pid)
+                if kind == 'done':
+                    self._resolve(task_id, message[2])
+                else:
+                    self._resolve(task_id, {'success': False, 'error': message[2]})
+            elif kind == 'retired':
+                pid, reason = message[2], message[3]
+                self._remove(pid)
+                if not self._closed:
+                    logging.info(f"Recycling processing worker {pid}: {reason}")
+                    self._spawn()
+            self._assign()
+
+    def _remove(self, pid):
+        """Forget a worker; a task handed to it but not started goes back to the front of the queue"""
+        process, _ = self._workers.pop(pid, (None, None))
+        if pid in self._idle:
+            self._idle.remove(pid)
+        task_id = self._assigned.pop(pid, None)
+        if task_id is not None:
+            with self._lock:
+                self._pending.appendleft(task_id)
+        if process is not None:
+            process.join(5)
+
+    def _reap_dead_workers(self):
+        """Replace workers that died without retiring and fail the task they held"""
+        for pid, (process, _) in list(self._workers.items()):
+            if process.is_alive():
+                continue
+            exitcode = process.exitcode
+            task_id = self._assigned.pop(pid, None)
+            self._remove(pid)
+            if task_id is not None:
+                self._resolve(task_id, {'success': False,
+                                        'error': f"Processing worker exited unexpectedly (code {exitcode})"})
+            if not self._closed:
+                logging.warning(f"Processing worker {pid} died with exit code {exitcode}; restarting")
+                self._spawn()
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def start_pool(size, max_jobs_per_worker=50, max_rss_mb=1024):
+    """
+    Return the pool for the current process, starting it on first use.
+    A pool inherited through fork (e.g. gunicorn --preload) belongs to the
+    parent, so each worker process starts its own.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.owner_pid != os.getpid():
+            _pool = ProcessingPool(size, max_jobs_per_worker, max_rss_mb).start()
+        return _pool